@@ -0,0 +1,93 @@
+from fastapi import APIRouter, Request
+from fastapi.responses import Response
+from typing import Optional, Tuple
+import asyncio
+import logging
+import os
+from app.services.image_generation.image_store import image_store
+
+router = APIRouter()
+
+# Настройка логирования
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Содержимое по адресу никогда не меняется
+CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+class RangeNotSatisfiable(ValueError):
+    pass
+
+def parse_range(header: Optional[str], size: int) -> Optional[Tuple[int, int]]:
+    """Разбирает заголовок Range и возвращает (start, end) включительно.
+    
+    None - отдать файл целиком (нет заголовка, несколько диапазонов или
+    непонятный формат). RangeNotSatisfiable - диапазон вне файла.
+    """
+    if not header or not header.startswith("bytes="):
+        return None
+    spec = header[len("bytes="):].strip()
+    if "," in spec or "-" not in spec:
+        return None
+    start_str, end_str = (part.strip() for part in spec.split("-", 1))
+    try:
+        start = int(start_str) if start_str else None
+        end = int(end_str) if end_str else None
+    except ValueError:
+        return None
+    if start is None:
+        # bytes=-N - последние N байт
+        if not end:
+            raise RangeNotSatisfiable(header)
+        return max(size - end, 0), size - 1
+    if end is None:
+        end = size - 1
+    if start >= size or start > end:
+        raise RangeNotSatisfiable(header)
+    return start, min(end, size - 1)
+
+def _read(path: str, start: int, length: int) -> bytes:
+    with open(path, "rb") as f:
+        f.seek(start)
+        return f.read(length)
+
+@router.api_route("/images/{digest}.png", methods=["GET", "HEAD"])
+async def get_image(digest: str, request: Request):
+    path = image_store.path_for(digest)
+    if path is None or not os.path.exists(path):
+        return Response(status_code=404)
+    
+    size = os.path.getsize(path)
+    etag = f'"{digest}"'
+    headers = {
+        "ETag": etag,
+        "Cache-Control": CACHE_CONTROL,
+        "Accept-Ranges": "bytes",
+    }
+    
+    if etag in request.headers.get("if-none-match", ""):
+        return Response(status_code=304, headers=headers)
+    
+    try:
+        byte_range = parse_range(request.headers.get("range"), size)
+    except RangeNotSatisfiable:
+        headers["Content-Range"] = f"bytes */{size}"
+        return Response(status_code=416, headers=headers)
+    
+    # If-Range с чужим ETag - отдаем файл целиком
+    if_range = request.headers.get("if-range")
+    if byte_range and if_range and if_range != etag:
+        byte_range = None
+    
+    start, end = byte_range or (0, size - 1)
+    status_code = 206 if byte_range else 200
+    if byte_range:
+        headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    
+    if request.method == "HEAD":
+        headers["Content-Length"] = str(end - start + 1)
+        return Response(status_code=status_code, headers=headers, media_type="image/png")
+    
+    loop = asyncio.get_event_loop()
+    content = await loop.run_in_executor(None, _read, path, start, end - start + 1)
+    return Response(content=content, status_code=status_code, headers=headers, media_type="image/png")
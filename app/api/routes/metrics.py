@@ -0,0 +1,53 @@
+from fastapi import APIRouter
+from fastapi.responses import Response
+from app.core.metrics import metrics, record_ollama_timings
+from app.core.cancellation import cancellation_stats
+from app.core.tracing import tracer
+from app.core.task_graph import stage_timings
+from app.core.worker_registry import worker_registry
+from app.services.comfy.events import comfy_events
+from app.services.comfy.render_queue import render_queue
+from app.services.comfy.supervisor import comfy_supervisor
+from app.services.gpu import gpu_scheduler, gpu_telemetry
+from app.services.image_generation.illustration_cache import illustration_cache
+from app.services.image_generation.image_store import image_store
+from app.services.ollama.conversation import conversation_stats
+from app.services.ollama.speculation import story_speculator
+from app.services.session import session_store
+from services.json_stream import json_generator
+from services.llm_scheduler import llm_scheduler
+from services.prompt_budget import prompt_budget_stats
+
+router = APIRouter()
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Счетчики компонентов, которые раньше были видны только в логах и get_stats()
+for component, stats_source in (
+    ("llm_scheduler", llm_scheduler),
+    ("json_generator", json_generator),
+    ("prompt_budget", prompt_budget_stats),
+    ("conversation", conversation_stats),
+    ("speculation", story_speculator),
+    ("cancellation", cancellation_stats),
+    ("stage_timings", stage_timings),
+    ("gpu_scheduler", gpu_scheduler),
+    ("gpu_telemetry", gpu_telemetry),
+    ("comfy_supervisor", comfy_supervisor),
+    ("comfy_events", comfy_events),
+    ("render_queue", render_queue),
+    ("illustration_cache", illustration_cache),
+    ("image_store", image_store),
+    ("session_store", session_store),
+    ("worker_registry", worker_registry),
+    ("tracing", tracer),
+):
+    metrics.register_collector(component, stats_source.get_stats)
+
+# Анализ контекста и промпты картинок идут через JSON-генератор, сегменты - через story_generator
+json_generator.on_done(record_ollama_timings)
+
+@router.get("/metrics")
+async def get_metrics():
+    """Метрики воркера в текстовом формате Prometheus"""
+    return Response(content=metrics.render(), media_type=CONTENT_TYPE)
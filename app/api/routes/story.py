@@ -1,51 +1,326 @@
 from fastapi import APIRouter, WebSocket, WebSocketDisconnect
-from typing import List
+from dataclasses import dataclass
+from typing import Dict, Optional, Set
+import asyncio
 import logging
+import time
+import uuid
 from app.services.ollama import generate_next_segment
+from app.services.ollama.story_generator import update_story_context, generate_image_prompt
 from app.services.comfy.image_generator import story_image_generator
-from app.services.ollama.story_generator import update_story_context
-from app.services.image_generation import image_service, GenerationStatus
-import aiohttp
-import asyncio
+from app.core.task_graph import TaskGraph
+from app.services.ollama.timeline import NOT_STARTED
+from app.services.ollama.segment_events import SegmentEventType, extract_choices
+from app.services.ollama.speculation import story_speculator
+from app.services.ollama.conversation import ConversationState
+from app.services.session import session_store, SessionSnapshot, StorySegment
+from app.core.worker_registry import worker_registry
+from app.core.metrics import first_sentence_seconds, websocket_sessions
+from app.core.tracing import tracer
+from services.llm_scheduler import current_session, llm_scheduler
 import json
-from config.ollama_config import OLLAMA_CONFIG
 
 router = APIRouter()
-active_connections: List[WebSocket] = []
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+def context_message(story_context: Dict) -> Dict:
+    return {
+        "type": "context",
+        "content": {
+            "character": {
+                "gender": story_context["current_state"].get("gender", "-"),
+                "age": story_context["current_state"].get("age", "неизвестно"),
+                "name": story_context["current_state"].get("name", "-")
+            },
+            "timeline": story_context.get("timeline", []),
+            "timeline_summary": story_context.get("timeline_summary", ""),
+            "current_state": story_context.get("current_state", {})
+        }
+    }
+
+def session_message(session: SessionSnapshot) -> Dict:
+    return {
+        "type": "session",
+        "token": session.token,
+        "resumed": bool(session.segments)
+    }
+
+def resume_message(session: SessionSnapshot) -> Dict:
+    """Вся сохраненная история одним сообщением: клиент отрисовывает ее без генерации"""
+    return {
+        "type": "resume",
+        "segments": [
+            {
+                "choice": segment.choice,
+                "text": extract_choices(segment.text)[0],
+                "chapter": segment.chapter,
+                "image": segment.image
+            }
+            for segment in session.segments
+        ],
+        "choices": session.choices
+    }
+
+@dataclass
+class PostSegmentTasks:
+    context: asyncio.Task       # обновленный контекст истории (при ошибке - прежний)
+    illustration: asyncio.Task  # картинка сегмента; новый выбор ее отменяет
+
+def start_post_segment(websocket: WebSocket,
+                       text: str,
+                       choice: str,
+                       story_context: Dict,
+                       session_token: Optional[str] = None,
+                       segment_index: int = 0) -> PostSegmentTasks:
+    """Запускает обработку после сегмента фоновыми графами задач.
+    
+    Анализ контекста нужен следующему сегменту, поэтому его ждут;
+    иллюстрация живет отдельно и не задерживает следующий выбор.
+    Каждый результат сохраняется в сессию и отправляется клиенту сразу.
+    """
+    async def update_context():
+        return await update_story_context(text, choice, story_context)
+    
+    async def send_context(context: Dict):
+        if session_token:
+            await session_store.update_context(session_token, context)
+        await websocket.send_json(context_message(context))
+        logger.info("[STORY] <<< Контекст обновлен и отправлен")
+    
+    async def image_prompt():
+        return await generate_image_prompt(text)
+    
+    async def illustration(image_prompt: str):
+        image = await story_image_generator.generate_story_illustration({
+            'current_text': text,
+            'current_chapter': story_context.get("current_chapter", 1),
+            'prompt': image_prompt
+        })
+        return image, image_prompt
+    
+    async def send_image(result):
+        image, prompt = result
+        if image is None:
+            return
+        image_ref = {
+            "url": image.url,
+            "digest": image.digest,
+            "size": image.size,
+            "prompt": prompt
+        }
+        # Сначала сохраняем ссылку: после переподключения картинка не генерируется заново
+        if session_token:
+            await session_store.add_image(session_token, segment_index, image_ref)
+        await websocket.send_json({"type": "image", **image_ref})
+        logger.info("[STORY] <<< Картинка отправлена")
+    
+    context_graph = TaskGraph("post_segment")
+    context_graph.add("context", update_context, on_done=send_context)
+    
+    image_graph = TaskGraph("post_segment")
+    image_graph.add("image_prompt", image_prompt)
+    image_graph.add("illustration", illustration, deps=["image_prompt"], on_done=send_image)
+    
+    async def context_result() -> Dict:
+        results = await context_graph.run()
+        return results.get("context", story_context)
+    
+    return PostSegmentTasks(
+        context=asyncio.ensure_future(context_result()),
+        illustration=asyncio.ensure_future(image_graph.run())
+    )
+
 @router.websocket("/ws")
 async def websocket_endpoint(websocket: WebSocket):
     await websocket.accept()
-    active_connections.append(websocket)
+    # Соединения учитываются в общем реестре: при нескольких воркерах глобальный список видел бы только свои
+    connection_id = uuid.uuid4().hex
+    await worker_registry.register_connection(connection_id)
+    websocket_sessions.inc()
     logger.info("WebSocket connection accepted")
     
+    # Запросы к Ollama из этого соединения (и его фоновых задач) учитываются как одна сессия
+    current_session.set(connection_id)
+    
+    async def send_queue_position(info: Dict):
+        await websocket.send_json({"type": "queued", **info})
+    
+    llm_scheduler.subscribe(connection_id, send_queue_position)
+    
+    # Заранее сгенерированные продолжения этой сессии
+    branches = story_speculator.session_cache()
+    
+    # Сокет читается отдельной задачей: выбор не теряется и не ждет, пока рисуется картинка
+    inbox: asyncio.Queue = asyncio.Queue()
+    illustrations: Set[asyncio.Task] = set()
+    
+    # Генерация текущего сегмента: новый выбор или уход читателя ее прерывают
+    generating: Set[asyncio.Task] = set()
+    # Анализ контекста после сегмента: новый выбор его ждет, прерывает только уход читателя
+    analyses: Set[asyncio.Task] = set()
+    closed = asyncio.Event()
+    
+    def cancel_illustrations(reason: str) -> None:
+        for task in list(illustrations):
+            if not task.done():
+                task.cancel()
+                logger.info(f"[STORY] Иллюстрация отменена: {reason}")
+    
+    def cancel_generation(reason: str) -> None:
+        for task in list(generating):
+            if not task.done():
+                task.cancel()
+                logger.info(f"[STORY] Генерация сегмента прервана: {reason}")
+    
+    def cancel_analyses(reason: str) -> None:
+        for task in list(analyses):
+            if not task.done():
+                task.cancel()
+                logger.info(f"[STORY] Анализ контекста прерван: {reason}")
+    
+    async def run_segment(events, branch, started: float) -> asyncio.Task:
+        """Стримит сегмент отдельной задачей, которую новый выбор или уход читателя отменяют"""
+        task = asyncio.ensure_future(stream_segment(events, branch, started))
+        generating.add(task)
+        task.add_done_callback(generating.discard)
+        # wait, а не await: отмена сегмента не должна отменять саму обработку сообщений
+        await asyncio.wait([task])
+        return task
+    
+    async def send_choices(choices) -> None:
+        if choices:
+            await websocket.send_json({"type": "choices", "choices": choices})
+    
+    def prefetch_after(illustration: asyncio.Task, choices, context: Dict, state, choice_trace) -> None:
+        """Запускает ветки, когда иллюстрация дорисована, если читатель еще не выбрал"""
+        def start(task: asyncio.Task) -> None:
+            if task.cancelled() or closed.is_set() or trace is not choice_trace or not inbox.empty():
+                return
+            branches.start(choices, context, state)
+        illustration.add_done_callback(start)
+    
+    async def read_messages():
+        try:
+            while True:
+                message = json.loads(await websocket.receive_text())
+                if message.get("type") == "choice":
+                    # Следующий сегмент важнее картинки и недописанного текста
+                    cancel_illustrations("новый выбор")
+                    cancel_generation("новый выбор")
+                await inbox.put(message)
+        except WebSocketDisconnect:
+            logger.info("WebSocket connection closed")
+            closed.set()
+            cancel_generation("соединение закрыто")
+            cancel_illustrations("соединение закрыто")
+            cancel_analyses("соединение закрыто")
+        finally:
+            await inbox.put(None)
+    
+    async def stream_segment(events, branch, started: float) -> Optional[Dict]:
+        """Отправляет сегмент клиенту; при отмене закрывает поток Ollama сразу"""
+        offered_choices = []
+        first_sentence = False
+        speculative = branch is not None
+        # Атрибуты пишутся в спан напрямую: пока генератор открыт, текущий спан - запрос к Ollama
+        with tracer.span("segment", speculative=speculative) as span:
+            try:
+                async for event in events:
+                    event_type = event["type"]
+                    
+                    if event_type == SegmentEventType.TEXT:
+                        # Генератор отдает только завершенные предложения: первый фрагмент и есть первое предложение
+                        if not first_sentence:
+                            first_sentence = True
+                            elapsed = time.monotonic() - started
+                            first_sentence_seconds.observe(elapsed, speculative=str(speculative).lower())
+                            if span is not None:
+                                span.attributes["first_sentence_seconds"] = round(elapsed, 3)
+                        await websocket.send_json({
+                            "type": "story",
+                            "content": event["delta"],
+                            "done": False
+                        })
+                    
+                    elif event_type == SegmentEventType.CHOICES:
+                        # Клиенту варианты уходят после регистрации иллюстрации: иначе клик
+                        # раньше нее не отменил бы картинку, и она рисовалась бы вместе со следующим сегментом
+                        logger.info(f"[STORY] Варианты выбора: {event['choices']}")
+                        offered_choices = event["choices"]
+                    
+                    elif event_type == SegmentEventType.DONE:
+                        if span is not None:
+                            span.attributes["chars"] = len(event["text"])
+                        return {"text": event["text"], "chapter": event.get("chapter", 1), "choices": offered_choices}
+                return None
+            finally:
+                # Без aclose генератор держал бы ответ Ollama и место в очереди до сборки мусора
+                await events.aclose()
+                if branch is not None:
+                    await branch.cancel()
+    
+    reader = asyncio.ensure_future(read_messages())
+    trace = None
+    
     try:
-        # Начинаем с кнопки "Начать историю"
-        await websocket.send_json({
-            "type": "choices",
-            "choices": ["Начать историю"]
-        })
+        # Клиент передает токен сессии, чтобы продолжить историю после обрыва связи
+        session = await session_store.open(websocket.query_params.get("session"))
+        await worker_registry.update_connection(connection_id, session.token)
+        await websocket.send_json(session_message(session))
+        story_context = session.story_context
+        segments_count = len(session.segments)
+        conversation = ConversationState()
+        conversation.context = session.conversation_context
+        # Варианты, которые читатель видит сейчас: их показываем снова, если сегмент не удался
+        last_choices = session.choices if session.segments else ["Начать историю"]
+        
+        if session.segments and story_context is not None:
+            logger.info(f"[STORY] Сессия восстановлена: {segments_count} сегментов")
+            await websocket.send_json(resume_message(session))
+            await websocket.send_json(context_message(story_context))
+            if session.choices:
+                branches.start(session.choices, story_context, conversation)
+        else:
+            # Начинаем с кнопки "Начать историю"
+            await websocket.send_json({
+                "type": "choices",
+                "choices": ["Начать историю"]
+            })
         
         while True:
-            data = await websocket.receive_text()
-            message = json.loads(data)
+            message = await inbox.get()
+            if message is None:
+                break
             
             if message["type"] == "choice":
                 choice = message["content"]
+                received = time.monotonic()
                 logger.info(f"User choice received: {choice}")
+                # Трасса выбора: задачи сегмента и после него наследуют ее через contextvars
+                trace = tracer.start_trace("choice", choice=choice[:80], segment=segments_count)
                 
+                branch = None
                 if choice == "Начать историю":
+                    branches.cancel_all()
+                    if segments_count:
+                        # Новая история - новая сессия, старая остается по своему токену
+                        session = await session_store.open()
+                        segments_count = 0
+                        await worker_registry.update_connection(connection_id, session.token)
+                        await websocket.send_json(session_message(session))
+                    # Новая история - новый диалог с Ollama
+                    conversation = ConversationState()
                     # Инициализируем контекст истории
                     story_context = {
                         "current_chapter": 1,
                         "story_state": "beginning",
                         "previous_choices": [],
                         "characters": [],
-                        "timeline": ["История еще не началась..."],
+                        "timeline": [NOT_STARTED],
+                        "timeline_summary": "",
                         "current_state": {
                             "location": "Неизвестно",
                             "scene": "Ожидание начала истории",
@@ -53,119 +328,107 @@ async def websocket_endpoint(websocket: WebSocket):
                         }
                     }
                 else:
+                    # Ветка ищется по контексту до добавления выбора
+                    branch = branches.take(choice, story_context)
                     # Обычная обработка выбора
                     story_context["previous_choices"].append(choice)
                 
-                # Генерируем историю потоково
-                current_text = ""
-                async for segment in generate_next_segment(choice, story_context):
-                    # Если это сообщение с картинкой, просто пересылаем его
-                    if "type" in segment and segment["type"] == "image":
-                        logger.info("[STORY] >>> Пересылаем картинку клиенту")
-                        await websocket.send_json(segment)
-                        logger.info("[STORY] <<< Картинка отправлена")
-                        continue
-
-                    # Отправляем только новый текст
-                    new_text = segment["text"][len(current_text):]
-                    if new_text:
-                        logger.info("[STORY] >>> Начинаем отправку нового текста клиенту")
-                        await websocket.send_json({
-                            "type": "story",
-                            "content": new_text,
-                            "done": segment["done"]
-                        })
-                        logger.info("[STORY] <<< Текст отправлен клиенту")
-                        current_text = segment["text"]
-                        logger.info(f"[STORY] Текущий текст обновлен, done={segment['done']}")
-
-                        # Если это финальный фрагмент, обновляем контекст
-                        if segment["done"]:
-                            logger.info("[STORY] >>> Обновляем контекст истории")
-                            # Обновляем контекст на основе текста
-                            story_context = await update_story_context(current_text, choice, story_context)
-                            # Отправляем обновленный контекст клиенту
-                            await websocket.send_json({
-                                "type": "context",
-                                "content": {
-                                    "character": {
-                                        "gender": story_context["current_state"].get("gender", "-"),
-                                        "age": story_context["current_state"].get("age", "неизвестно"),
-                                        "name": story_context["current_state"].get("name", "-")
-                                    },
-                                    "timeline": story_context.get("timeline", []),
-                                    "current_state": story_context.get("current_state", {})
-                                }
-                            })
-                            logger.info("[STORY] <<< Контекст обновлен и отправлен")
-                    
-                    # Когда история завершена и есть варианты выбора
-                    if segment["choices"] and segment["done"]:
-                        logger.info("[STORY] >>> Начинаем обработку завершенного сегмента")
-                        logger.info(f"[STORY] Варианты выбора: {segment['choices']}")
-                        
-                        logger.info("=== ЗАВЕРШЕНО ПОЛУЧЕНИЕ ДАННЫХ ОТ OLLAMA ===")
-                        logger.info(f"Текущий текст: {current_text}")
-                        logger.info(f"Варианты выбора: {segment['choices']}")
-                        
-                        logger.info("[STORY] >>> Отправляем варианты выбора")
-                        await websocket.send_json({
-                            "type": "choices",
-                            "choices": segment["choices"]
-                        })
-                        logger.info("[STORY] <<< Варианты выбора отправлены")
-                        logger.info("=== КНОПКИ ОТПРАВЛЕНЫ, НАЧИНАЕМ 5-СЕКУНДНОЕ ОЖИДАНИЕ ===")
-                        
-                        # Ждем 5 секунд, чтобы пользователь мог сделать выбор
-                        try:
-                            logger.info("Ждем 5 секунд на выбор пользователя")
-                            await asyncio.wait_for(websocket.receive_text(), timeout=5.0)
-                            logger.info("Пользователь сделал выбор, пропускаем генерацию картинки")
-                            continue
-                        except asyncio.TimeoutError:
-                            logger.info("Пользователь не сделал выбор за 5 секунд")
-                            
-                            # Только теперь начинаем генерацию промпта и картинки
-                            story_context["current_text"] = current_text
-                            async with aiohttp.ClientSession() as session:
-                                story_context["session"] = session
-                                
-                                try:
-                                    # 1. Генерируем английский промпт
-                                    logger.info("Начинаем генерацию промпта для изображения")
-                                    prompt = await story_image_generator._translate_to_english(current_text, session)
-                                    logger.info(f"Сгенерирован промпт: {prompt}")
-                                    
-                                    # 2. Выгружаем Ollama
-                                    logger.info("Выгрузка модели Ollama")
-                                    async with session.post(
-                                        f"{OLLAMA_CONFIG['base_url']}/api/generate",
-                                        json={
-                                            "model": OLLAMA_CONFIG['model'],
-                                            "prompt": "",
-                                            "keep_alive": 0
-                                        }
-                                    ) as response:
-                                        if response.status == 200:
-                                            logger.info("Модель Ollama успешно выгружена")
-                                    
-                                    # 3. Генерируем изображение
-                                    logger.info("Начинаем генерацию изображения")
-                                    result = await image_service.generate_image(prompt, session)
-                                    
-                                    if result.status == GenerationStatus.COMPLETED and result.image_data:
-                                        logger.info("Изображение успешно сгенерировано")
-                                        await websocket.send_json({
-                                            "type": "image",
-                                            "content": result.image_data,
-                                            "prompt": prompt
-                                        })
-                                        logger.info("Изображение отправлено клиенту")
-                                    else:
-                                        logger.error(f"Ошибка генерации изображения: {result.error_message}")
-                                except Exception as e:
-                                    logger.error(f"Ошибка при генерации изображения: {e}")
+                # Генерируем историю потоково: генератор отдает только новые фрагменты
+                if branch is not None and branch.conversation is not None:
+                    conversation = branch.conversation
+                events = branch.stream() if branch else generate_next_segment(choice, story_context, conversation)
+                tracer.annotate(session=session.token, speculative=branch is not None)
+                segment_task = await run_segment(events, branch, received)
+                if branch is not None and not segment_task.cancelled() and segment_task.result() is None:
+                    # Ветка оборвалась без done - генерируем сегмент заново обычным запросом
+                    logger.warning(f"[STORY] Заготовленная ветка '{choice}' оборвалась, генерируем заново")
+                    await websocket.send_json({"type": "cancelled"})
+                    branch = None
+                    events = generate_next_segment(choice, story_context, conversation)
+                    segment_task = await run_segment(events, None, received)
+                if segment_task.cancelled():
+                    tracer.end(trace, asyncio.CancelledError())
+                    # Выбор не состоялся - откатываем его, сегмент не сохраняется
+                    if choice != "Начать историю":
+                        story_context["previous_choices"].pop()
+                    if not closed.is_set():
+                        await websocket.send_json({"type": "cancelled"})
+                    continue
+                segment = segment_task.result()
+                if segment is None:
+                    # Поток закончился без done: выбор не состоялся, читатель выбирает снова
+                    logger.warning(f"[STORY] Сегмент для выбора '{choice}' не получен")
+                    tracer.end(trace, RuntimeError("поток закончился без done"))
+                    if choice != "Начать историю":
+                        story_context["previous_choices"].pop()
+                    if not closed.is_set():
+                        await websocket.send_json({"type": "cancelled"})
+                        await send_choices(["Начать историю"] if choice == "Начать историю" else last_choices)
+                    continue
+                segment_text = segment["text"]
+                offered_choices = segment["choices"]
+                last_choices = offered_choices
                 
+                # Сегмент сохраняется до отправки done: текст уже не придется генерировать заново
+                await session_store.add_segment(
+                    session.token,
+                    StorySegment(
+                        choice=choice,
+                        text=segment_text,
+                        choices=offered_choices,
+                        chapter=segment["chapter"]
+                    ),
+                    story_context,
+                    conversation.context
+                )
+                segment_index = segments_count
+                segments_count += 1
+                await websocket.send_json({
+                    "type": "story",
+                    "content": "",
+                    "done": True
+                })
+                            
+                # Иллюстрация рисуется в фоне, контекст нужен следующему сегменту - ждем его
+                if segment_text:
+                    post = start_post_segment(
+                        websocket, segment_text, choice, story_context, session.token, segment_index
+                    )
+                    illustrations.add(post.illustration)
+                    post.illustration.add_done_callback(illustrations.discard)
+                    # Трасса выбора длится до готовой картинки
+                    post.illustration.add_done_callback(
+                        lambda task, trace=trace: tracer.end(trace, asyncio.CancelledError() if task.cancelled() else None)
+                    )
+                    analyses.add(post.context)
+                    post.context.add_done_callback(analyses.discard)
+                    await send_choices(offered_choices)
+                    # wait, а не await: отмена анализа при уходе читателя не должна ронять обработчик
+                    await asyncio.wait([post.context])
+                    if post.context.cancelled():
+                        continue
+                    story_context = post.context.result()
+                    # Пока рисуется картинка, GPU занят ComfyUI: модель Ollama, загруженная
+                    # ради веток, вытеснила бы ее - продолжения готовим после иллюстрации
+                    if offered_choices:
+                        prefetch_after(post.illustration, offered_choices, story_context, conversation, trace)
+                else:
+                    tracer.end(trace)
+                    await send_choices(offered_choices)
+                    # Пока читатель выбирает, GPU свободен - готовим продолжения заранее
+                    if offered_choices:
+                        branches.start(offered_choices, story_context, conversation)
+    
     except WebSocketDisconnect:
-        active_connections.remove(websocket)
         logger.info("WebSocket connection closed")
+    finally:
+        reader.cancel()
+        cancel_generation("соединение закрыто")
+        cancel_illustrations("соединение закрыто")
+        cancel_analyses("соединение закрыто")
+        branches.cancel_all()
+        # Трасса прерванного выбора тоже экспортируется (уже законченная не меняется)
+        tracer.end(trace, asyncio.CancelledError())
+        llm_scheduler.unsubscribe(connection_id)
+        websocket_sessions.dec()
+        await worker_registry.unregister_connection(connection_id)
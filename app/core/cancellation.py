@@ -0,0 +1,58 @@
+import logging
+from typing import Dict
+
+# Настройка логирования
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+class CancellationStats:
+    """Сколько секунд работы GPU сэкономила отмена.
+    
+    Для каждого вида работы (текст Ollama, рендер ComfyUI) копится
+    средняя длительность завершенных задач. Отмененная задача экономит
+    эту среднюю длительность за вычетом уже потраченного времени; пока
+    завершенных задач нет, экономия не засчитывается.
+    """
+    
+    def __init__(self):
+        self.kinds: Dict[str, Dict[str, float]] = {}
+    
+    def _entry(self, kind: str) -> Dict[str, float]:
+        return self.kinds.setdefault(kind, {
+            "completed": 0,
+            "completed_seconds": 0.0,
+            "cancelled": 0,
+            "cancelled_seconds": 0.0,
+            "gpu_seconds_saved": 0.0,
+        })
+    
+    def average(self, kind: str) -> float:
+        entry = self._entry(kind)
+        return entry["completed_seconds"] / entry["completed"] if entry["completed"] else 0.0
+    
+    def completed(self, kind: str, seconds: float) -> None:
+        entry = self._entry(kind)
+        entry["completed"] += 1
+        entry["completed_seconds"] += seconds
+    
+    def cancelled(self, kind: str, elapsed: float) -> float:
+        """Учитывает отмену после elapsed секунд работы и возвращает оценку экономии"""
+        saved = max(self.average(kind) - elapsed, 0.0)
+        entry = self._entry(kind)
+        entry["cancelled"] += 1
+        entry["cancelled_seconds"] += elapsed
+        entry["gpu_seconds_saved"] += saved
+        logger.info(f"[CANCEL] {kind}: отменено через {elapsed:.1f} с, сэкономлено ~{saved:.1f} с GPU")
+        return saved
+    
+    def get_stats(self) -> Dict:
+        return {
+            "gpu_seconds_saved": sum(entry["gpu_seconds_saved"] for entry in self.kinds.values()),
+            "kinds": {
+                kind: {**entry, "avg_seconds": self.average(kind)}
+                for kind, entry in self.kinds.items()
+            },
+        }
+
+# Общая статистика отмен
+cancellation_stats = CancellationStats()
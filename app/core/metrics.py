@@ -0,0 +1,261 @@
+import bisect
+import math
+import re
+import threading
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+# Метрики в текстовом формате Prometheus (exposition format 0.0.4).
+# Значения хранятся в памяти процесса: при нескольких воркерах uvicorn
+# у каждого свои гистограммы, и /metrics отдает метрики того воркера,
+# который принял запрос.
+
+PREFIX = "storycraft"
+
+LabelValues = Tuple[str, ...]
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _labels(names: Iterable[str], values: Iterable[str], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(str(value))}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def _number(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Metric:
+    kind = "untyped"
+    
+    def __init__(self, name: str, help_text: str, labels: Iterable[str] = ()):
+        self.name = f"{PREFIX}_{name}"
+        self.help = help_text
+        self.label_names = tuple(labels)
+        self._lock = threading.Lock()
+    
+    def _key(self, labels: Dict[str, str]) -> LabelValues:
+        return tuple(str(labels.get(name, "")) for name in self.label_names)
+    
+    def header(self) -> List[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+    
+    def render(self) -> List[str]:
+        raise NotImplementedError
+
+class Counter(Metric):
+    """Монотонный счетчик"""
+    kind = "counter"
+    
+    def __init__(self, name: str, help_text: str, labels: Iterable[str] = ()):
+        super().__init__(name, help_text, labels)
+        self._values: Dict[LabelValues, float] = {}
+        if not self.label_names:
+            # Метрика без меток видна в /metrics с нулем еще до первого события
+            self._values[()] = 0
+    
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+    
+    def value(self, **labels: str) -> float:
+        return self._values.get(self._key(labels), 0)
+    
+    def render(self) -> List[str]:
+        return [
+            f"{self.name}{_labels(self.label_names, key)} {_number(value)}"
+            for key, value in sorted(self._values.items())
+        ]
+
+class Gauge(Counter):
+    """Текущее значение, может уменьшаться"""
+    kind = "gauge"
+    
+    def dec(self, amount: float = 1, **labels: str) -> None:
+        self.inc(-amount, **labels)
+
+class Histogram(Metric):
+    """Распределение значений по корзинам с накоплением, как в Prometheus"""
+    kind = "histogram"
+    
+    def __init__(self, name: str, help_text: str, buckets: Iterable[float], labels: Iterable[str] = ()):
+        super().__init__(name, help_text, labels)
+        self.buckets = sorted(buckets)
+        # метки -> (счетчики по корзинам, сумма, количество)
+        self._values: Dict[LabelValues, list] = {}
+        if not self.label_names:
+            self._values[()] = [[0] * len(self.buckets), 0.0, 0]
+    
+    def observe(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            index = bisect.bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+    
+    def count(self, **labels: str) -> int:
+        entry = self._values.get(self._key(labels))
+        return entry[2] if entry else 0
+    
+    def render(self) -> List[str]:
+        lines = []
+        for key, (counts, total, count) in sorted(self._values.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + [math.inf], counts + [0]):
+                cumulative += bucket_count
+                if bound == math.inf:
+                    cumulative = count
+                le = f'le="{_number(bound)}"'
+                lines.append(f"{self.name}_bucket{_labels(self.label_names, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.label_names, key)} {_number(total)}")
+            lines.append(f"{self.name}_count{_labels(self.label_names, key)} {count}")
+        return lines
+
+def _metric_name(*parts: str) -> str:
+    return re.sub(r"[^a-zA-Z0-9_]", "_", "_".join(parts)).lower()
+
+def _flatten(value, path: Tuple[str, ...]) -> Iterable[Tuple[Tuple[str, ...], float]]:
+    """Числовые значения словаря get_stats() с путем до них; строки и списки пропускаются"""
+    if isinstance(value, bool):
+        yield path, int(value)
+    elif isinstance(value, (int, float)):
+        yield path, value
+    elif isinstance(value, dict):
+        for key, item in value.items():
+            yield from _flatten(item, path + (str(key),))
+
+class MetricsRegistry:
+    """Все метрики процесса и сборщики get_stats() компонентов"""
+    
+    def __init__(self):
+        self.metrics: List[Metric] = []
+        self.collectors: Dict[str, Callable[[], Dict]] = {}
+    
+    def add(self, metric: Metric):
+        self.metrics.append(metric)
+        return metric
+    
+    def counter(self, name: str, help_text: str, labels: Iterable[str] = ()) -> Counter:
+        return self.add(Counter(name, help_text, labels))
+    
+    def gauge(self, name: str, help_text: str, labels: Iterable[str] = ()) -> Gauge:
+        return self.add(Gauge(name, help_text, labels))
+    
+    def histogram(self, name: str, help_text: str, buckets: Iterable[float], labels: Iterable[str] = ()) -> Histogram:
+        return self.add(Histogram(name, help_text, buckets, labels))
+    
+    def register_collector(self, component: str, get_stats: Callable[[], Dict]) -> None:
+        """Счетчики компонента из get_stats() попадут в /metrics как storycraft_<component>_<поле>"""
+        self.collectors[component] = get_stats
+    
+    def render(self) -> str:
+        lines: List[str] = []
+        for metric in self.metrics:
+            lines.extend(metric.header())
+            lines.extend(metric.render())
+        for component, get_stats in self.collectors.items():
+            try:
+                stats = get_stats()
+            except Exception as e:
+                lines.append(f"# {component}: ошибка get_stats: {e}")
+                continue
+            for path, value in _flatten(stats, ()):
+                name = _metric_name(PREFIX, component, *path)
+                lines.append(f"# TYPE {name} untyped")
+                lines.append(f"{name} {_number(value)}")
+        return "\n".join(lines) + "\n"
+
+# Общий реестр метрик процесса
+metrics = MetricsRegistry()
+
+# Время от выбора читателя до первого предложения нового сегмента
+first_sentence_seconds = metrics.histogram(
+    "segment_first_sentence_seconds", "Время до первого предложения сегмента",
+    (0.25, 0.5, 1, 2, 3, 5, 8, 13, 20, 30, 60), labels=("speculative",))
+ollama_tokens_per_second = metrics.histogram(
+    "ollama_tokens_per_second", "Скорость генерации Ollama (eval_count / eval_duration)",
+    (1, 2, 5, 10, 15, 20, 30, 40, 60, 80, 120, 200))
+ollama_prompt_eval_seconds = metrics.histogram(
+    "ollama_prompt_eval_seconds", "Время разбора промпта Ollama (prompt_eval_duration)",
+    (0.05, 0.1, 0.25, 0.5, 1, 2, 4, 8, 16, 32))
+ollama_prompt_tokens = metrics.histogram(
+    "ollama_prompt_tokens", "Токенов промпта, разобранных Ollama (prompt_eval_count)",
+    (64, 128, 256, 512, 1024, 2048, 4096, 8192))
+comfyui_queue_wait_seconds = metrics.histogram(
+    "comfyui_queue_wait_seconds", "Ожидание в очереди ComfyUI до начала выполнения",
+    (0.1, 0.25, 0.5, 1, 2, 5, 10, 30, 60, 120))
+comfyui_sampling_seconds = metrics.histogram(
+    "comfyui_sampling_seconds", "Время семплирования ComfyUI по событиям progress",
+    (0.5, 1, 2, 5, 10, 20, 40, 80, 160))
+image_fetch_bytes = metrics.histogram(
+    "image_fetch_bytes", "Размер иллюстрации, полученной из ComfyUI",
+    (64 << 10, 128 << 10, 256 << 10, 512 << 10, 1 << 20, 2 << 20, 4 << 20, 8 << 20))
+websocket_sessions = metrics.gauge(
+    "websocket_sessions", "Открытые WebSocket-сессии воркера")
+model_loads = metrics.counter(
+    "model_loads_total", "Загрузки моделей в видеопамять", labels=("backend",))
+model_unloads = metrics.counter(
+    "model_unloads_total", "Выгрузки моделей из видеопамяти", labels=("backend",))
+
+def record_ollama_timings(final_chunk: Dict) -> None:
+    """Скорость генерации и разбор промпта из последнего чанка /api/generate (длительности в нс)"""
+    eval_count = final_chunk.get("eval_count")
+    eval_duration = final_chunk.get("eval_duration")
+    if eval_count and eval_duration:
+        ollama_tokens_per_second.observe(eval_count / (eval_duration / 1e9))
+    prompt_eval_duration = final_chunk.get("prompt_eval_duration")
+    if prompt_eval_duration:
+        ollama_prompt_eval_seconds.observe(prompt_eval_duration / 1e9)
+    if final_chunk.get("prompt_eval_count"):
+        ollama_prompt_tokens.observe(final_chunk["prompt_eval_count"])
+
+class ComfyTimings:
+    """Обработчик progress-событий одной задачи ComfyUI для wait_for_prompt.
+    
+    Ожидание в очереди - от отправки до execution_start, семплирование -
+    от первого до последнего события progress.
+    """
+    
+    def __init__(self, submitted: float, clock: Callable[[], float]):
+        self.submitted = submitted
+        self.clock = clock
+        self.started: Optional[float] = None
+        self.first_progress: Optional[float] = None
+        self.last_progress: Optional[float] = None
+    
+    def __call__(self, event_type: str, data: Dict) -> None:
+        now = self.clock()
+        if event_type == "execution_start" and self.started is None:
+            self.started = now
+            comfyui_queue_wait_seconds.observe(now - self.submitted)
+        elif event_type == "progress":
+            if self.first_progress is None:
+                self.first_progress = now
+            self.last_progress = now
+    
+    @property
+    def sampling(self) -> Optional[float]:
+        if self.first_progress is None or self.last_progress <= self.first_progress:
+            return None
+        return self.last_progress - self.first_progress
+    
+    def finish(self) -> None:
+        if self.sampling is not None:
+            comfyui_sampling_seconds.observe(self.sampling)
+    
+    def summary(self) -> Dict[str, float]:
+        """Ожидание в очереди и семплирование, если события о них пришли"""
+        summary = {}
+        if self.started is not None:
+            summary["queue_wait_seconds"] = round(self.started - self.submitted, 3)
+        if self.sampling is not None:
+            summary["sampling_seconds"] = round(self.sampling, 3)
+        return summary
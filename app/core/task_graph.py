@@ -0,0 +1,118 @@
+import asyncio
+import logging
+import time
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+from app.core.tracing import tracer
+
+# Настройка логирования
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+class DependencyFailed(Exception):
+    """Шаг не запускался, потому что не выполнилась его зависимость"""
+    pass
+
+@dataclass
+class TaskNode:
+    name: str
+    func: Callable[..., Awaitable[Any]]
+    deps: List[str] = field(default_factory=list)
+    on_done: Optional[Callable[[Any], Awaitable[None]]] = None
+
+class StageTimings:
+    """Длительности этапов всех графов: количество, сумма и максимум"""
+    
+    def __init__(self):
+        self.stages: Dict[str, Dict[str, float]] = {}
+    
+    def record(self, stage: str, seconds: float, ok: bool = True) -> None:
+        entry = self.stages.setdefault(stage, {"count": 0, "errors": 0, "total": 0.0, "max": 0.0})
+        entry["count"] += 1
+        entry["total"] += seconds
+        entry["max"] = max(entry["max"], seconds)
+        if not ok:
+            entry["errors"] += 1
+    
+    def get_stats(self) -> Dict:
+        return {
+            stage: {**entry, "avg": entry["total"] / entry["count"] if entry["count"] else 0.0}
+            for stage, entry in self.stages.items()
+        }
+
+class TaskGraph:
+    """Небольшой исполнитель DAG из async-шагов.
+    
+    Шаг стартует, как только готовы его зависимости, и получает их
+    результаты именованными аргументами. on_done вызывается сразу по
+    готовности шага, не дожидаясь остальных. Ошибка шага не роняет граф:
+    зависимые шаги пропускаются, остальные выполняются.
+    """
+    
+    def __init__(self, name: str = "graph", timings: Optional[StageTimings] = None):
+        self.name = name
+        self.nodes: Dict[str, TaskNode] = {}
+        self.timings = timings if timings is not None else stage_timings
+        self.durations: Dict[str, float] = {}
+        self.errors: Dict[str, BaseException] = {}
+    
+    def add(self,
+            name: str,
+            func: Callable[..., Awaitable[Any]],
+            deps: Optional[List[str]] = None,
+            on_done: Optional[Callable[[Any], Awaitable[None]]] = None) -> "TaskGraph":
+        for dep in deps or []:
+            if dep not in self.nodes:
+                raise ValueError(f"Шаг {name} зависит от неизвестного шага {dep}")
+        self.nodes[name] = TaskNode(name, func, list(deps or []), on_done)
+        return self
+    
+    async def _run_node(self, node: TaskNode, futures: Dict[str, asyncio.Future]) -> Any:
+        kwargs = {}
+        for dep in node.deps:
+            try:
+                kwargs[dep] = await futures[dep]
+            except Exception as e:
+                raise DependencyFailed(f"{node.name}: не выполнен шаг {dep}") from e
+        
+        started = time.perf_counter()
+        ok = False
+        try:
+            with tracer.span(f"{self.name}.{node.name}"):
+                result = await node.func(**kwargs)
+            ok = True
+        finally:
+            duration = time.perf_counter() - started
+            self.durations[node.name] = duration
+            self.timings.record(f"{self.name}.{node.name}", duration, ok)
+        logger.info(f"[{self.name}] Шаг {node.name} выполнен за {duration:.2f} с")
+        if node.on_done is not None:
+            await node.on_done(result)
+        return result
+    
+    async def run(self) -> Dict[str, Any]:
+        """Выполняет граф и возвращает результаты успешных шагов"""
+        futures: Dict[str, asyncio.Future] = {}
+        # Шаги добавляются только после своих зависимостей, поэтому порядок вставки топологический
+        for name, node in self.nodes.items():
+            futures[name] = asyncio.ensure_future(self._run_node(node, futures))
+        try:
+            await asyncio.wait(futures.values())
+        except asyncio.CancelledError:
+            for future in futures.values():
+                future.cancel()
+            raise
+        
+        results = {}
+        for name, future in futures.items():
+            error = future.exception()
+            if error is None:
+                results[name] = future.result()
+            else:
+                self.errors[name] = error
+                if not isinstance(error, DependencyFailed):
+                    logger.error(f"[{self.name}] Ошибка шага {name}: {error}")
+        return results
+
+# Общая статистика длительностей этапов
+stage_timings = StageTimings()
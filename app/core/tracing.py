@@ -0,0 +1,383 @@
+import aiohttp
+import argparse
+import asyncio
+import functools
+import json
+import logging
+import os
+import secrets
+import sys
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+# Настройка логирования
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+@dataclass
+class Span:
+    """Один этап или внешний вызов внутри трассы выбора"""
+    name: str
+    trace_id: str
+    span_id: str
+    parent_id: Optional[str] = None
+    start: float = field(default_factory=time.time)
+    end: Optional[float] = None
+    status: str = "ok"                  # ok / error / cancelled
+    error: Optional[str] = None
+    attributes: Dict[str, Any] = field(default_factory=dict)
+    _started: float = field(default_factory=time.perf_counter, repr=False)
+    
+    @property
+    def duration(self) -> Optional[float]:
+        return None if self.end is None else self.end - self.start
+    
+    def to_dict(self) -> Dict:
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start": self.start,
+            "duration": self.duration,
+            "status": self.status,
+            "error": self.error,
+            "attributes": self.attributes,
+        }
+
+# Текущий спан задачи; задачи, созданные внутри, наследуют его как родителя
+_current_span: ContextVar[Optional[Span]] = ContextVar("current_span", default=None)
+
+class JSONLExporter:
+    """Дописывает законченные трассы в файл, по спану в строке.
+    
+    Запись идет в пуле потоков, чтобы диск не задерживал event loop.
+    Файл больше max_bytes переименовывается в <файл>.1 (предыдущий .1
+    удаляется), и запись продолжается в новый.
+    """
+    
+    def __init__(self, path: Optional[str] = None, max_bytes: Optional[int] = None):
+        self.path = path or os.getenv("TRACE_FILE", "data/traces.jsonl")
+        self.max_bytes = max_bytes if max_bytes is not None else int(os.getenv("TRACE_FILE_MAX_MB", "64")) * 1024 * 1024
+        self._lock = threading.Lock()
+        self._tasks: set = set()
+        self.stats = {"rotations": 0}
+    
+    def export(self, spans: List[Span]) -> None:
+        lines = "".join(json.dumps(span.to_dict(), ensure_ascii=False, default=str) + "\n" for span in spans)
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self._write(lines)
+            return
+        task = loop.run_in_executor(None, self._write, lines)
+        self._tasks.add(task)
+        task.add_done_callback(self._done)
+    
+    def _done(self, task: asyncio.Future) -> None:
+        self._tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.warning(f"[TRACE] Ошибка записи трассы в {self.path}: {task.exception()}")
+    
+    def _write(self, lines: str) -> None:
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with self._lock:
+            try:
+                size = os.path.getsize(self.path)
+            except FileNotFoundError:
+                size = 0
+            if size and size + len(lines) > self.max_bytes:
+                os.replace(self.path, self.path + ".1")
+                self.stats["rotations"] += 1
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(lines)
+    
+    async def flush(self) -> None:
+        if self._tasks:
+            await asyncio.wait(list(self._tasks))
+
+def _otlp_value(value: Any) -> Dict:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+def to_otlp(spans: List[Span], service_name: str = "storycraft") -> Dict:
+    """Трасса в формате OTLP/HTTP JSON (ExportTraceServiceRequest)"""
+    return {
+        "resourceSpans": [{
+            "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": service_name}}]},
+            "scopeSpans": [{
+                "scope": {"name": "storycraft.tracing"},
+                "spans": [
+                    {
+                        "traceId": span.trace_id,
+                        "spanId": span.span_id,
+                        "parentSpanId": span.parent_id or "",
+                        "name": span.name,
+                        "kind": 1,
+                        "startTimeUnixNano": str(int(span.start * 1e9)),
+                        "endTimeUnixNano": str(int((span.end or span.start) * 1e9)),
+                        "attributes": [
+                            {"key": key, "value": _otlp_value(value)}
+                            for key, value in span.attributes.items()
+                        ],
+                        # 1 - OK, 2 - ERROR; отмена считается успешным завершением
+                        "status": {"code": 2, "message": span.error or ""} if span.status == "error" else {"code": 1},
+                    }
+                    for span in spans
+                ],
+            }],
+        }]
+    }
+
+class OTLPExporter:
+    """Отправляет трассы коллектору OpenTelemetry по OTLP/HTTP JSON"""
+    
+    def __init__(self, endpoint: Optional[str] = None, timeout: float = 5.0):
+        self.endpoint = endpoint or os.getenv("TRACE_OTLP_ENDPOINT", "http://localhost:4318/v1/traces")
+        self.timeout = timeout
+        self._tasks: set = set()
+        self.stats = {"exported": 0, "errors": 0}
+    
+    def export(self, spans: List[Span]) -> None:
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        task = loop.create_task(self._send(to_otlp(spans)))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+    
+    async def _send(self, payload: Dict) -> None:
+        try:
+            async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=self.timeout)) as session:
+                async with session.post(self.endpoint, json=payload) as response:
+                    if response.status >= 300:
+                        raise aiohttp.ClientError(f"статус {response.status}")
+            self.stats["exported"] += 1
+        except (aiohttp.ClientError, asyncio.TimeoutError, OSError) as e:
+            self.stats["errors"] += 1
+            logger.warning(f"[TRACE] Коллектор трасс недоступен: {e}")
+    
+    async def flush(self) -> None:
+        if self._tasks:
+            await asyncio.wait(list(self._tasks))
+
+def make_exporter(kind: Optional[str] = None):
+    """Экспортер по TRACE_EXPORTER: jsonl, otlp или none (по умолчанию)"""
+    kind = (kind or os.getenv("TRACE_EXPORTER", "none")).lower()
+    if kind == "otlp":
+        return OTLPExporter()
+    if kind == "jsonl":
+        return JSONLExporter()
+    return None
+
+class Tracer:
+    """Трассы выборов читателя на contextvars.
+    
+    start_trace() создает корневой спан выбора и делает его текущим;
+    задачи, созданные после этого (сегмент, графы после сегмента,
+    иллюстрация), получают копию контекста и продолжают ту же трассу.
+    Вне трассы span() ничего не записывает, поэтому служебные вызовы
+    (запуск, очистка сессий) трасс не создают.
+    
+    Трасса экспортируется целиком, когда закончились все ее спаны:
+    иллюстрация обычно заканчивается позже корневого спана. Спан,
+    открытый уже после экспорта, уходит отдельной порцией с тем же
+    trace_id - load_traces() собирает их вместе.
+    """
+    
+    def __init__(self, exporter=None, max_pending: int = 256):
+        self.exporter = exporter
+        self.max_pending = max_pending
+        # trace_id -> [число открытых спанов, законченные спаны]
+        self._pending: "OrderedDict[str, list]" = OrderedDict()
+        self.stats = {
+            "traces": 0,
+            "spans": 0,
+            "errors": 0,
+            "cancelled": 0,
+            "exported": 0,
+            "dropped": 0,
+            "export_errors": 0,
+        }
+    
+    @property
+    def enabled(self) -> bool:
+        return self.exporter is not None
+    
+    @staticmethod
+    def current() -> Optional[Span]:
+        return _current_span.get()
+    
+    def _open(self, name: str, trace_id: str, parent_id: Optional[str], attributes: Dict) -> Span:
+        span = Span(name, trace_id, secrets.token_hex(8), parent_id, attributes=dict(attributes))
+        entry = self._pending.get(trace_id)
+        if entry is None:
+            entry = self._pending[trace_id] = [0, []]
+            while len(self._pending) > self.max_pending:
+                # Трасса с незакрытым спаном не должна копиться вечно
+                self._pending.popitem(last=False)
+                self.stats["dropped"] += 1
+        entry[0] += 1
+        return span
+    
+    def start_trace(self, name: str, **attributes) -> Optional[Span]:
+        """Новая трасса; корневой спан становится текущим в этой задаче"""
+        if not self.enabled:
+            return None
+        self.stats["traces"] += 1
+        span = self._open(name, secrets.token_hex(16), None, attributes)
+        _current_span.set(span)
+        return span
+    
+    def start_span(self, name: str, parent: Optional[Span] = None, **attributes) -> Optional[Span]:
+        """Дочерний спан текущего (или parent) без переключения текущего"""
+        parent = parent or _current_span.get()
+        if parent is None or not self.enabled:
+            return None
+        return self._open(name, parent.trace_id, parent.span_id, attributes)
+    
+    def end(self, span: Optional[Span], error: Optional[BaseException] = None) -> None:
+        if span is None or span.end is not None:
+            return
+        span.end = span.start + (time.perf_counter() - span._started)
+        if isinstance(error, (asyncio.CancelledError, GeneratorExit)):
+            span.status = "cancelled"
+            self.stats["cancelled"] += 1
+        elif error is not None:
+            span.status = "error"
+            span.error = f"{type(error).__name__}: {error}"
+            self.stats["errors"] += 1
+        self.stats["spans"] += 1
+        entry = self._pending.get(span.trace_id)
+        if entry is None:
+            return
+        entry[0] -= 1
+        entry[1].append(span)
+        if entry[0] <= 0:
+            del self._pending[span.trace_id]
+            self._export(entry[1])
+    
+    def _export(self, spans: List[Span]) -> None:
+        try:
+            self.exporter.export(sorted(spans, key=lambda span: span.start))
+            self.stats["exported"] += 1
+        except Exception as e:
+            self.stats["export_errors"] += 1
+            logger.warning(f"[TRACE] Ошибка экспорта трассы: {e}")
+    
+    @contextmanager
+    def span(self, name: str, **attributes) -> Iterator[Optional[Span]]:
+        """Спан на время блока; внутри блока он текущий"""
+        span = self.start_span(name, **attributes)
+        if span is None:
+            yield None
+            return
+        token = _current_span.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            self.end(span, e)
+            raise
+        finally:
+            try:
+                _current_span.reset(token)
+            except ValueError:
+                # Асинхронный генератор закрыли из другого контекста
+                pass
+            self.end(span)
+    
+    def annotate(self, **attributes) -> None:
+        """Добавляет атрибуты текущему спану, если он есть"""
+        span = _current_span.get()
+        if span is not None:
+            span.attributes.update(attributes)
+    
+    def traced(self, name: str) -> Callable:
+        """Декоратор async-функции: вызов внутри трассы становится спаном"""
+        def decorator(func: Callable) -> Callable:
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                with self.span(name):
+                    return await func(*args, **kwargs)
+            return wrapper
+        return decorator
+    
+    async def flush(self) -> None:
+        """Дожидается отправки трасс (при завершении приложения)"""
+        flush = getattr(self.exporter, "flush", None)
+        if flush is not None:
+            await flush()
+    
+    def get_stats(self) -> Dict:
+        return {**self.stats, "pending_traces": len(self._pending), "enabled": self.enabled}
+
+# Создаем экземпляр трассировщика
+tracer = Tracer(make_exporter())
+
+def load_traces(path: str) -> Dict[str, List[Dict]]:
+    """Спаны из JSONL, сгруппированные по trace_id"""
+    traces: Dict[str, List[Dict]] = {}
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                span = json.loads(line)
+                traces.setdefault(span["trace_id"], []).append(span)
+    return traces
+
+def format_trace(spans: List[Dict]) -> str:
+    """Дерево спанов трассы со смещением от начала и длительностью"""
+    children: Dict[Optional[str], List[Dict]] = {}
+    ids = {span["span_id"] for span in spans}
+    for span in sorted(spans, key=lambda span: span["start"]):
+        parent = span["parent_id"] if span["parent_id"] in ids else None
+        children.setdefault(parent, []).append(span)
+    origin = min(span["start"] for span in spans)
+    lines: List[str] = []
+    
+    def walk(parent: Optional[str], depth: int) -> None:
+        for span in children.get(parent, []):
+            status = "" if span["status"] == "ok" else f" [{span['status']}]"
+            attributes = " ".join(f"{key}={value}" for key, value in span["attributes"].items())
+            lines.append(
+                f"{span['start'] - origin:8.3f}s {span['duration'] or 0:8.3f}s  "
+                f"{'  ' * depth}{span['name']}{status}  {attributes}".rstrip()
+            )
+            walk(span["span_id"], depth + 1)
+    
+    walk(None, 0)
+    return "\n".join(lines)
+
+def trace_duration(spans: List[Dict]) -> float:
+    return max(span["start"] + (span["duration"] or 0) for span in spans) - min(span["start"] for span in spans)
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Разбор трасс выборов читателя")
+    parser.add_argument("path", nargs="?", default=os.getenv("TRACE_FILE", "data/traces.jsonl"))
+    parser.add_argument("--trace", help="Показать трассу с этим trace_id")
+    parser.add_argument("--slowest", type=int, default=3, help="Сколько самых долгих трасс показать")
+    args = parser.parse_args(argv)
+    
+    traces = load_traces(args.path)
+    if args.trace:
+        selected = [args.trace] if args.trace in traces else []
+    else:
+        selected = sorted(traces, key=lambda trace_id: trace_duration(traces[trace_id]), reverse=True)[:args.slowest]
+    for trace_id in selected:
+        print(f"trace {trace_id}: {trace_duration(traces[trace_id]):.3f}s")
+        print(format_trace(traces[trace_id]))
+        print()
+    return 0 if selected else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,186 @@
+import asyncio
+import errno
+import fcntl
+import logging
+import os
+import sqlite3
+import threading
+import time
+from contextlib import asynccontextmanager
+from typing import Dict, Optional
+
+# Настройка логирования
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+def pid_alive(pid: int) -> bool:
+    """Жив ли процесс на этой машине"""
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+class WorkerRegistry:
+    """Общее состояние воркеров uvicorn на одной машине.
+    
+    Воркеры - отдельные процессы, поэтому глобальные переменные модулей
+    у каждого свои. Все, что должно быть видно сразу всем воркерам,
+    хранится здесь: активные соединения, аренды общих ресурсов GPU
+    (ComfyUI), флаги вроде "модель ComfyUI в памяти". Межпроцессные
+    блокировки - flock на файлах рядом с базой.
+    
+    Записи воркера, который упал, не мешают остальным: при подсчете
+    учитываются только живые процессы.
+    """
+    
+    def __init__(self, path: Optional[str] = None, lock_poll: float = 0.05):
+        self.path = path or os.getenv("WORKER_REGISTRY_PATH", os.path.join("data", "registry.db"))
+        self.lock_poll = lock_poll
+        self._conn: Optional[sqlite3.Connection] = None
+        self._conn_pid: Optional[int] = None
+        self._lock = threading.Lock()
+        self.stats = {
+            "lock_waits": 0,
+            "lock_wait_seconds": 0.0,
+            "stale_rows_removed": 0,
+        }
+    
+    def _connect(self) -> sqlite3.Connection:
+        # После fork соединение родителя использовать нельзя
+        if self._conn is None or self._conn_pid != os.getpid():
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS connections ("
+                "id TEXT PRIMARY KEY, token TEXT, worker INTEGER NOT NULL, connected REAL NOT NULL)"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS leases ("
+                "id TEXT PRIMARY KEY, resource TEXT NOT NULL, worker INTEGER NOT NULL, acquired REAL NOT NULL)"
+            )
+            conn.execute("CREATE TABLE IF NOT EXISTS flags (name TEXT PRIMARY KEY, value TEXT)")
+            self._conn = conn
+            self._conn_pid = os.getpid()
+        return self._conn
+    
+    @property
+    def worker(self) -> int:
+        return os.getpid()
+    
+    def _execute(self, sql: str, params: tuple = ()) -> list:
+        with self._lock:
+            return self._connect().execute(sql, params).fetchall()
+    
+    def _prune(self, table: str) -> None:
+        """Удаляет записи воркеров, которых уже нет"""
+        rows = self._execute(f"SELECT DISTINCT worker FROM {table}")
+        dead = [worker for worker, in rows if not pid_alive(worker)]
+        for worker in dead:
+            with self._lock:
+                removed = self._connect().execute(f"DELETE FROM {table} WHERE worker = ?", (worker,)).rowcount
+            self.stats["stale_rows_removed"] += removed
+            logger.info(f"[REGISTRY] Удалены записи завершившегося воркера {worker}: {removed}")
+    
+    def _count(self, table: str, where: str = "", params: tuple = ()) -> int:
+        self._prune(table)
+        return self._execute(f"SELECT COUNT(*) FROM {table} {where}", params)[0][0]
+    
+    async def _run(self, func, *args):
+        # sqlite3 блокирующий - выполняем в пуле потоков
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, func, *args)
+    
+    # Соединения websocket всех воркеров
+    
+    async def register_connection(self, connection_id: str, token: Optional[str] = None) -> None:
+        await self._run(
+            self._execute,
+            "INSERT OR REPLACE INTO connections (id, token, worker, connected) VALUES (?, ?, ?, ?)",
+            (connection_id, token, self.worker, time.time())
+        )
+    
+    async def update_connection(self, connection_id: str, token: str) -> None:
+        await self._run(self._execute, "UPDATE connections SET token = ? WHERE id = ?", (token, connection_id))
+    
+    async def unregister_connection(self, connection_id: str) -> None:
+        await self._run(self._execute, "DELETE FROM connections WHERE id = ?", (connection_id,))
+    
+    async def count_connections(self, token: Optional[str] = None) -> int:
+        if token is None:
+            return await self._run(self._count, "connections")
+        return await self._run(self._count, "connections", "WHERE token = ?", (token,))
+    
+    # Аренды общих ресурсов (ComfyUI)
+    
+    async def add_lease(self, resource: str, lease_id: str) -> None:
+        await self._run(
+            self._execute,
+            "INSERT OR REPLACE INTO leases (id, resource, worker, acquired) VALUES (?, ?, ?, ?)",
+            (lease_id, resource, self.worker, time.time())
+        )
+    
+    async def remove_lease(self, lease_id: str) -> None:
+        await self._run(self._execute, "DELETE FROM leases WHERE id = ?", (lease_id,))
+    
+    async def count_leases(self, resource: str) -> int:
+        return await self._run(self._count, "leases", "WHERE resource = ?", (resource,))
+    
+    # Флаги
+    
+    async def get_flag(self, name: str) -> Optional[str]:
+        rows = await self._run(self._execute, "SELECT value FROM flags WHERE name = ?", (name,))
+        return rows[0][0] if rows else None
+    
+    async def set_flag(self, name: str, value: str) -> None:
+        await self._run(self._execute, "INSERT OR REPLACE INTO flags (name, value) VALUES (?, ?)", (name, value))
+    
+    async def forget_worker(self) -> None:
+        """Убирает записи этого воркера при его остановке"""
+        for table in ("connections", "leases"):
+            await self._run(self._execute, f"DELETE FROM {table} WHERE worker = ?", (self.worker,))
+    
+    # Межпроцессные блокировки
+    
+    def _lock_path(self, name: str) -> str:
+        directory = os.path.dirname(self.path) or "."
+        os.makedirs(directory, exist_ok=True)
+        return os.path.join(directory, f"{name}.lock")
+    
+    @asynccontextmanager
+    async def lock(self, name: str):
+        """Блокировка на все воркеры; ожидание не занимает поток и отменяемо"""
+        fd = os.open(self._lock_path(name), os.O_RDWR | os.O_CREAT, 0o644)
+        started = time.monotonic()
+        waited = False
+        try:
+            while True:
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except BlockingIOError:
+                    waited = True
+                    await asyncio.sleep(self.lock_poll)
+            if waited:
+                self.stats["lock_waits"] += 1
+                self.stats["lock_wait_seconds"] += time.monotonic() - started
+            yield
+        finally:
+            # Закрытие дескриптора снимает flock
+            os.close(fd)
+    
+    def close(self) -> None:
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+    
+    def get_stats(self) -> Dict:
+        """Возвращает счетчики реестра"""
+        return {**self.stats, "worker": self.worker, "path": self.path}
+
+# Создаем экземпляр общего реестра воркеров
+worker_registry = WorkerRegistry()
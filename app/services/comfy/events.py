@@ -0,0 +1,303 @@
+import aiohttp
+import asyncio
+import json
+import logging
+import uuid
+from collections import OrderedDict
+from typing import Callable, Dict, Optional
+from config.comfy_config import comfy_config
+
+# Настройка логирования
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Понятные имена узлов стандартного workflow для логов
+NODE_NAMES = {
+    '3': 'KSampler',
+    '8': 'VAE Decode',
+    '9': 'SaveImage'
+}
+
+class ComfyUIExecutionError(RuntimeError):
+    """Ошибка выполнения workflow на стороне ComfyUI"""
+    pass
+
+class ComfyEventListener:
+    """Один общий WebSocket к ComfyUI для всех задач приложения.
+    
+    События executed / execution_error / progress раскладываются по
+    future конкретного prompt_id. Опрос /history остается только
+    страховкой: редкий - пока сокет подключен, частый - пока нет.
+    """
+    
+    def __init__(self, base_url: Optional[str] = None):
+        self.base_url = base_url or comfy_config.base_url
+        self.client_id = f"storycraft_{uuid.uuid4().hex[:8]}"
+        self.is_connected = False
+        self.poll_interval_connected = 10.0
+        self.poll_interval_disconnected = 1.0
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._task: Optional[asyncio.Task] = None
+        self._connected_event: Optional[asyncio.Event] = None
+        self._waiters: Dict[str, asyncio.Future] = {}
+        self._outputs: Dict[str, Dict] = {}
+        self._progress_callbacks: Dict[str, Callable[[str, Dict], None]] = {}
+        # Недавно завершенные задачи: событие могло прийти раньше, чем мы начали ждать
+        self._finished: "OrderedDict[str, Dict]" = OrderedDict()
+        self._finished_limit = 64
+        self.stats = {
+            "events": 0,
+            "completed_via_ws": 0,
+            "completed_via_poll": 0,
+            "execution_errors": 0,
+            "reconnects": 0,
+            "interrupted": 0,
+            "deleted_from_queue": 0,
+        }
+    
+    @property
+    def ws_url(self) -> str:
+        return f"ws://{self.base_url.split('://', 1)[1]}/ws?clientId={self.client_id}"
+    
+    def start(self) -> None:
+        """Запускает фоновое подключение, если оно еще не запущено"""
+        if self._connected_event is None:
+            self._connected_event = asyncio.Event()
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+    
+    async def ensure_connected(self, timeout: float = 2.0) -> bool:
+        """Подключается до отправки задачи, чтобы ComfyUI слал её события нам"""
+        self.start()
+        if self.is_connected:
+            return True
+        try:
+            await asyncio.wait_for(self._connected_event.wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            logger.warning("WebSocket ComfyUI не подключился, статус задачи будет опрашиваться")
+        return self.is_connected
+    
+    async def stop(self) -> None:
+        """Закрывает WebSocket при завершении приложения"""
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except (asyncio.CancelledError, Exception):
+                pass
+            self._task = None
+        if self._session and not self._session.closed:
+            await self._session.close()
+        self.is_connected = False
+    
+    async def _run(self) -> None:
+        """Держит WebSocket открытым и переподключается при обрывах"""
+        delay = 0.5
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession()
+        while True:
+            try:
+                async with self._session.ws_connect(self.ws_url, heartbeat=30) as ws:
+                    self.is_connected = True
+                    self._connected_event.set()
+                    delay = 0.5
+                    logger.info(f"Подключен общий WebSocket ComfyUI (clientId: {self.client_id})")
+                    async for msg in ws:
+                        if msg.type == aiohttp.WSMsgType.TEXT:
+                            self._dispatch(msg.data)
+                        elif msg.type in (aiohttp.WSMsgType.CLOSED, aiohttp.WSMsgType.ERROR):
+                            break
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.debug(f"WebSocket ComfyUI недоступен: {e}")
+            if self.is_connected:
+                self.stats["reconnects"] += 1
+                logger.warning("WebSocket ComfyUI отключен, переподключаемся")
+            self.is_connected = False
+            self._connected_event.clear()
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 5.0)
+    
+    def _dispatch(self, raw: str) -> None:
+        """Разбирает событие ComfyUI и передает его ожидающей задаче"""
+        try:
+            data = json.loads(raw)
+        except json.JSONDecodeError:
+            return
+        if not isinstance(data, dict) or 'type' not in data:
+            return
+        
+        self.stats["events"] += 1
+        event_type = data['type']
+        event_data = data.get('data') or {}
+        prompt_id = event_data.get('prompt_id')
+        
+        if event_type == "status":
+            queue_remaining = event_data.get('status', {}).get('exec_info', {}).get('queue_remaining', 0)
+            if queue_remaining > 0:
+                logger.info(f"В очереди {queue_remaining} задач")
+            return
+        
+        if prompt_id is None:
+            return
+        
+        if event_type == "execution_start":
+            logger.info(f"Начало генерации изображения (prompt_id: {prompt_id})")
+        
+        elif event_type == "execution_cached":
+            logger.info("Используется кэшированный результат")
+        
+        elif event_type == "progress":
+            node = event_data.get('node', 'unknown')
+            logger.info(f"Прогресс {NODE_NAMES.get(node, f'Node {node}')}: {event_data.get('value', 0)}/{event_data.get('max', 100)}")
+        
+        elif event_type == "executed":
+            node = event_data.get('node')
+            output = event_data.get('output')
+            if node is not None and output:
+                self._outputs.setdefault(prompt_id, {})[node] = output
+                if 'images' in output:
+                    logger.info(f"Изображение сохранено: {output['images'][0].get('filename')}")
+        
+        elif event_type == "executing":
+            # node == None означает, что весь workflow выполнен
+            if event_data.get('node') is None:
+                self._finish(prompt_id, self._outputs.pop(prompt_id, {}))
+            else:
+                node = event_data['node']
+                logger.info(f"Выполняется {NODE_NAMES.get(node, f'Node {node}')}")
+        
+        elif event_type == "execution_success":
+            self._finish(prompt_id, self._outputs.pop(prompt_id, {}))
+        
+        elif event_type in ("execution_error", "execution_interrupted"):
+            self.stats["execution_errors"] += 1
+            error = event_data.get('exception_message') or event_data.get('error') or event_type
+            logger.error(f"Ошибка генерации: {error}")
+            self._outputs.pop(prompt_id, None)
+            self._finish(prompt_id, ComfyUIExecutionError(str(error)))
+        
+        callback = self._progress_callbacks.get(prompt_id)
+        if callback:
+            try:
+                callback(event_type, event_data)
+            except Exception as e:
+                logger.warning(f"Ошибка в обработчике прогресса: {e}")
+    
+    def _finish(self, prompt_id: str, result) -> None:
+        future = self._waiters.get(prompt_id)
+        if future is not None:
+            if not future.done():
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+            return
+        # Никто еще не ждет - запоминаем результат
+        self._finished[prompt_id] = result
+        while len(self._finished) > self._finished_limit:
+            self._finished.popitem(last=False)
+    
+    async def _poll_history(self, prompt_id: str, session: aiohttp.ClientSession) -> Optional[Dict]:
+        """Разовая проверка /history - запасной путь при потере событий"""
+        try:
+            async with session.get(f"{self.base_url}/history/{prompt_id}") as response:
+                if response.status != 200:
+                    return None
+                history = await response.json()
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            return None
+        entry = history.get(prompt_id)
+        if not entry:
+            return None
+        status = entry.get('status', {})
+        if status.get('status_str') == 'error':
+            raise ComfyUIExecutionError(f"Задача {prompt_id} завершилась с ошибкой")
+        if not entry.get('outputs') and not status.get('completed'):
+            return None
+        return entry.get('outputs', {})
+    
+    async def wait_for_prompt(self,
+                              prompt_id: str,
+                              session: aiohttp.ClientSession,
+                              timeout: float = 300,
+                              on_progress: Optional[Callable[[str, Dict], None]] = None) -> Dict:
+        """Ждет завершения задачи и возвращает outputs по узлам"""
+        self.start()
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        if prompt_id in self._finished:
+            result = self._finished.pop(prompt_id)
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+        self._waiters[prompt_id] = future
+        if on_progress:
+            self._progress_callbacks[prompt_id] = on_progress
+        
+        deadline = loop.time() + timeout
+        try:
+            while True:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    raise TimeoutError("Превышено время ожидания генерации")
+                interval = self.poll_interval_connected if self.is_connected else self.poll_interval_disconnected
+                try:
+                    outputs = await asyncio.wait_for(asyncio.shield(future), timeout=min(interval, remaining))
+                    self.stats["completed_via_ws"] += 1
+                    if outputs:
+                        return outputs
+                    # Для закэшированных узлов events может не быть - берем outputs из истории
+                    return await self._poll_history(prompt_id, session) or {}
+                except asyncio.TimeoutError:
+                    outputs = await self._poll_history(prompt_id, session)
+                    if outputs is not None:
+                        self.stats["completed_via_poll"] += 1
+                        return outputs
+        finally:
+            self._waiters.pop(prompt_id, None)
+            self._progress_callbacks.pop(prompt_id, None)
+            self._outputs.pop(prompt_id, None)
+            if not future.done():
+                future.cancel()
+    
+    async def cancel_prompt(self, prompt_id: str, session: aiohttp.ClientSession) -> Optional[str]:
+        """Снимает задачу с ComfyUI: из очереди удаляет, выполняемую прерывает.
+        
+        Возвращает "deleted", "interrupted" или None, если задача уже завершилась.
+        """
+        try:
+            async with session.get(f"{self.base_url}/queue") as response:
+                queue = await response.json() if response.status == 200 else {}
+            # Элементы очереди: [номер, prompt_id, workflow, ...]
+            pending = any(item[1] == prompt_id for item in queue.get('queue_pending', []))
+            running = any(item[1] == prompt_id for item in queue.get('queue_running', []))
+            if pending:
+                async with session.post(f"{self.base_url}/queue", json={"delete": [prompt_id]}):
+                    pass
+                self.stats["deleted_from_queue"] += 1
+                logger.info(f"Задача {prompt_id} удалена из очереди ComfyUI")
+                return "deleted"
+            if running:
+                # /interrupt прерывает текущую задачу - проверили выше, что это наша
+                async with session.post(f"{self.base_url}/interrupt", json={"prompt_id": prompt_id}):
+                    pass
+                self.stats["interrupted"] += 1
+                logger.info(f"Генерация {prompt_id} прервана")
+                return "interrupted"
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.warning(f"Не удалось отменить задачу ComfyUI {prompt_id}: {e}")
+        return None
+    
+    def get_stats(self) -> Dict:
+        """Возвращает состояние слушателя"""
+        return {
+            **self.stats,
+            "is_connected": self.is_connected,
+            "waiting": len(self._waiters),
+        }
+
+# Общий слушатель событий ComfyUI
+comfy_events = ComfyEventListener()
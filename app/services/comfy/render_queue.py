@@ -0,0 +1,276 @@
+import aiohttp
+import asyncio
+import copy
+import json
+import logging
+import os
+import time
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Set, Tuple
+from config.comfy_config import comfy_config
+from app.core.cancellation import cancellation_stats
+from app.core.metrics import ComfyTimings, image_fetch_bytes
+from app.core.tracing import tracer
+from app.services.comfy.supervisor import comfy_supervisor
+from app.services.comfy.events import comfy_events
+from app.services.gpu import gpu_scheduler, gpu_telemetry, GPUStage
+from app.services.image_generation.image_store import image_store, StoredImage
+
+# Настройка логирования
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Поля, которые у иллюстраций разные; по остальному workflow задачи объединяются в пакет
+PER_JOB_INPUTS = {("6", "text"), ("3", "seed")}
+
+def batch_key(workflow: Dict) -> str:
+    """Ключ пакета: workflow без текста промпта и сида (чекпоинт, размер, шаги и т.д.)"""
+    shared = {}
+    for node_id, node in workflow.items():
+        inputs = {
+            name: value for name, value in node.get("inputs", {}).items()
+            if (node_id, name) not in PER_JOB_INPUTS
+        }
+        shared[node_id] = {"class_type": node.get("class_type"), "inputs": inputs}
+    return json.dumps(shared, sort_keys=True)
+
+def _references(node: Dict) -> Set[str]:
+    """Узлы, на выходы которых ссылается узел"""
+    return {
+        value[0] for value in node.get("inputs", {}).values()
+        if isinstance(value, list) and len(value) == 2 and isinstance(value[0], str)
+    }
+
+def build_batch_workflow(workflows: List[Dict]) -> Tuple[Dict, List[str]]:
+    """Собирает из workflow одного пакета один граф для /prompt.
+    
+    Узлы, одинаковые у всех задач (чекпоинт, LoRA, негативный промпт,
+    латент), остаются в графе один раз; различающиеся узлы и все, что от
+    них зависит, копируются для каждого уникального workflow. Одинаковые
+    workflow (тот же промпт и сид) рендерятся один раз.
+    
+    Возвращает граф и id узла SaveImage для каждого входного workflow.
+    """
+    unique: List[Dict] = []
+    index_of: Dict[str, int] = {}
+    chain_of: List[int] = []
+    for workflow in workflows:
+        key = json.dumps(workflow, sort_keys=True)
+        if key not in index_of:
+            index_of[key] = len(unique)
+            unique.append(workflow)
+        chain_of.append(index_of[key])
+    
+    template = unique[0]
+    # Узлы, которые различаются между задачами, и все их потомки
+    per_job = {
+        node_id for node_id in template
+        if any(json.dumps(w.get(node_id), sort_keys=True) != json.dumps(template[node_id], sort_keys=True)
+               for w in unique[1:])
+    }
+    changed = True
+    while changed:
+        changed = False
+        for node_id, node in template.items():
+            if node_id not in per_job and _references(node) & per_job:
+                per_job.add(node_id)
+                changed = True
+    
+    def chain_id(node_id: str, chain: int) -> str:
+        # Первая цепочка сохраняет исходные id, чтобы одиночная задача не отличалась от прежней
+        return node_id if chain == 0 or node_id not in per_job else f"{node_id}.{chain}"
+    
+    combined: Dict = {node_id: node for node_id, node in template.items() if node_id not in per_job}
+    for chain, workflow in enumerate(unique):
+        for node_id in per_job:
+            node = copy.deepcopy(workflow[node_id])
+            for name, value in node.get("inputs", {}).items():
+                if isinstance(value, list) and len(value) == 2 and value[0] in per_job:
+                    node["inputs"][name] = [chain_id(value[0], chain), value[1]]
+            combined[chain_id(node_id, chain)] = node
+    
+    save_node = next(
+        (node_id for node_id, node in template.items() if node.get("class_type") == "SaveImage"), "9"
+    )
+    return combined, [chain_id(save_node, chain) for chain in chain_of]
+
+@dataclass
+class RenderJob:
+    workflow: Dict
+    future: asyncio.Future
+    enqueued: float = field(default_factory=time.monotonic)
+
+class RenderQueue:
+    """Очередь иллюстраций всех сессий воркера.
+    
+    Задачи копятся в течение короткого окна; задачи с одинаковыми
+    настройками (чекпоинт, размер, шаги) уходят в ComfyUI одним
+    workflow, и каждая сессия получает свою картинку из его выходов.
+    Так ComfyUI один раз проверяет модели и обрабатывает одну задачу
+    очереди вместо нескольких.
+    """
+    
+    def __init__(self, window: Optional[float] = None, max_batch: Optional[int] = None):
+        self.window = window if window is not None else float(os.getenv("COMFYUI_BATCH_WINDOW", "0.3"))
+        self.max_batch = max_batch or int(os.getenv("COMFYUI_MAX_BATCH", "4"))
+        self._pending: List[RenderJob] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._tasks: Set[asyncio.Task] = set()
+        self.stats = {
+            "jobs": 0,
+            "batches": 0,
+            "batched_jobs": 0,
+            "deduplicated": 0,
+            "largest_batch": 0,
+            "failures": 0,
+            "cancelled_batches": 0,
+        }
+    
+    async def render(self, workflow: Dict) -> Optional[StoredImage]:
+        """Ставит workflow в очередь и ждет готовую картинку.
+        
+        Пакет запускается из контекста задачи, которая его открыла, поэтому
+        спаны ComfyUI попадают в трассу первой задачи пакета.
+        """
+        with tracer.span("comfyui.render"):
+            job = RenderJob(workflow, asyncio.get_event_loop().create_future())
+            self._pending.append(job)
+            self.stats["jobs"] += 1
+            if len(self._pending) >= self.max_batch:
+                self._flush()
+            elif self._timer is None:
+                self._timer = asyncio.get_event_loop().call_later(self.window, self._flush)
+            return await job.future
+    
+    def _flush(self) -> None:
+        """Разбирает накопленные задачи на пакеты и запускает их"""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        jobs = [job for job in self._pending if not job.future.done()]
+        self._pending = []
+        
+        groups: Dict[str, List[RenderJob]] = {}
+        for job in jobs:
+            groups.setdefault(batch_key(job.workflow), []).append(job)
+        for group in groups.values():
+            for start in range(0, len(group), self.max_batch):
+                task = asyncio.ensure_future(self._run(group[start:start + self.max_batch]))
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+    
+    async def _run(self, jobs: List[RenderJob]) -> None:
+        self.stats["batches"] += 1
+        self.stats["largest_batch"] = max(self.stats["largest_batch"], len(jobs))
+        if len(jobs) > 1:
+            self.stats["batched_jobs"] += len(jobs)
+            waited = time.monotonic() - min(job.enqueued for job in jobs)
+            logger.info(f"[RENDER] Пакет из {len(jobs)} иллюстраций (ожидание {waited:.2f}с)")
+        # Если все сессии пакета отказались от картинок (новый выбор, уход), пакет отменяется
+        render = asyncio.ensure_future(self._render_batch([job.workflow for job in jobs]))
+        abandoned = asyncio.ensure_future(asyncio.wait([job.future for job in jobs]))
+        await asyncio.wait([render, abandoned], return_when=asyncio.FIRST_COMPLETED)
+        abandoned.cancel()
+        if not render.done():
+            render.cancel()
+            try:
+                await render
+            except (asyncio.CancelledError, Exception):
+                pass
+            self.stats["cancelled_batches"] += 1
+            logger.info(f"[RENDER] Пакет из {len(jobs)} иллюстраций отменен: картинки больше не нужны")
+            return
+        try:
+            images = render.result()
+        except Exception as e:
+            self.stats["failures"] += 1
+            logger.error(f"[RENDER] Ошибка пакета из {len(jobs)} иллюстраций: {e}")
+            for job in jobs:
+                if not job.future.done():
+                    job.future.set_exception(e)
+            return
+        for job, image in zip(jobs, images):
+            if not job.future.done():
+                job.future.set_result(image)
+    
+    async def _render_batch(self, workflows: List[Dict]) -> List[Optional[StoredImage]]:
+        """Выполняет пакет одним workflow на прогретом ComfyUI"""
+        workflow, save_nodes = build_batch_workflow(workflows)
+        self.stats["deduplicated"] += len(save_nodes) - len(set(save_nodes))
+        tracer.annotate(batch=len(workflows))
+        
+        async with comfy_supervisor.acquire():
+            # Выгружаем модель Ollama, только если иначе не хватит видеопамяти
+            decision = await gpu_scheduler.prepare(GPUStage.IMAGE)
+            if not decision.fits:
+                logger.warning("Недостаточно свободной памяти GPU для генерации изображения")
+                return [None] * len(workflows)
+            
+            async with aiohttp.ClientSession() as session:
+                # Подключаемся к общему WebSocket до отправки, чтобы получить события задачи
+                await comfy_events.ensure_connected()
+                with tracer.span("comfyui.submit", images=len(set(save_nodes))):
+                    async with session.post(
+                        f"{comfy_config.base_url}/prompt",
+                        json={"prompt": workflow, "client_id": comfy_events.client_id}
+                    ) as response:
+                        if response.status != 200:
+                            logger.error(f"Ошибка запуска workflow: {await response.text()}")
+                            return [None] * len(workflows)
+                        prompt_id = (await response.json())['prompt_id']
+                        logger.info(f"Запущена генерация {len(set(save_nodes))} изображений, prompt_id: {prompt_id}")
+                
+                # Ждем события о завершении вместо опроса /history
+                submitted = time.monotonic()
+                timings = ComfyTimings(submitted, time.monotonic)
+                with tracer.span("comfyui.execute", prompt_id=prompt_id), gpu_telemetry.stage("image"):
+                    try:
+                        outputs = await comfy_events.wait_for_prompt(prompt_id, session, on_progress=timings)
+                    except asyncio.CancelledError:
+                        # Снимаем задачу с ComfyUI, иначе она займет GPU впустую
+                        outcome = await comfy_events.cancel_prompt(prompt_id, session)
+                        if outcome is not None:
+                            cancellation_stats.cancelled("comfyui", 0.0 if outcome == "deleted" else time.monotonic() - submitted)
+                        raise
+                    cancellation_stats.completed("comfyui", time.monotonic() - submitted)
+                    timings.finish()
+                    tracer.annotate(**timings.summary())
+                await gpu_scheduler.mark_loaded(GPUStage.IMAGE)
+                
+                images: Dict[str, Optional[StoredImage]] = {}
+                for node_id in set(save_nodes):
+                    images[node_id] = await self._fetch(session, outputs.get(node_id), prompt_id)
+                return [images[node_id] for node_id in save_nodes]
+    
+    async def _fetch(self, session: aiohttp.ClientSession, output: Optional[Dict], prompt_id: str) -> Optional[StoredImage]:
+        """Забирает картинку узла SaveImage и кладет ее в хранилище"""
+        if not output or 'images' not in output:
+            logger.error(f"ComfyUI не вернул изображение для prompt_id: {prompt_id}")
+            return None
+        image_path = output['images'][0]['filename']
+        with tracer.span("comfyui.fetch", filename=image_path):
+            try:
+                async with session.get(f"{comfy_config.base_url}/view", params={"filename": image_path}) as response:
+                    if response.status == 200:
+                        # Сохраняем файл и отдаем клиенту ссылку вместо base64
+                        content = await response.read()
+                        image_fetch_bytes.observe(len(content))
+                        tracer.annotate(bytes=len(content))
+                        return await image_store.save(content)
+                    logger.error(f"Ошибка при получении изображения: {response.status}")
+                    return None
+            except Exception as e:
+                logger.error(f"Ошибка при получении изображения: {e}")
+                return None
+    
+    def get_stats(self) -> Dict:
+        """Возвращает счетчики пакетов"""
+        return {
+            **self.stats,
+            "pending": len(self._pending),
+            "window": self.window,
+            "max_batch": self.max_batch,
+        }
+
+# Создаем экземпляр очереди иллюстраций
+render_queue = RenderQueue()
@@ -0,0 +1,286 @@
+import aiohttp
+import asyncio
+import logging
+import os
+import uuid
+from contextlib import asynccontextmanager
+from typing import Dict, List, Optional
+from app.core.worker_registry import WorkerRegistry, worker_registry
+from config.comfy_config import comfy_config
+
+# Настройка логирования
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+class ComfyUISupervisor:
+    """Держит процесс ComfyUI прогретым между иллюстрациями.
+    
+    Сессии берут ComfyUI через acquire(); процесс запускается при первом
+    обращении, перезапускается при падении и останавливается, только когда
+    никто им не пользуется дольше idle_timeout секунд.
+    
+    При нескольких воркерах uvicorn процесс запускает только один из них
+    (под межпроцессной блокировкой), остальные видят его как внешний.
+    Пользователи учитываются в общем реестре, поэтому владелец не
+    остановит ComfyUI, пока с ним работает другой воркер.
+    """
+    
+    def __init__(self,
+                 command: Optional[List[str]] = None,
+                 cwd: Optional[str] = None,
+                 base_url: Optional[str] = None,
+                 idle_timeout: Optional[float] = None,
+                 startup_timeout: Optional[float] = None,
+                 max_restarts: Optional[int] = None,
+                 registry: Optional[WorkerRegistry] = None,
+                 log_file: Optional[str] = None):
+        self.comfyui_path = cwd or os.getenv('COMFYUI_PATH', '/home/user/Загрузки/Data/Packages/ComfyUI')
+        if command is None:
+            python_path = os.getenv('COMFYUI_PYTHON_PATH', './venv/bin/python3')
+            script = os.getenv('COMFYUI_SCRIPT', 'main.py')
+            args = os.getenv('COMFYUI_ARGS', '--listen 0.0.0.0 --lowvram --preview-method auto --use-quad-cross-attention --force-fp32').split()
+            command = [python_path, script] + args
+        self.comfyui_command = command
+        self.base_url = base_url or comfy_config.base_url
+        
+        self.idle_timeout = idle_timeout if idle_timeout is not None else float(os.getenv('COMFYUI_IDLE_TIMEOUT', '300'))
+        self.startup_timeout = startup_timeout if startup_timeout is not None else float(os.getenv('COMFYUI_STARTUP_TIMEOUT', '120'))
+        self.max_restarts = max_restarts if max_restarts is not None else int(os.getenv('COMFYUI_MAX_RESTARTS', '3'))
+        self.registry = registry or worker_registry
+        self.log_file = os.path.abspath(log_file or os.getenv('COMFYUI_LOG_FILE', os.path.join('data', 'comfyui.log')))
+        self.probe_interval = 0.5
+        
+        self.process: Optional[asyncio.subprocess.Process] = None
+        self.refcount = 0
+        self.is_ready = False
+        self.is_external = False  # ComfyUI запущен не нами (например, вручную)
+        self._lock: Optional[asyncio.Lock] = None
+        self._idle_task: Optional[asyncio.Task] = None
+        self._watch_task: Optional[asyncio.Task] = None
+        self._stopping = False
+        self._restarts = 0
+        
+        self.stats = {
+            "acquires": 0,
+            "warm_acquires": 0,
+            "starts": 0,
+            "restarts": 0,
+            "crashes": 0,
+            "idle_shutdowns": 0,
+            "handed_over": 0,
+        }
+        logger.info(f"ComfyUI path: {self.comfyui_path}")
+        logger.info(f"ComfyUI command: {self.comfyui_command}")
+    
+    def _get_lock(self) -> asyncio.Lock:
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        return self._lock
+    
+    @asynccontextmanager
+    async def acquire(self):
+        """Берет ComfyUI в пользование на время блока"""
+        self.refcount += 1
+        self.stats["acquires"] += 1
+        self._cancel_idle_timer()
+        lease_id = uuid.uuid4().hex
+        try:
+            await self.registry.add_lease("comfyui", lease_id)
+            await self.ensure_running()
+        except BaseException:
+            await self.registry.remove_lease(lease_id)
+            self._release()
+            raise
+        try:
+            yield self
+        finally:
+            await self.registry.remove_lease(lease_id)
+            self._release()
+    
+    def _release(self) -> None:
+        self.refcount -= 1
+        if self.refcount == 0:
+            self._schedule_idle_shutdown()
+    
+    async def ensure_running(self) -> None:
+        """Запускает ComfyUI, если он еще не готов к работе"""
+        async with self._get_lock(), self.registry.lock("comfyui"):
+            if self.is_ready and self._is_alive():
+                self.stats["warm_acquires"] += 1
+                return
+            # Внешний ComfyUI (в том числе запущенный другим воркером) мог остановиться
+            if self.is_ready and self.is_external:
+                if await self.probe():
+                    self.stats["warm_acquires"] += 1
+                    return
+                self.is_ready = False
+            
+            # ComfyUI уже мог быть запущен вручную - тогда просто используем его
+            if not self._is_alive() and await self.probe():
+                logger.info("Используем уже запущенный ComfyUI сервер")
+                self.is_external = True
+                self.is_ready = True
+                return
+            
+            self.is_external = False
+            await self._start()
+    
+    async def probe(self, session: Optional[aiohttp.ClientSession] = None) -> bool:
+        """Проверяет, отвечает ли ComfyUI на HTTP запросы"""
+        own_session = session is None
+        if own_session:
+            session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=2))
+        try:
+            async with session.get(f"{self.base_url}/system_stats") as response:
+                return response.status == 200
+        except (aiohttp.ClientError, asyncio.TimeoutError, OSError):
+            return False
+        finally:
+            if own_session:
+                await session.close()
+    
+    def _is_alive(self) -> bool:
+        return self.process is not None and self.process.returncode is None
+    
+    async def _start(self) -> None:
+        """Запускает процесс ComfyUI и ждет готовности"""
+        logger.info("Запускаем ComfyUI сервер...")
+        self._stopping = False
+        os.makedirs(os.path.dirname(self.log_file), exist_ok=True)
+        if os.path.exists(self.log_file):
+            # Вывод предыдущего запуска (например, перед падением) остается в .1
+            os.replace(self.log_file, self.log_file + ".1")
+        # Процесс не зависит от запустившего воркера: своя сессия (сигналы группы воркера
+        # до него не доходят) и вывод в файл, а не в pipe, который закроется с воркером.
+        # Иначе ComfyUI, оставленный другим воркерам при shutdown(), не пережил бы выход владельца
+        with open(self.log_file, "ab") as log:
+            self.process = await asyncio.create_subprocess_exec(
+                *self.comfyui_command,
+                cwd=self.comfyui_path,
+                stdin=asyncio.subprocess.DEVNULL,
+                stdout=log,
+                stderr=asyncio.subprocess.STDOUT,
+                start_new_session=True
+            )
+        logger.info(f"Вывод ComfyUI пишется в {self.log_file}")
+        self.stats["starts"] += 1
+        try:
+            await self._wait_ready()
+        except BaseException:
+            await self._terminate()
+            raise
+        self._watch_task = asyncio.create_task(self._watch(self.process))
+    
+    async def _wait_ready(self) -> None:
+        """Ждет, пока ComfyUI начнет отвечать, не блокируя event loop"""
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + self.startup_timeout
+        async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=2)) as session:
+            while loop.time() < deadline:
+                if self.process.returncode is not None:
+                    raise RuntimeError(f"ComfyUI завершился при запуске с кодом {self.process.returncode}")
+                if await self.probe(session):
+                    self.is_ready = True
+                    logger.info("ComfyUI сервер запущен и готов к работе")
+                    return
+                await asyncio.sleep(self.probe_interval)
+        raise TimeoutError(f"ComfyUI сервер не смог запуститься за {self.startup_timeout} секунд")
+    
+    async def _watch(self, process: asyncio.subprocess.Process) -> None:
+        """Следит за процессом и перезапускает его при падении"""
+        returncode = await process.wait()
+        if self._stopping or process is not self.process:
+            return
+        
+        self.is_ready = False
+        self.stats["crashes"] += 1
+        logger.error(f"ComfyUI неожиданно завершился с кодом {returncode}")
+        
+        if self.refcount == 0:
+            return
+        if self._restarts >= self.max_restarts:
+            logger.error(f"Превышено количество перезапусков ComfyUI ({self.max_restarts})")
+            return
+        
+        self._restarts += 1
+        self.stats["restarts"] += 1
+        logger.info(f"Перезапускаем ComfyUI (попытка {self._restarts}/{self.max_restarts})")
+        try:
+            async with self._get_lock(), self.registry.lock("comfyui"):
+                if not self.is_ready:
+                    await self._start()
+        except Exception as e:
+            logger.error(f"Не удалось перезапустить ComfyUI: {e}")
+    
+    def _schedule_idle_shutdown(self) -> None:
+        if self.is_external or not self._is_alive():
+            return
+        self._cancel_idle_timer()
+        self._idle_task = asyncio.create_task(self._idle_shutdown())
+    
+    def _cancel_idle_timer(self) -> None:
+        if self._idle_task and not self._idle_task.done():
+            self._idle_task.cancel()
+        self._idle_task = None
+    
+    async def _idle_shutdown(self) -> None:
+        while True:
+            await asyncio.sleep(self.idle_timeout)
+            async with self._get_lock():
+                if self.refcount or not self._is_alive():
+                    return
+                # Процесс наш, но им может пользоваться другой воркер
+                leases = await self.registry.count_leases("comfyui")
+                if leases:
+                    logger.info(f"ComfyUI используется другими воркерами ({leases}), не останавливаем")
+                    continue
+                logger.info(f"ComfyUI простаивает {self.idle_timeout} секунд, останавливаем")
+                self.stats["idle_shutdowns"] += 1
+                await self._terminate()
+                return
+    
+    async def _terminate(self) -> None:
+        """Останавливает только запущенный нами процесс"""
+        self._stopping = True
+        self.is_ready = False
+        process = self.process
+        if process is None:
+            return
+        if process.returncode is None:
+            logger.info(f"Останавливаем ComfyUI сервер (PID: {process.pid})")
+            process.terminate()
+            try:
+                await asyncio.wait_for(process.wait(), timeout=10)
+            except asyncio.TimeoutError:
+                process.kill()
+                await process.wait()
+        self.process = None
+        self._restarts = 0
+        logger.info("ComfyUI сервер остановлен")
+    
+    async def shutdown(self) -> None:
+        """Останавливает ComfyUI при завершении приложения, если он не нужен другим воркерам"""
+        self._cancel_idle_timer()
+        async with self._get_lock():
+            if self._is_alive():
+                leases = await self.registry.count_leases("comfyui")
+                if leases:
+                    # Процесс остается работать: другие воркеры найдут его по probe() как внешний
+                    logger.info(f"ComfyUI используется другими воркерами ({leases}), оставляем запущенным")
+                    self._stopping = True
+                    self.stats["handed_over"] += 1
+                    return
+            await self._terminate()
+    
+    def get_stats(self) -> Dict:
+        """Возвращает состояние супервизора"""
+        return {
+            **self.stats,
+            "refcount": self.refcount,
+            "is_ready": self.is_ready,
+            "is_external": self.is_external,
+            "pid": self.process.pid if self._is_alive() else None,
+        }
+
+# Создаем экземпляр супервизора
+comfy_supervisor = ComfyUISupervisor()
@@ -0,0 +1,4 @@
+from .scheduler import gpu_scheduler, GPUStage, ResidencyDecision
+from .telemetry import gpu_telemetry, GPUTelemetry, TelemetrySample
+
+__all__ = ['gpu_scheduler', 'GPUStage', 'ResidencyDecision', 'gpu_telemetry', 'GPUTelemetry', 'TelemetrySample']
@@ -0,0 +1,269 @@
+import aiohttp
+import asyncio
+import logging
+import os
+import time
+from collections import deque
+from dataclasses import dataclass, asdict, field
+from enum import Enum
+from typing import Dict, List, Optional
+from app.core.worker_registry import WorkerRegistry, worker_registry
+from app.core.metrics import model_loads, model_unloads
+from app.core.tracing import tracer
+from app.services.gpu.telemetry import GPUTelemetry, gpu_telemetry
+from config.comfy_config import comfy_config
+from config.ollama_config import OLLAMA_CONFIG
+from services.ollama_connection import OllamaConnection, ollama_connection
+
+# Настройка логирования
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+MB = 1024 * 1024
+
+class GPUStage(Enum):
+    TEXT = "text"    # генерация текста в Ollama
+    IMAGE = "image"  # генерация иллюстрации в ComfyUI
+
+@dataclass
+class ResidencyDecision:
+    stage: str
+    action: str                         # keep / evict_ollama / evict_comfyui / unknown
+    free_mb: Optional[float] = None     # свободно до решения
+    need_mb: float = 0                  # сколько нужно следующему этапу
+    free_after_mb: Optional[float] = None
+    fits: bool = True
+    evicted: List[str] = field(default_factory=list)
+    vram_source: str = "comfyui"        # comfyui (/system_stats) / telemetry
+
+class GPUResidencyScheduler:
+    """Решает, какую модель держать в VRAM между этапами.
+    
+    Перед этапом читает свободную память (ComfyUI /system_stats) и
+    загруженные модели Ollama (/api/ps). Чужую модель выгружает только
+    если следующая не поместится в бюджет, иначе обе остаются в памяти.
+    
+    Видеокарта одна на все воркеры uvicorn, поэтому решение принимается
+    под межпроцессной блокировкой, а признак загруженной модели ComfyUI
+    хранится в общем реестре воркеров.
+    """
+    
+    def __init__(self,
+                 comfy_url: Optional[str] = None,
+                 ollama: Optional[OllamaConnection] = None,
+                 text_model_mb: Optional[float] = None,
+                 image_model_mb: Optional[float] = None,
+                 reserve_mb: Optional[float] = None,
+                 registry: Optional[WorkerRegistry] = None,
+                 telemetry: Optional[GPUTelemetry] = None):
+        self.comfy_url = comfy_url or comfy_config.base_url
+        self.ollama = ollama or ollama_connection
+        self.text_model_mb = text_model_mb if text_model_mb is not None else float(os.getenv('GPU_TEXT_MODEL_MB', '6000'))
+        self.image_model_mb = image_model_mb if image_model_mb is not None else float(os.getenv('GPU_IMAGE_MODEL_MB', '3000'))
+        self.reserve_mb = reserve_mb if reserve_mb is not None else float(os.getenv('GPU_RESERVE_MB', '512'))
+        self.registry = registry or worker_registry
+        self.telemetry = telemetry or gpu_telemetry
+        
+        # ComfyUI не сообщает о загруженных моделях, поэтому помним сами (копия флага из реестра)
+        self.comfy_resident = False
+        self._lock: Optional[asyncio.Lock] = None
+        self.decisions = deque(maxlen=20)
+        self.stats = {
+            "decisions": 0,
+            "kept_resident": 0,
+            "evicted_ollama": 0,
+            "evicted_comfyui": 0,
+            "unknown_budget": 0,
+            "probe_errors": 0,
+        }
+    
+    def _get_lock(self) -> asyncio.Lock:
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        return self._lock
+    
+    async def read_comfy_vram(self) -> Optional[Dict[str, float]]:
+        """Свободная и общая память GPU по данным ComfyUI, в МБ"""
+        try:
+            async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=5)) as session:
+                async with session.get(f"{self.comfy_url}/system_stats") as response:
+                    if response.status != 200:
+                        return None
+                    stats = await response.json()
+        except (aiohttp.ClientError, asyncio.TimeoutError, OSError):
+            # ComfyUI не запущен - значит и его моделей в памяти нет
+            return None
+        devices = stats.get('devices') or []
+        if not devices:
+            return None
+        device = devices[0]
+        return {
+            "free_mb": device.get('vram_free', 0) / MB,
+            "total_mb": device.get('vram_total', 0) / MB,
+        }
+    
+    async def read_ollama_models(self) -> Dict[str, float]:
+        """Модели Ollama в видеопамяти: имя -> МБ"""
+        try:
+            async with self.ollama.request("get", "/api/ps") as response:
+                if response.status != 200:
+                    return {}
+                data = await response.json()
+        except Exception as e:
+            self.stats["probe_errors"] += 1
+            logger.warning(f"Не удалось получить список моделей Ollama: {e}")
+            return {}
+        return {
+            model.get('name', ''): model.get('size_vram', 0) / MB
+            for model in data.get('models', [])
+            if model.get('size_vram', 0) > 0
+        }
+    
+    @tracer.traced("ollama.unload")
+    async def _unload_ollama(self, models: List[str]) -> List[str]:
+        """Выгружает модели Ollama через keep_alive: 0"""
+        unloaded = []
+        for model in models:
+            try:
+                async with self.ollama.request(
+                    "post",
+                    "/api/generate",
+                    json={"model": model, "prompt": "", "keep_alive": 0}
+                ) as response:
+                    if response.status == 200:
+                        unloaded.append(model)
+                        model_unloads.inc(backend="ollama")
+                        logger.info(f"Модель {model} выгружена из GPU")
+            except Exception as e:
+                logger.warning(f"Ошибка при выгрузке модели {model}: {e}")
+        return unloaded
+    
+    @tracer.traced("comfyui.free")
+    async def _free_comfyui(self) -> bool:
+        """Выгружает модели ComfyUI, не трогая очередь задач"""
+        try:
+            async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=30)) as session:
+                async with session.post(
+                    f"{self.comfy_url}/free",
+                    json={"unload_models": True, "free_memory": True}
+                ) as response:
+                    if response.status == 200:
+                        model_unloads.inc(backend="comfyui")
+                        logger.info("Модели ComfyUI выгружены из GPU")
+                        return True
+        except (aiohttp.ClientError, asyncio.TimeoutError, OSError) as e:
+            logger.warning(f"Ошибка при выгрузке моделей ComfyUI: {e}")
+        return False
+    
+    async def _set_comfy_resident(self, value: bool) -> None:
+        self.comfy_resident = value
+        await self.registry.set_flag("comfy_resident", "1" if value else "0")
+    
+    async def read_image_vram(self, since: Optional[float] = None) -> Optional[Dict[str, float]]:
+        """Память перед иллюстрацией: свежая телеметрия GPU, иначе /system_stats.
+        
+        since - после выгрузки ждем отсчет телеметрии, снятый уже после нее.
+        """
+        vram = self.telemetry.vram() if since is None else await self.telemetry.wait_vram(since)
+        if vram is not None:
+            return {**vram, "source": "telemetry"}
+        return await self.read_comfy_vram()
+    
+    @tracer.traced("gpu.prepare")
+    async def prepare(self, stage: GPUStage) -> ResidencyDecision:
+        """Освобождает память под этап, только если он иначе не поместится"""
+        # Окно этапа для телеметрии: по нему видно, во что обошлась выгрузка модели
+        with self.telemetry.stage(f"prepare.{stage.value}") as window:
+            decision = await self._decide(stage)
+            window.name = f"prepare.{stage.value}.{decision.action}"
+        return decision
+    
+    async def _decide(self, stage: GPUStage) -> ResidencyDecision:
+        # Сначала очередь внутри процесса, затем блокировка между воркерами
+        async with self._get_lock(), self.registry.lock("gpu"):
+            self.comfy_resident = await self.registry.get_flag("comfy_resident") == "1"
+            # ComfyUI сообщает память раз в запрос; телеметрия - каждую секунду и не будит ComfyUI
+            vram = await (self.read_image_vram() if stage == GPUStage.IMAGE else self.read_comfy_vram())
+            ollama_models = await self.read_ollama_models()
+            
+            if stage == GPUStage.TEXT:
+                # Модель уже в памяти - место под неё не нужно
+                need_mb = 0 if OLLAMA_CONFIG['model'] in ollama_models else self.text_model_mb
+            else:
+                need_mb = 0 if self.comfy_resident and vram is not None else self.image_model_mb
+            
+            decision = ResidencyDecision(stage=stage.value, action="keep", need_mb=need_mb)
+            
+            if vram is None:
+                if stage == GPUStage.TEXT:
+                    # ComfyUI не отвечает - вытеснять нечего, Ollama разберется сама
+                    await self._set_comfy_resident(False)
+                else:
+                    # Бюджет неизвестен - ведем себя как раньше и освобождаем память
+                    decision.action = "unknown"
+                    decision.evicted = await self._unload_ollama(list(ollama_models))
+                    self.stats["unknown_budget"] += 1
+                return self._record(decision)
+            
+            decision.free_mb = vram["free_mb"]
+            decision.free_after_mb = vram["free_mb"]
+            decision.vram_source = vram.get("source", "comfyui")
+            if need_mb == 0 or vram["free_mb"] - need_mb >= self.reserve_mb:
+                return self._record(decision)
+            
+            if stage == GPUStage.TEXT:
+                if await self._free_comfyui():
+                    decision.action = "evict_comfyui"
+                    decision.evicted = ["comfyui"]
+                    await self._set_comfy_resident(False)
+            elif ollama_models:
+                decision.evicted = await self._unload_ollama(list(ollama_models))
+                evicted_at = time.time()
+                if decision.evicted:
+                    decision.action = "evict_ollama"
+            
+            if decision.evicted:
+                after = await (self.read_image_vram(since=evicted_at) if stage == GPUStage.IMAGE else self.read_comfy_vram())
+                if after is not None:
+                    decision.free_after_mb = after["free_mb"]
+            decision.fits = decision.free_after_mb - need_mb >= self.reserve_mb
+            return self._record(decision)
+    
+    async def mark_loaded(self, stage: GPUStage) -> None:
+        """Отмечает, что этап загрузил свою модель в видеопамять"""
+        if stage == GPUStage.IMAGE:
+            await self._set_comfy_resident(True)
+    
+    def _record(self, decision: ResidencyDecision) -> ResidencyDecision:
+        self.stats["decisions"] += 1
+        if decision.action == "keep":
+            self.stats["kept_resident"] += 1
+        elif decision.action == "evict_ollama":
+            self.stats["evicted_ollama"] += 1
+        elif decision.action == "evict_comfyui":
+            self.stats["evicted_comfyui"] += 1
+        if decision.need_mb > 0 and decision.fits:
+            # Модели этапа нет в памяти - этап загрузит ее
+            model_loads.inc(backend="ollama" if decision.stage == GPUStage.TEXT.value else "comfyui")
+        self.decisions.append(asdict(decision))
+        tracer.annotate(stage=decision.stage, action=decision.action, need_mb=decision.need_mb,
+                        free_mb=decision.free_mb, evicted=",".join(decision.evicted))
+        free = f"{decision.free_mb:.0f}" if decision.free_mb is not None else "?"
+        logger.info(f"GPU [{decision.stage}]: {decision.action}, свободно {free} МБ, нужно {decision.need_mb:.0f} МБ")
+        return decision
+    
+    def get_stats(self) -> Dict:
+        """Возвращает счетчики и последние решения планировщика"""
+        return {
+            **self.stats,
+            "comfy_resident": self.comfy_resident,
+            "budget_mb": {
+                "text": self.text_model_mb,
+                "image": self.image_model_mb,
+                "reserve": self.reserve_mb,
+            },
+            "recent_decisions": list(self.decisions),
+        }
+
+# Создаем экземпляр планировщика
+gpu_scheduler = GPUResidencyScheduler()
@@ -0,0 +1,331 @@
+import asyncio
+import bisect
+import logging
+import os
+import shlex
+import time
+from array import array
+from collections import deque
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Optional
+
+# Настройка логирования
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+class TelemetrySample(NamedTuple):
+    timestamp: float
+    gpu_percent: float
+    vram_percent: float
+    vram_mb: float
+    sclk_ghz: float
+
+def parse_line(line: str) -> Optional[TelemetrySample]:
+    """Разбирает строку radeontop -d:
+    
+    1732769289.199306: bus 03, gpu 2.50%, ..., vram 53.68% 4361.34mb, ..., sclk 3.89% 0.068ghz
+    
+    Возвращает None для строк другого формата (заголовок, обрыв записи).
+    """
+    head, sep, body = line.partition(": ")
+    if not sep:
+        return None
+    try:
+        timestamp = float(head)
+    except ValueError:
+        return None
+    fields: Dict[str, List[str]] = {}
+    for field_text in body.split(", "):
+        parts = field_text.split()
+        if len(parts) >= 2:
+            fields[parts[0]] = parts[1:]
+    try:
+        gpu = float(fields["gpu"][0].rstrip("%"))
+        vram_percent = float(fields["vram"][0].rstrip("%"))
+        vram_mb = float(fields["vram"][1].rstrip("mb"))
+        sclk = fields.get("sclk")
+        sclk_ghz = float(sclk[1].rstrip("ghz")) if sclk and len(sclk) > 1 else 0.0
+    except (KeyError, IndexError, ValueError):
+        return None
+    return TelemetrySample(timestamp, gpu, vram_percent, vram_mb, sclk_ghz)
+
+class RingBuffer:
+    """Последние capacity отсчетов в массивах double, по массиву на поле"""
+    
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self._columns = [array("d", bytes(8 * capacity)) for _ in TelemetrySample._fields]
+        self._next = 0
+        self._size = 0
+    
+    def __len__(self) -> int:
+        return self._size
+    
+    def append(self, sample: TelemetrySample) -> None:
+        for column, value in zip(self._columns, sample):
+            column[self._next] = value
+        self._next = (self._next + 1) % self.capacity
+        self._size = min(self._size + 1, self.capacity)
+    
+    def column(self, index: int) -> array:
+        """Поле всех отсчетов от старых к новым"""
+        column = self._columns[index]
+        if self._size < self.capacity:
+            return column[:self._size]
+        return column[self._next:] + column[:self._next]
+    
+    def latest(self) -> Optional[TelemetrySample]:
+        if not self._size:
+            return None
+        index = (self._next - 1) % self.capacity
+        return TelemetrySample(*(column[index] for column in self._columns))
+    
+    def between(self, start: float, end: float) -> List[TelemetrySample]:
+        """Отсчеты с start <= timestamp <= end"""
+        times = self.column(0)
+        lo = bisect.bisect_left(times, start)
+        hi = bisect.bisect_right(times, end)
+        columns = [self.column(i)[lo:hi] for i in range(len(self._columns))]
+        return [TelemetrySample(*values) for values in zip(*columns)]
+    
+    def before(self, moment: float) -> Optional[TelemetrySample]:
+        """Последний отсчет не позже moment"""
+        times = self.column(0)
+        index = bisect.bisect_right(times, moment) - 1
+        if index < 0:
+            return None
+        return TelemetrySample(*(self.column(i)[index] for i in range(len(self._columns))))
+
+@dataclass
+class StageWindow:
+    """Интервал этапа конвейера в часах телеметрии (time.time)"""
+    name: str
+    start: float
+    end: Optional[float] = None
+
+class GPUTelemetry:
+    """Телеметрия GPU из вывода radeontop -d (файл или pipe).
+    
+    Отсчеты раз в секунду копятся в кольцевых буферах на
+    GPU_TELEMETRY_SECONDS секунд. Этапы конвейера отмечаются через
+    stage(); для каждого этапа считается VRAM до, на пике и после, то
+    есть во что обошлась загрузка или выгрузка модели.
+    
+    Источник - GPU_TELEMETRY_SOURCE: путь к файлу, который пишет
+    radeontop (читается с конца, как tail -f), или "cmd:radeontop -d - -i 1".
+    Без источника телеметрия выключена, и vram() возвращает None.
+    """
+    
+    def __init__(self,
+                 source: Optional[str] = None,
+                 capacity: Optional[int] = None,
+                 max_age: Optional[float] = None,
+                 max_stages: int = 200):
+        self.source = source if source is not None else os.getenv("GPU_TELEMETRY_SOURCE", "")
+        self.samples = RingBuffer(capacity or int(os.getenv("GPU_TELEMETRY_SECONDS", "3600")))
+        self.max_age = max_age if max_age is not None else float(os.getenv("GPU_TELEMETRY_MAX_AGE", "3"))
+        self.stages: deque = deque(maxlen=max_stages)
+        self._task: Optional[asyncio.Task] = None
+        self._process: Optional[asyncio.subprocess.Process] = None
+        self._sample_event: Optional[asyncio.Event] = None
+        self.stats = {
+            "samples": 0,
+            "parse_errors": 0,
+            "stale_reads": 0,
+            "restarts": 0,
+        }
+    
+    def feed(self, line: str) -> Optional[TelemetrySample]:
+        """Добавляет строку radeontop; строки не по формату считаются и пропускаются"""
+        if not line.strip():
+            return None
+        sample = parse_line(line)
+        if sample is None:
+            self.stats["parse_errors"] += 1
+            return None
+        latest = self.samples.latest()
+        if latest is not None and sample.timestamp <= latest.timestamp:
+            # Буфер упорядочен по времени: повтор или откат часов пропускаем
+            return None
+        self.samples.append(sample)
+        self.stats["samples"] += 1
+        if self._sample_event is not None:
+            self._sample_event.set()
+        return sample
+    
+    def feed_lines(self, lines: Iterable[str]) -> int:
+        return sum(1 for line in lines if self.feed(line) is not None)
+    
+    def load_file(self, path: str) -> int:
+        """Читает сохраненный лог целиком (для разбора после запуска)"""
+        with open(path, encoding="utf-8", errors="replace") as f:
+            return self.feed_lines(f)
+    
+    def start(self) -> None:
+        """Запускает чтение источника, если он задан"""
+        if not self.source or (self._task is not None and not self._task.done()):
+            return
+        self._sample_event = asyncio.Event()
+        self._task = asyncio.ensure_future(self._run())
+    
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except (asyncio.CancelledError, Exception):
+                pass
+            self._task = None
+        if self._process is not None and self._process.returncode is None:
+            self._process.kill()
+            await self._process.wait()
+        self._process = None
+    
+    async def _run(self) -> None:
+        while True:
+            try:
+                if self.source.startswith("cmd:"):
+                    await self._read_command(self.source[len("cmd:"):])
+                else:
+                    await self._follow_file(self.source)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"[TELEMETRY] Источник телеметрии недоступен ({self.source}): {e}")
+            self.stats["restarts"] += 1
+            await asyncio.sleep(5)
+    
+    async def _read_command(self, command: str) -> None:
+        """Читает stdout radeontop построчно"""
+        self._process = await asyncio.create_subprocess_exec(
+            *shlex.split(command), stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL
+        )
+        logger.info(f"[TELEMETRY] Запущен {command} (pid {self._process.pid})")
+        async for raw in self._process.stdout:
+            self.feed(raw.decode("utf-8", errors="replace"))
+        await self._process.wait()
+    
+    async def _follow_file(self, path: str, poll: float = 0.5) -> None:
+        """Дочитывает новые строки файла, как tail -f; начинает с конца файла"""
+        with open(path, encoding="utf-8", errors="replace") as f:
+            f.seek(0, os.SEEK_END)
+            logger.info(f"[TELEMETRY] Читаем телеметрию GPU из {path}")
+            partial = ""
+            while True:
+                chunk = f.readline()
+                if not chunk:
+                    if os.path.getsize(path) < f.tell():
+                        # Файл перезаписан заново
+                        f.seek(0)
+                    await asyncio.sleep(poll)
+                    continue
+                partial += chunk
+                if partial.endswith("\n"):
+                    self.feed(partial)
+                    partial = ""
+    
+    def vram(self, since: Optional[float] = None) -> Optional[Dict[str, float]]:
+        """Свободная и общая VRAM по последнему отсчету, в МБ.
+        
+        None, если отсчетов нет, последний старше max_age секунд или
+        получен раньше since.
+        """
+        latest = self.samples.latest()
+        if latest is None:
+            return None
+        if time.time() - latest.timestamp > self.max_age or (since is not None and latest.timestamp < since):
+            self.stats["stale_reads"] += 1
+            return None
+        if latest.vram_percent <= 0:
+            return None
+        total_mb = latest.vram_mb * 100 / latest.vram_percent
+        return {"free_mb": total_mb - latest.vram_mb, "total_mb": total_mb}
+    
+    async def wait_vram(self, since: float, timeout: float = 2.0) -> Optional[Dict[str, float]]:
+        """VRAM по первому отсчету не раньше since (после выгрузки модели)"""
+        deadline = time.monotonic() + timeout
+        while True:
+            vram = self.vram(since)
+            if vram is not None or self._sample_event is None:
+                return vram
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            self._sample_event.clear()
+            try:
+                await asyncio.wait_for(self._sample_event.wait(), timeout=remaining)
+            except asyncio.TimeoutError:
+                return None
+    
+    @contextmanager
+    def stage(self, name: str) -> Iterator[StageWindow]:
+        """Отмечает этап; имя можно уточнить внутри блока (window.name)"""
+        window = StageWindow(name, time.time())
+        try:
+            yield window
+        finally:
+            window.end = time.time()
+            self.stages.append(window)
+    
+    def profile(self, window: StageWindow) -> Optional[Dict]:
+        """VRAM до, во время и после этапа; None, пока нет отсчета после его конца"""
+        end = window.end if window.end is not None else time.time()
+        inside = self.samples.between(window.start, end)
+        before = self.samples.before(window.start)
+        after = self.samples.between(end, end + self.max_age)
+        if before is None and not inside:
+            return None
+        if not after and window.end is not None:
+            return None
+        first = before or inside[0]
+        last = after[0] if after else inside[-1]
+        points = [first] + inside + [last]
+        return {
+            "name": window.name,
+            "start": window.start,
+            "seconds": round(end - window.start, 3),
+            "vram_start_mb": first.vram_mb,
+            "vram_end_mb": last.vram_mb,
+            "vram_peak_mb": max(sample.vram_mb for sample in points),
+            "vram_delta_mb": round(last.vram_mb - first.vram_mb, 2),
+            "gpu_avg_percent": round(sum(sample.gpu_percent for sample in points) / len(points), 2),
+            "samples": len(inside),
+        }
+    
+    def series(self, window: StageWindow) -> List[TelemetrySample]:
+        """VRAM и загрузка GPU по секундам за время этапа"""
+        return self.samples.between(window.start, window.end if window.end is not None else time.time())
+    
+    def stage_summary(self) -> Dict[str, Dict[str, float]]:
+        """Средние по именам этапов: длительность, изменение VRAM, пик, загрузка GPU"""
+        summary: Dict[str, Dict[str, float]] = {}
+        for window in self.stages:
+            profile = self.profile(window)
+            if profile is None:
+                continue
+            entry = summary.setdefault(window.name, {
+                "count": 0, "seconds": 0.0, "vram_delta_mb": 0.0, "vram_peak_mb": 0.0, "gpu_avg_percent": 0.0,
+            })
+            entry["count"] += 1
+            entry["seconds"] += profile["seconds"]
+            entry["vram_delta_mb"] += profile["vram_delta_mb"]
+            entry["gpu_avg_percent"] += profile["gpu_avg_percent"]
+            entry["vram_peak_mb"] = max(entry["vram_peak_mb"], profile["vram_peak_mb"])
+        for entry in summary.values():
+            for key in ("seconds", "vram_delta_mb", "gpu_avg_percent"):
+                entry[key] = round(entry[key] / entry["count"], 3)
+        return summary
+    
+    def get_stats(self) -> Dict:
+        latest = self.samples.latest()
+        return {
+            **self.stats,
+            "enabled": bool(self.source),
+            "buffered": len(self.samples),
+            "latest": latest._asdict() if latest else {},
+            "stages": self.stage_summary(),
+        }
+
+# Создаем экземпляр телеметрии GPU
+gpu_telemetry = GPUTelemetry()
@@ -1,3 +1,5 @@
 from .image_service import image_service, GenerationResult, GenerationStatus
+from .image_store import image_store, StoredImage
+from .illustration_cache import illustration_cache
 
-__all__ = ['image_service', 'GenerationResult', 'GenerationStatus']
+__all__ = ['image_service', 'GenerationResult', 'GenerationStatus', 'image_store', 'StoredImage', 'illustration_cache']
@@ -0,0 +1,194 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional, Set, Tuple
+from app.services.image_generation.image_store import ImageStore, StoredImage, image_store
+
+# Настройка логирования
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+def workflow_key(workflow: Dict) -> str:
+    """sha256 канонического JSON workflow: промпт, сид, размер, модель и все остальное"""
+    canonical = json.dumps(workflow, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+class IllustrationCache:
+    """Кэш готовых иллюстраций по хешу итогового workflow.
+    
+    Один и тот же workflow (тот же промпт, сид и настройки) ComfyUI
+    рендерит в ту же картинку, поэтому при попадании ComfyUI не
+    запускается вовсе. Сами картинки лежат в хранилище изображений, кэш -
+    только индекс "ключ workflow -> digest", по маленькому файлу на
+    запись. Суммарный размер картинок, на которые ссылается индекс,
+    ограничен max_bytes: вытесняются давно не использованные записи, а
+    их картинки удаляет сборка мусора хранилища, если на них не ссылается
+    ни одна сессия. Порядок использования переживает перезапуск через
+    mtime файлов индекса.
+    """
+    
+    def __init__(self,
+                 root: Optional[str] = None,
+                 max_bytes: Optional[int] = None,
+                 store: Optional[ImageStore] = None):
+        self.root = root or os.getenv("ILLUSTRATION_CACHE_PATH", os.path.join("data", "illustration_cache"))
+        self.max_bytes = max_bytes if max_bytes is not None else int(os.getenv("ILLUSTRATION_CACHE_MAX_MB", "512")) * 1024 * 1024
+        self.store = store or image_store
+        # ключ -> (digest, размер картинки), от давно использованных к недавним
+        self._index: Optional["OrderedDict[str, Tuple[str, int]]"] = None
+        self._size = 0
+        self._lock = threading.Lock()
+        self.stats = {
+            "hits": 0,
+            "misses": 0,
+            "writes": 0,
+            "evictions": 0,
+            "bytes_evicted": 0,
+        }
+    
+    def _path(self, key: str) -> str:
+        return os.path.join(self.root, key[:2], f"{key}.json")
+    
+    def _read_entry(self, path: str) -> Optional[Tuple[str, int]]:
+        try:
+            with open(path, encoding="utf-8") as f:
+                entry = json.load(f)
+            return entry["digest"], int(entry["size"])
+        except (FileNotFoundError, ValueError, KeyError, TypeError):
+            return None
+    
+    def _entries(self) -> List[Tuple[float, str, Tuple[str, int]]]:
+        """Записи индекса на диске (в том числе других воркеров) как (mtime, ключ, запись)"""
+        entries = []
+        if os.path.isdir(self.root):
+            for directory, _, files in os.walk(self.root):
+                for name in files:
+                    if not name.endswith(".json"):
+                        continue
+                    path = os.path.join(directory, name)
+                    try:
+                        mtime = os.stat(path).st_mtime
+                    except FileNotFoundError:
+                        continue
+                    entry = self._read_entry(path)
+                    if entry is not None:
+                        entries.append((mtime, name[:-5], entry))
+        return entries
+    
+    def _load_index(self) -> "OrderedDict[str, Tuple[str, int]]":
+        """Читает индекс при первом обращении, порядок LRU - по mtime"""
+        if self._index is None:
+            entries = sorted(self._entries())
+            self._index = OrderedDict((key, entry) for _, key, entry in entries)
+            self._size = sum(size for _, size in self._index.values())
+        return self._index
+    
+    def _drop(self, key: str) -> None:
+        entry = self._index.pop(key, None)
+        if entry is not None:
+            self._size -= entry[1]
+        try:
+            os.unlink(self._path(key))
+        except FileNotFoundError:
+            pass
+    
+    def _get(self, key: str) -> Optional[StoredImage]:
+        with self._lock:
+            index = self._load_index()
+            path = self._path(key)
+            entry = self._read_entry(path)
+            if entry is None:
+                # Запись вытеснена (возможно, другим воркером)
+                if key in index:
+                    self._size -= index.pop(key)[1]
+                return None
+            image = self.store.stored(entry[0])
+            if image is None:
+                # Картинку уже удалила сборка мусора хранилища
+                self._drop(key)
+                return None
+            if key not in index:
+                # Записал другой воркер
+                index[key] = entry
+                self._size += entry[1]
+            index.move_to_end(key)
+            try:
+                os.utime(path)
+            except OSError:
+                pass
+            return image
+    
+    def _put(self, key: str, image: StoredImage) -> None:
+        with self._lock:
+            index = self._load_index()
+            path = self._path(key)
+            directory = os.path.dirname(path)
+            os.makedirs(directory, exist_ok=True)
+            # Пишем во временный файл и переименовываем: читатель не увидит половину записи
+            fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+            try:
+                with os.fdopen(fd, "w", encoding="utf-8") as f:
+                    json.dump({"digest": image.digest, "size": image.size}, f)
+                os.replace(tmp_path, path)
+            except BaseException:
+                if os.path.exists(tmp_path):
+                    os.unlink(tmp_path)
+                raise
+            previous = index.pop(key, None)
+            self._size += image.size - (previous[1] if previous else 0)
+            index[key] = (image.digest, image.size)
+            self.stats["writes"] += 1
+            self._evict()
+    
+    def _evict(self) -> None:
+        """Удаляет давно не использованные записи, пока картинки кэша больше max_bytes"""
+        index = self._index
+        while self._size > self.max_bytes and len(index) > 1:
+            key, (_, size) = next(iter(index.items()))
+            self._drop(key)
+            self.stats["evictions"] += 1
+            self.stats["bytes_evicted"] += size
+    
+    async def get(self, workflow: Dict) -> Optional[StoredImage]:
+        """Готовая картинка из хранилища для workflow или None"""
+        key = workflow_key(workflow)
+        loop = asyncio.get_event_loop()
+        image = await loop.run_in_executor(None, self._get, key)
+        if image is None:
+            self.stats["misses"] += 1
+        else:
+            self.stats["hits"] += 1
+            logger.info(f"[CACHE] Иллюстрация взята из кэша ({key[:12]})")
+        return image
+    
+    async def put(self, workflow: Dict, image: StoredImage) -> None:
+        """Запоминает картинку из хранилища, отрендеренную по workflow"""
+        key = workflow_key(workflow)
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, self._put, key, image)
+    
+    async def digests(self) -> Set[str]:
+        """Картинки, на которые ссылаются записи кэша всех воркеров"""
+        loop = asyncio.get_event_loop()
+        entries = await loop.run_in_executor(None, self._entries)
+        return {digest for _, _, (digest, _) in entries}
+    
+    def get_stats(self) -> Dict:
+        """Возвращает счетчики попаданий и размер кэша"""
+        lookups = self.stats["hits"] + self.stats["misses"]
+        return {
+            **self.stats,
+            "hit_ratio": self.stats["hits"] / lookups if lookups else 0.0,
+            "entries": len(self._index) if self._index is not None else None,
+            "size_bytes": self._size,
+            "max_bytes": self.max_bytes,
+            "root": self.root,
+        }
+
+# Создаем экземпляр кэша иллюстраций
+illustration_cache = IllustrationCache()
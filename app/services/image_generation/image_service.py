@@ -1,12 +1,15 @@
 import aiohttp
 import json
-import asyncio
 import logging
 import os
-import base64
 from typing import Dict, Optional, Tuple
 from dataclasses import dataclass
 from enum import Enum
+from app.core.tracing import tracer
+from app.services.comfy.supervisor import comfy_supervisor
+from app.services.comfy.events import comfy_events, ComfyUIExecutionError
+from app.services.gpu import gpu_scheduler, GPUStage
+from app.services.image_generation.image_store import image_store, StoredImage
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO)
@@ -33,35 +36,21 @@ class GenerationStatus(Enum):
 @dataclass
 class GenerationResult:
     status: GenerationStatus
-    image_data: Optional[str] = None
+    image: Optional[StoredImage] = None
     error_message: Optional[str] = None
 
 class ImageGenerationService:
     def __init__(self):
         self.base_url = os.getenv("COMFYUI_API_URL", "http://127.0.0.1:8188")
         self.base_prompt = os.getenv("COMFYUI_BASE_PROMPT", "anime style, high quality illustration")
-        self.min_memory_gb = float(os.getenv("COMFYUI_MIN_MEMORY_GB", "2.0"))
         
     async def check_system_resources(self, session: aiohttp.ClientSession) -> Tuple[bool, str]:
-        """Проверяет доступность системных ресурсов"""
+        """Проверяет, хватит ли видеопамяти, при необходимости выгружая модель Ollama"""
         try:
-            async with session.get(f"{self.base_url}/system_stats") as response:
-                if response.status != 200:
-                    return False, "Не удалось получить информацию о системе"
-                
-                stats = await response.json()
-                if 'system' in stats and 'memory' in stats['system']:
-                    memory_info = stats['system']['memory']
-                    free_memory = memory_info.get('free', 0)
-                    total_memory = memory_info.get('total', 0)
-                    
-                    free_memory_gb = free_memory / (1024 * 1024 * 1024)
-                    if free_memory_gb < self.min_memory_gb:
-                        return False, f"Недостаточно памяти GPU: {free_memory_gb:.2f}GB < {self.min_memory_gb}GB"
-                    
-                    return True, ""
-                
-                return False, "Не удалось получить информацию о памяти"
+            decision = await gpu_scheduler.prepare(GPUStage.IMAGE)
+            if not decision.fits:
+                return False, f"Недостаточно памяти GPU: {decision.free_after_mb:.0f}MB < {decision.need_mb:.0f}MB"
+            return True, ""
         except Exception as e:
             return False, f"Ошибка проверки ресурсов: {str(e)}"
 
@@ -81,49 +70,49 @@ class ImageGenerationService:
         self, 
         prompt_id: str, 
         session: aiohttp.ClientSession,
-        timeout: int = 300,
-        check_interval: int = 1
+        timeout: int = 300
     ) -> str:
         """Ожидает завершения генерации изображения"""
-        start_time = asyncio.get_event_loop().time()
+        try:
+            # Завершение приходит событием общего WebSocket, /history - только запасной путь
+            outputs = await comfy_events.wait_for_prompt(prompt_id, session, timeout=timeout)
+        except ComfyUIExecutionError as e:
+            raise APIError(f"Ошибка выполнения workflow: {str(e)}")
+        except aiohttp.ClientError as e:
+            raise APIError(f"Ошибка сети при проверке статуса: {str(e)}")
         
-        while True:
-            if asyncio.get_event_loop().time() - start_time > timeout:
-                raise TimeoutError("Превышено время ожидания генерации")
-                
-            try:
-                async with session.get(f"{self.base_url}/history/{prompt_id}") as response:
-                    if response.status != 200:
-                        raise APIError(f"Ошибка получения статуса: {response.status}")
-                        
-                    history = await response.json()
-                    if prompt_id in history:
-                        outputs = history[prompt_id].get('outputs', {})
-                        if outputs and '9' in outputs:
-                            image_data = outputs['9']
-                            if image_data and 'images' in image_data:
-                                return image_data['images'][0]['filename']
-                                
-            except aiohttp.ClientError as e:
-                raise APIError(f"Ошибка сети при проверке статуса: {str(e)}")
-                
-            await asyncio.sleep(check_interval)
+        image_data = outputs.get('9')
+        if image_data and 'images' in image_data:
+            return image_data['images'][0]['filename']
+        raise APIError(f"ComfyUI не вернул изображение для задачи {prompt_id}")
 
-    async def get_image_data(self, image_path: str, session: aiohttp.ClientSession) -> str:
-        """Получает данные изображения в формате base64"""
+    async def get_image_data(self, image_path: str, session: aiohttp.ClientSession) -> StoredImage:
+        """Забирает изображение у ComfyUI и кладет его в хранилище"""
         try:
             image_url = f"{self.base_url}/view?filename={image_path}"
             async with session.get(image_url) as response:
                 if response.status != 200:
                     raise APIError(f"Ошибка получения изображения: {response.status}")
                     
-                img_data = await response.read()
-                return f"data:image/png;base64,{base64.b64encode(img_data).decode('utf-8')}"
+                return await image_store.save(await response.read())
         except Exception as e:
             raise APIError(f"Ошибка при получении данных изображения: {str(e)}")
 
+    @tracer.traced("comfyui.generate_image")
     async def generate_image(self, prompt: str, session: Optional[aiohttp.ClientSession] = None) -> GenerationResult:
         """Основной метод генерации изображения"""
+        try:
+            # ComfyUI остается прогретым между вызовами, супервизор лишь считает пользователей
+            async with comfy_supervisor.acquire():
+                return await self._generate(prompt, session)
+        except Exception as e:
+            return GenerationResult(
+                status=GenerationStatus.FAILED,
+                error_message=f"ComfyUI недоступен: {str(e)}"
+            )
+
+    async def _generate(self, prompt: str, session: Optional[aiohttp.ClientSession]) -> GenerationResult:
+        """Генерирует изображение на уже запущенном ComfyUI"""
         own_session = session is None
         if own_session:
             session = aiohttp.ClientSession()
@@ -139,9 +128,10 @@ class ImageGenerationService:
 
             # Подготавливаем и отправляем workflow
             workflow = await self.prepare_workflow(prompt, session)
+            await comfy_events.ensure_connected()
             async with session.post(
                 f"{self.base_url}/prompt",
-                json={"prompt": workflow}
+                json={"prompt": workflow, "client_id": comfy_events.client_id}
             ) as response:
                 if response.status != 200:
                     return GenerationResult(
@@ -154,11 +144,12 @@ class ImageGenerationService:
             # Ожидаем результат
             try:
                 image_path = await self.wait_for_generation(prompt_id, session)
-                image_data = await self.get_image_data(image_path, session)
+                await gpu_scheduler.mark_loaded(GPUStage.IMAGE)
+                image = await self.get_image_data(image_path, session)
                 
                 return GenerationResult(
                     status=GenerationStatus.COMPLETED,
-                    image_data=image_data
+                    image=image
                 )
                 
             except TimeoutError as e:
@@ -0,0 +1,131 @@
+import asyncio
+import hashlib
+import logging
+import os
+import re
+import tempfile
+import time
+from dataclasses import dataclass
+from typing import Dict, Iterable, Optional
+
+# Настройка логирования
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+DIGEST_RE = re.compile(r'^[0-9a-f]{64}$')
+
+@dataclass
+class StoredImage:
+    digest: str
+    size: int
+    url: str
+    content_type: str = "image/png"
+
+class ImageStore:
+    """Хранилище иллюстраций, адресуемых по sha256 содержимого.
+    
+    Файл с одним и тем же содержимым пишется один раз, поэтому URL
+    никогда не меняет смысл и может кэшироваться браузером навсегда.
+    """
+    
+    def __init__(self, root: Optional[str] = None, url_prefix: str = "/images"):
+        self.root = root or os.getenv("IMAGE_STORE_PATH", os.path.join("data", "images"))
+        self.url_prefix = url_prefix
+        self.stats = {
+            "saved": 0,
+            "deduplicated": 0,
+            "bytes_written": 0,
+            "collected": 0,
+            "bytes_collected": 0,
+        }
+    
+    def path_for(self, digest: str) -> Optional[str]:
+        """Путь к файлу по digest; None для некорректного digest"""
+        if not DIGEST_RE.match(digest):
+            return None
+        # Раскладываем по подкаталогам, чтобы не держать тысячи файлов в одном
+        return os.path.join(self.root, digest[:2], f"{digest}.png")
+    
+    def url_for(self, digest: str) -> str:
+        return f"{self.url_prefix}/{digest}.png"
+    
+    def stored(self, digest: str) -> Optional[StoredImage]:
+        """Уже сохраненное изображение по digest; None, если файла нет"""
+        path = self.path_for(digest)
+        if path is None:
+            return None
+        try:
+            size = os.path.getsize(path)
+        except FileNotFoundError:
+            return None
+        return StoredImage(digest=digest, size=size, url=self.url_for(digest))
+    
+    def _write(self, data: bytes) -> StoredImage:
+        """Считает digest и атомарно пишет файл (выполняется в пуле потоков)"""
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.path_for(digest)
+        if os.path.exists(path):
+            self.stats["deduplicated"] += 1
+        else:
+            directory = os.path.dirname(path)
+            os.makedirs(directory, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    f.write(data)
+                os.replace(tmp_path, path)
+            except BaseException:
+                if os.path.exists(tmp_path):
+                    os.unlink(tmp_path)
+                raise
+            self.stats["saved"] += 1
+            self.stats["bytes_written"] += len(data)
+        return StoredImage(digest=digest, size=len(data), url=self.url_for(digest))
+    
+    async def save(self, data: bytes) -> StoredImage:
+        """Сохраняет изображение, не блокируя event loop хешированием и записью"""
+        loop = asyncio.get_event_loop()
+        image = await loop.run_in_executor(None, self._write, data)
+        logger.info(f"Изображение сохранено: {image.url} ({image.size} байт)")
+        return image
+    
+    def _collect(self, keep: Iterable[str], min_age: float) -> int:
+        """Удаляет файлы, digest которых не в keep (выполняется в пуле потоков)"""
+        keep = set(keep)
+        cutoff = time.time() - min_age
+        removed = 0
+        if not os.path.isdir(self.root):
+            return 0
+        for directory, _, files in os.walk(self.root):
+            for name in files:
+                digest = name[:-len(".png")]
+                if not name.endswith(".png") or not DIGEST_RE.match(digest) or digest in keep:
+                    continue
+                path = os.path.join(directory, name)
+                try:
+                    st = os.stat(path)
+                    # Свежий файл может быть еще не записан в сессию или кэш
+                    if st.st_mtime > cutoff:
+                        continue
+                    os.unlink(path)
+                except FileNotFoundError:
+                    continue
+                removed += 1
+                self.stats["collected"] += 1
+                self.stats["bytes_collected"] += st.st_size
+        return removed
+    
+    async def collect(self, keep: Iterable[str], min_age: float = 3600) -> int:
+        """Удаляет изображения, на которые никто не ссылается, и возвращает их число"""
+        loop = asyncio.get_event_loop()
+        removed = await loop.run_in_executor(None, self._collect, keep, min_age)
+        if removed:
+            logger.info(f"Удалено изображений без ссылок: {removed}")
+        return removed
+    
+    def get_stats(self) -> Dict:
+        """Возвращает счетчики хранилища"""
+        return {**self.stats, "root": self.root}
+
+# Создаем экземпляр хранилища
+image_store = ImageStore()
@@ -0,0 +1,89 @@
+import logging
+from typing import Dict, List, Optional, Tuple
+from config.ollama_config import OLLAMA_CONFIG
+from services.prompt_budget import estimate_tokens
+
+# Настройка логирования
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+class ConversationStats:
+    """Общие метрики переиспользования контекста по всем сессиям"""
+    
+    def __init__(self):
+        self.stats = {
+            "full_prompts": 0,
+            "continuations": 0,
+            "fallbacks_overflow": 0,
+            "fallbacks_error": 0,
+            "prompt_eval_tokens": 0,
+            "prefill_tokens_saved": 0,
+        }
+    
+    def get_stats(self) -> Dict:
+        return dict(self.stats)
+
+class ConversationState:
+    """Состояние диалога одной сессии с Ollama.
+    
+    Хранит массив context из последнего ответа /api/generate. Следующий
+    сегмент отправляется с этим context и коротким промптом только с новым
+    выбором, и Ollama не разбирает заново системный промпт и всю историю.
+    Если context не помещается в окно или запрос с ним не удался,
+    сегмент генерируется по полному промпту, как раньше.
+    """
+    
+    def __init__(self,
+                 num_ctx: Optional[int] = None,
+                 reserve_tokens: Optional[int] = None,
+                 enabled: Optional[bool] = None):
+        self.num_ctx = num_ctx or OLLAMA_CONFIG["generation_params"]["num_ctx"]
+        self.reserve_tokens = reserve_tokens if reserve_tokens is not None else OLLAMA_CONFIG["context"]["reserve_tokens"]
+        self.enabled = enabled if enabled is not None else OLLAMA_CONFIG["context"]["reuse_context"]
+        self.context: Optional[List[int]] = None
+        # Сколько токенов Ollama разбирала для последнего полного промпта
+        self.full_prompt_tokens: Optional[int] = None
+        self._full_prompt_estimate = 0
+    
+    def prepare(self, full_prompt: str, continuation_prompt: str) -> Tuple[str, Optional[List[int]]]:
+        """Выбирает промпт для запроса: продолжение по context или полный"""
+        self._full_prompt_estimate = estimate_tokens(full_prompt)
+        if self.enabled and self.context:
+            needed = len(self.context) + estimate_tokens(continuation_prompt) + self.reserve_tokens
+            if needed <= self.num_ctx:
+                return continuation_prompt, self.context
+            logger.info(f"[CONVERSATION] Контекст не помещается в окно ({needed} > {self.num_ctx}), отправляем полный промпт")
+            conversation_stats.stats["fallbacks_overflow"] += 1
+        self.context = None
+        return full_prompt, None
+    
+    def record(self, final_chunk: Dict, used_context: bool) -> None:
+        """Запоминает context и считает сэкономленный prefill по финальному чанку"""
+        prompt_eval = final_chunk.get("prompt_eval_count", 0)
+        conversation_stats.stats["prompt_eval_tokens"] += prompt_eval
+        if used_context:
+            conversation_stats.stats["continuations"] += 1
+            baseline = self.full_prompt_tokens or self._full_prompt_estimate
+            saved = max(0, baseline - prompt_eval)
+            conversation_stats.stats["prefill_tokens_saved"] += saved
+            logger.info(f"[CONVERSATION] Продолжение по context: разобрано {prompt_eval} токенов, сэкономлено ~{saved}")
+        else:
+            conversation_stats.stats["full_prompts"] += 1
+            if prompt_eval:
+                self.full_prompt_tokens = prompt_eval
+        self.context = final_chunk.get("context") or None
+    
+    def fail(self) -> None:
+        """Запрос с context не удался - дальше начинаем с полного промпта"""
+        conversation_stats.stats["fallbacks_error"] += 1
+        self.context = None
+    
+    def fork(self) -> "ConversationState":
+        """Копия для спекулятивной ветки: общая история, дальше независимо"""
+        state = ConversationState(self.num_ctx, self.reserve_tokens, self.enabled)
+        state.context = self.context
+        state.full_prompt_tokens = self.full_prompt_tokens
+        return state
+
+# Создаем экземпляр общих метрик
+conversation_stats = ConversationStats()
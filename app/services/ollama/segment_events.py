@@ -0,0 +1,65 @@
+import re
+from enum import Enum
+from typing import List, Optional, Tuple
+
+class SegmentEventType(str, Enum):
+    """Типы событий, которые generate_next_segment отдает маршруту"""
+    TEXT = "text"        # новый фрагмент текста (delta)
+    CHOICES = "choices"  # варианты выбора, разобранные из текста
+    DONE = "done"        # сегмент завершен, в событии полный текст
+    IMAGE = "image"      # иллюстрация к сегменту
+
+SENTENCE_ENDINGS = ".!?"
+
+# Строка варианта выбора: "1. ...", "2) ...", "* ...", "- ..."
+CHOICE_LINE_RE = re.compile(r'^\s*(?:\d+[\.\)]|[\*\-•])\s+(.+?)\s*$')
+
+class SentenceBuffer:
+    """Копит чанки модели и отдает текст целыми предложениями"""
+    
+    def __init__(self):
+        self.buffer = ""
+    
+    def feed(self, chunk: str) -> Optional[str]:
+        """Добавляет чанк; возвращает завершенные предложения, если они появились"""
+        self.buffer += chunk
+        if not any(p in chunk for p in SENTENCE_ENDINGS):
+            return None
+        sentence_end_idx = max(self.buffer.rfind(p) for p in SENTENCE_ENDINGS)
+        if sentence_end_idx == -1:
+            return None
+        # Пробелы и переносы строк после точки остаются в буфере, чтобы
+        # склеенные фрагменты точно повторяли ответ модели
+        complete = self.buffer[:sentence_end_idx + 1]
+        self.buffer = self.buffer[sentence_end_idx + 1:]
+        return complete
+    
+    def flush(self) -> str:
+        """Возвращает недописанный остаток после конца потока"""
+        rest, self.buffer = self.buffer, ""
+        return rest
+
+def extract_choices(text: str) -> Tuple[str, List[str]]:
+    """Отделяет варианты выбора в конце текста от самой истории.
+    
+    Варианты - это подряд идущие строки списка в самом конце текста.
+    Возвращает (текст без вариантов, варианты).
+    """
+    lines = text.rstrip().split('\n')
+    choices = []
+    idx = len(lines)
+    while idx > 0:
+        line = lines[idx - 1]
+        if not line.strip():
+            idx -= 1
+            continue
+        match = CHOICE_LINE_RE.match(line)
+        if not match:
+            break
+        choice = match.group(1).replace('**', '').strip()
+        if choice:
+            choices.insert(0, choice)
+        idx -= 1
+    if len(choices) < 2:
+        return text.strip(), []
+    return '\n'.join(lines[:idx]).strip(), choices
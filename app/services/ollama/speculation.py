@@ -0,0 +1,200 @@
+import asyncio
+import copy
+import hashlib
+import json
+import logging
+import os
+from typing import AsyncIterator, Dict, List, Optional, Set
+from app.services.ollama.conversation import ConversationState
+from app.services.ollama.segment_events import SegmentEventType
+from app.services.ollama.story_generator import generate_next_segment
+from services.llm_scheduler import LLMPriority, llm_scheduler, priority_floor
+
+# Настройка логирования
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+def context_key(context: Dict) -> str:
+    """Хеш состояния истории; несериализуемые значения (сессии и т.п.) берутся как str"""
+    raw = json.dumps(context, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+class SpeculativeBranch:
+    """Продолжение истории для одного варианта выбора, сгенерированное заранее.
+    
+    Фоновая задача читает генератор только до события done; остаток
+    дочитывается, лишь если читатель выбрал эту ветку.
+    """
+    
+    def __init__(self, choice: str, context: Dict, conversation: Optional[ConversationState] = None):
+        self.choice = choice
+        # Своя копия диалога: при попадании сессия продолжает уже с ней
+        self.conversation = conversation.fork() if conversation is not None else None
+        self.events: List[Dict] = []
+        self.error: Optional[BaseException] = None
+        self._generator = generate_next_segment(choice, context, self.conversation)
+        self._updated = asyncio.Event()
+        self.task: Optional[asyncio.Task] = None
+        self.claimed = False
+    
+    async def prefetch(self, slots: asyncio.Semaphore) -> None:
+        # Фоновая ветка не обгоняет в очереди к Ollama ничьи интерактивные запросы
+        priority_floor.set(LLMPriority.SPECULATIVE)
+        try:
+            async with slots:
+                while True:
+                    if self.claimed:
+                        # Читатель ждет эту ветку: следующие запросы идут как интерактивные
+                        priority_floor.set(None)
+                    event = await self._generator.__anext__()
+                    self.events.append(event)
+                    self._updated.set()
+                    if event["type"] == SegmentEventType.DONE:
+                        break
+        except StopAsyncIteration:
+            pass
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning(f"[SPECULATION] Ошибка фоновой генерации ветки '{self.choice}': {e}")
+            self.error = e
+        finally:
+            self._updated.set()
+    
+    def claim(self) -> None:
+        """Ветку выбрал читатель: ее генерация больше не фоновая и не вытесняется"""
+        self.claimed = True
+        if self.task is not None and not self.task.done():
+            llm_scheduler.promote(self.task)
+    
+    @property
+    def preempted(self) -> bool:
+        """Генерацию прервал llm_scheduler ради интерактивного запроса - продолжить ее нельзя"""
+        return self.task is not None and self.task.cancelled() and not self.is_done
+    
+    @property
+    def is_done(self) -> bool:
+        return bool(self.events) and self.events[-1]["type"] == SegmentEventType.DONE
+    
+    async def stream(self) -> AsyncIterator[Dict]:
+        """Отдает накопленные события, затем догоняет фоновую генерацию"""
+        idx = 0
+        while True:
+            while idx < len(self.events):
+                yield self.events[idx]
+                idx += 1
+            if self.task.done():
+                break
+            self._updated.clear()
+            await self._updated.wait()
+        while idx < len(self.events):
+            yield self.events[idx]
+            idx += 1
+        if self.error is not None:
+            raise self.error
+        # Дочитываем генератор, чтобы он закрыл ответ Ollama
+        async for event in self._generator:
+            yield event
+    
+    async def cancel(self) -> None:
+        """Останавливает генерацию и закрывает ответ Ollama"""
+        if self.task and not self.task.done():
+            self.task.cancel()
+            try:
+                await self.task
+            except (asyncio.CancelledError, Exception):
+                pass
+        await self._generator.aclose()
+
+class BranchCache:
+    """Ветки одной сессии, ключ - (хеш контекста, выбор)"""
+    
+    def __init__(self, speculator: "StorySpeculator"):
+        self.speculator = speculator
+        self.branches: Dict[tuple, SpeculativeBranch] = {}
+        # Ссылки на задачи отмены: иначе сборщик мусора может снять их до закрытия ответа Ollama
+        self._cancelling: Set[asyncio.Task] = set()
+    
+    def start(self, choices: List[str], context: Dict, conversation: Optional[ConversationState] = None) -> None:
+        """Запускает фоновую генерацию для первых вариантов выбора"""
+        self.cancel_all()
+        if not self.speculator.enabled:
+            return
+        key = context_key(context)
+        for choice in choices[:self.speculator.max_branches]:
+            branch_context = copy.deepcopy(context)
+            branch_context["previous_choices"].append(choice)
+            branch = SpeculativeBranch(choice, branch_context, conversation)
+            branch.task = asyncio.create_task(branch.prefetch(self.speculator.slots))
+            self.branches[(key, choice)] = branch
+            self.speculator.stats["started"] += 1
+        logger.info(f"[SPECULATION] Запущено веток: {len(self.branches)}")
+    
+    def take(self, choice: str, context: Dict) -> Optional[SpeculativeBranch]:
+        """Забирает ветку под сделанный выбор, остальные отменяет"""
+        if not self.branches:
+            return None
+        branch = self.branches.pop((context_key(context), choice), None)
+        if branch is not None and (branch.preempted or (branch.error is not None and not branch.events)):
+            self._cancel(branch)
+            branch = None
+        if branch is None:
+            self.speculator.stats["misses"] += 1
+        else:
+            branch.claim()
+            self.speculator.stats["hits"] += 1
+            if branch.is_done:
+                self.speculator.stats["hits_ready"] += 1
+            logger.info(f"[SPECULATION] Попадание в заготовленную ветку: {choice}")
+        self.cancel_all()
+        return branch
+    
+    def cancel_all(self) -> None:
+        for branch in self.branches.values():
+            self.speculator.stats["cancelled"] += 1
+            self._cancel(branch)
+        self.branches = {}
+    
+    def _cancel(self, branch: SpeculativeBranch) -> None:
+        task = asyncio.create_task(branch.cancel())
+        self._cancelling.add(task)
+        task.add_done_callback(self._cancelling.discard)
+
+class StorySpeculator:
+    """Настройки и метрики спекулятивной генерации для всех сессий"""
+    
+    def __init__(self):
+        self.enabled = os.getenv("SPECULATIVE_ENABLED", "false").lower() == "true"
+        self.max_branches = int(os.getenv("SPECULATIVE_MAX_BRANCHES", "2"))
+        # Сколько веток всех сессий может одновременно занимать GPU
+        self.gpu_slots = int(os.getenv("SPECULATIVE_GPU_SLOTS", "1"))
+        self._slots: Optional[asyncio.Semaphore] = None
+        self.stats = {
+            "started": 0,
+            "hits": 0,
+            "hits_ready": 0,
+            "misses": 0,
+            "cancelled": 0,
+        }
+    
+    @property
+    def slots(self) -> asyncio.Semaphore:
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.gpu_slots)
+        return self._slots
+    
+    def session_cache(self) -> BranchCache:
+        return BranchCache(self)
+    
+    def get_stats(self) -> Dict:
+        """Возвращает счетчики и долю попаданий"""
+        lookups = self.stats["hits"] + self.stats["misses"]
+        return {
+            **self.stats,
+            "enabled": self.enabled,
+            "max_branches": self.max_branches,
+            "hit_rate": self.stats["hits"] / lookups if lookups else 0.0,
+        }
+
+# Создаем экземпляр спекулятивного генератора
+story_speculator = StorySpeculator()
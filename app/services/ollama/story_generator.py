@@ -1,117 +1,94 @@
-import aiohttp
+import asyncio
 import json
 import os
 import re
-from typing import Dict, List
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, List, Optional
 from config.ollama_config import OLLAMA_CONFIG
 import logging
-from app.services.comfy.image_generator import story_image_generator
+from services.ollama_connection import ollama_connection
+from services.llm_scheduler import LLMPriority
+from services.json_stream import json_generator
+from app.services.gpu import gpu_scheduler, gpu_telemetry, GPUStage
+from app.core.cancellation import cancellation_stats
+from app.core.metrics import record_ollama_timings
+from app.core.tracing import tracer
+from app.services.ollama.segment_events import SegmentEventType, SentenceBuffer, extract_choices
+from app.services.ollama.conversation import ConversationState
+from app.services.ollama.timeline import StoryTimeline, CHOICE_PREFIX
+from services.prompt_budget import PromptBuilder, request_options, token_counter
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# GPU Memory Management
-def cleanup_gpu():
-    """Force cleanup of GPU memory"""
-    import gc
-    gc.collect()
-    try:
-        # Перезапускаем Ollama сервис для освобождения GPU памяти
-        import subprocess
-        subprocess.run(["systemctl", "restart", "ollama"], check=True)
-        logger.info("Ollama service restarted to free GPU memory")
-    except Exception as e:
-        logger.warning(f"Failed to restart Ollama service: {e}")
-
-class ModelManager:
-    def __init__(self):
-        self.active_models = {}
-        self.model_params = {
-            "gpu_layers": 27,  # Количество слоев на GPU
-            "num_gpu": 1,      # Количество GPU
-            "gpu_memory_utilization": 0.8  # Процент использования памяти GPU
-        }
-    
-    def get_model(self, model_name):
-        """Get model with memory management"""
-        if model_name not in self.active_models:
-            try:
-                self.active_models[model_name] = client.load_model(
-                    model_name, 
-                    params=self.model_params
-                )
-            except Exception as e:
-                logger.error(f"Failed to load model {model_name}: {e}")
-                cleanup_gpu()  # Пробуем очистить память и загрузить снова
-                self.active_models[model_name] = client.load_model(
-                    model_name, 
-                    params=self.model_params
-                )
-                
-        return self.active_models[model_name]
-    
-    def unload_model(self, model_name):
-        """Explicitly unload a model"""
-        if model_name in self.active_models:
-            del self.active_models[model_name]
-            cleanup_gpu()
-
-model_manager = ModelManager()
-
-async def unload_model_from_gpu():
-    """Выгружает модель из GPU без её удаления"""
-    try:
-        async with aiohttp.ClientSession() as session:
-            response = await session.post(
-                f"{OLLAMA_CONFIG['base_url']}/api/generate",
-                json={
-                    "model": OLLAMA_CONFIG['model'],
-                    "prompt": "",
-                    "keep_alive": 0
-                }
-            )
-            if response.status == 200:
-                data = await response.json()
-                if data.get("done_reason") == "unload":
-                    logger.info(f"Модель {OLLAMA_CONFIG['model']} выгружена из GPU")
-                    return True
-                else:
-                    logger.warning(f"Неожиданный ответ при выгрузке модели: {data}")
-                    return False
-            else:
-                logger.warning(f"Не удалось выгрузить модель из GPU: {await response.text()}")
-                return False
-    except Exception as e:
-        logger.warning(f"Ошибка при выгрузке модели из GPU: {e}")
-        return False
-
 async def generate_text(prompt: str) -> str:
     """Генерирует текст с помощью языковой модели"""
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.post(
-                f"{OLLAMA_CONFIG['base_url']}/api/generate",
-                json={
-                    "model": OLLAMA_CONFIG["model"],
-                    "prompt": prompt,
-                    "stream": False
-                }
-            ) as response:
-                result = await response.json()
-                return result["response"]
+        async with ollama_connection.request(
+            "post",
+            "/api/generate",
+            priority=LLMPriority.ANALYSIS,
+            json={
+                "model": OLLAMA_CONFIG["model"],
+                "prompt": prompt,
+                "stream": False
+            }
+        ) as response:
+            result = await response.json()
+            return result["response"]
     except Exception as e:
         logger.error(f"Ошибка генерации текста: {e}")
         return ""
 
-async def generate_next_segment(choice: str, context: Dict) -> Dict:
+def continuation_prompt(choice: str) -> str:
+    """Короткий промпт для продолжения: система и история уже есть в context"""
+    return f"""Читатель выбрал: {choice}
+
+Продолжи историю с учетом этого выбора, сохраняя персонажей и события. Пиши ТОЛЬКО на русском языке.
+Сначала напиши текст истории, затем отдельно в конце предложи 3 варианта выбора."""
+
+@asynccontextmanager
+async def open_story_stream(request_params: Dict,
+                            conversation: Optional[ConversationState],
+                            choice: str):
+    """Открывает потоковый ответ Ollama, по возможности продолжая прошлый context.
+    
+    Отдает (response, used_context). Если запрос с context отклонен,
+    повторяет его с полным промптом.
+    """
+    params = request_params
+    used_context = False
+    if conversation is not None:
+        prompt, ollama_context = conversation.prepare(request_params["prompt"], continuation_prompt(choice))
+        if ollama_context is not None:
+            params = {**request_params, "prompt": prompt, "context": ollama_context}
+            used_context = True
+    
+    if used_context:
+        with tracer.span("ollama.generate", used_context=True), gpu_telemetry.stage("text"):
+            async with ollama_connection.request("post", "/api/generate", priority=LLMPriority.INTERACTIVE, json=params) as response:
+                tracer.annotate(status=response.status)
+                if response.status == 200:
+                    yield response, True
+                    return
+        logger.warning(f"[GENERATOR] Ollama отклонила продолжение по context ({response.status}), отправляем полный промпт")
+        conversation.fail()
+    
+    with tracer.span("ollama.generate", used_context=False), gpu_telemetry.stage("text"):
+        async with ollama_connection.request("post", "/api/generate", priority=LLMPriority.INTERACTIVE, json=request_params) as response:
+            tracer.annotate(status=response.status)
+            yield response, False
+
+async def generate_next_segment(choice: str,
+                                context: Dict,
+                                conversation: Optional[ConversationState] = None) -> AsyncIterator[Dict]:
     logger.info("[GENERATOR] >>> Начинаем генерацию нового сегмента")
     logger.info(f"[GENERATOR] Выбор пользователя: {choice}")
     
-    # Сначала выгружаем модели ComfyUI чтобы освободить память для Ollama
-    logger.info("[GENERATOR] >>> Выгружаем модели ComfyUI")
-    await story_image_generator._unload_all_models()
-    logger.info("[GENERATOR] <<< Модели ComfyUI выгружены")
+    # Выгружаем модели ComfyUI, только если иначе текстовая модель не поместится
+    await gpu_scheduler.prepare(GPUStage.TEXT)
 
     # Создаем краткое описание текущего состояния истории
     logger.info("[GENERATOR] >>> Формируем состояние истории")
@@ -128,24 +105,8 @@ async def generate_next_segment(choice: str, context: Dict) -> Dict:
             character_info.append(f"Имя персонажа: {character['name']}")
     
     # Добавляем хронологию событий
-    timeline_events = []
-    if 'timeline' in context and context['timeline']:
-        timeline_events = [f"- {event}" for event in context['timeline'][-5:]]  # Берем последние 5 событий
-    
-    story_state = "\\n".join([
-        f"Текущая глава: {context['current_chapter']}",
-        "",
-        "Информация о персонаже:",
-        *character_info,
-        "",
-        "Недавние события:",
-        *timeline_events,
-        "",
-        f"Последние выборы:",
-        *[f"- {c}" for c in context['previous_choices'][-3:]],
-        f"\\nТекущий выбор: {choice}"
-    ])
-    logger.info("[GENERATOR] <<< Состояние истории сформировано")
+    timeline_events = [f"- {event}" for event in context.get('timeline', [])[-5:]]  # Берем последние 5 событий
+    summary = [f"Ранее: {context['timeline_summary']}"] if context.get('timeline_summary') else []
 
     # Специальный промпт для первой главы
     if choice == "начало истории":
@@ -220,11 +181,25 @@ async def generate_next_segment(choice: str, context: Dict) -> Dict:
         - Используй ТОЛЬКО русский язык
         - Строго следуй характеристикам персонажа из контекста"""
         
-        user_prompt = f"""История находится в следующем состоянии:
+        user_prompt = """История находится в следующем состоянии:
         {story_state}
         
         Пожалуйста, продолжи историю, учитывая все предыдущие события и последний выбор читателя."""
 
+    # Состояние истории заполняется по приоритету в бюджет окна: при нехватке места
+    # первыми уходят сводка и старые события, затем выборы; глава и текущий выбор остаются всегда
+    builder = PromptBuilder("story")
+    builder.fixed(f"System: {system_prompt}\n\nUser: {user_prompt}")
+    builder.add("chapter", [f"Текущая глава: {context['current_chapter']}"])
+    builder.add("character", character_info, priority=1, header="\nИнформация о персонаже:")
+    # Сводка идет первой строкой событий и поэтому отбрасывается раньше них
+    builder.add("events", summary + timeline_events, priority=3, header="\nНедавние события:")
+    builder.add("choices", [f"- {c}" for c in context['previous_choices'][-3:]], priority=2, header="\nПоследние выборы:")
+    builder.add("choice", [f"\nТекущий выбор: {choice}"])
+    story_state = builder.build()
+    user_prompt = user_prompt.replace("{story_state}", story_state)
+    logger.info("[GENERATOR] <<< Состояние истории сформировано")
+
     logger.info(f"Story state:\n{story_state}")
     logger.info("[GENERATOR] >>> Отправляем запрос к Ollama")
     request_params = {
@@ -236,7 +211,8 @@ async def generate_next_segment(choice: str, context: Dict) -> Dict:
             "temperature": OLLAMA_CONFIG["generation_params"]["temperature"],
             "top_p": OLLAMA_CONFIG["generation_params"]["top_p"],
             "top_k": OLLAMA_CONFIG["generation_params"]["top_k"],
-            "num_predict": OLLAMA_CONFIG["generation_params"]["num_predict"],
+            # Один num_ctx для всех запросов и num_predict по бюджету
+            **builder.options(),
             "stop": OLLAMA_CONFIG["generation_params"]["stop"],
             "repeat_last_n": OLLAMA_CONFIG["generation_params"]["repeat_last_n"],
             "repeat_penalty": OLLAMA_CONFIG["generation_params"]["repeat_penalty"],
@@ -244,51 +220,48 @@ async def generate_next_segment(choice: str, context: Dict) -> Dict:
     }
     logger.info(f"[GENERATOR] Параметры запроса: {json.dumps(request_params, indent=2, ensure_ascii=False)}")
     
-    async with aiohttp.ClientSession() as session:
-        async with session.post(
-            f"{OLLAMA_CONFIG['base_url']}/api/generate",
-            json=request_params
-        ) as response:
+    started = time.monotonic()
+    try:
+        async with open_story_stream(request_params, conversation, choice) as (response, used_context):
             logger.info("[GENERATOR] >>> Получен ответ от Ollama, начинаем стриминг")
-            story_text = ""
-            buffer = ""
+            # Фрагменты копим списком и склеиваем один раз в конце
+            chunks: List[str] = []
+            sentences = SentenceBuffer()
             current_chapter = context.get("current_chapter", 1)
-            
+        
             async for line in response.content:
                 if not line.strip():
                     continue
                     
                 try:
                     data = json.loads(line)
+                    if data.get("done"):
+                        record_ollama_timings(data)
+                        tracer.annotate(
+                            eval_count=data.get("eval_count", 0),
+                            prompt_eval_count=data.get("prompt_eval_count", 0),
+                            eval_seconds=data.get("eval_duration", 0) / 1e9,
+                            load_seconds=data.get("load_duration", 0) / 1e9,
+                        )
+                    if data.get("done") and not used_context:
+                        # Точное число токенов полного промпта уточняет оценку бюджета
+                        token_counter.observe(request_params["prompt"], data.get("prompt_eval_count", 0))
+                    if data.get("done") and conversation is not None:
+                        # В последнем чанке Ollama возвращает context для следующего сегмента
+                        conversation.record(data, used_context)
                     if "response" not in data:
                         continue
-                        
-                    chunk = data["response"]
-                    buffer += chunk
-                    
-                    # Если встретили знак конца предложения, отправляем только новое предложение
-                    if any(p in chunk for p in ".!?"):
-                        sentence_end_idx = max(
-                            buffer.rfind("."),
-                            buffer.rfind("!"),
-                            buffer.rfind("?")
-                        )
-                        
-                        if sentence_end_idx > -1:
-                            complete_sentence = buffer[:sentence_end_idx + 1]
-                            story_text += complete_sentence + " "
-                            buffer = buffer[sentence_end_idx + 1:].lstrip()
-                            
-                            logger.info("[GENERATOR] >>> Отправляем новое предложение")
-                            # Отправляем только новое предложение
-                            yield {
-                                "text": story_text.strip(),
-                                "choices": [],
-                                "chapter": current_chapter,
-                                "done": False
-                            }
-                            logger.info("[GENERATOR] <<< Предложение отправлено")
-                    
+                
+                    # Отправляем только новые завершенные предложения
+                    delta = sentences.feed(data["response"])
+                    if delta:
+                        chunks.append(delta)
+                        yield {
+                            "type": SegmentEventType.TEXT,
+                            "delta": delta,
+                            "chapter": current_chapter
+                        }
+        
                 except json.JSONDecodeError:
                     continue
                 except Exception as e:
@@ -297,113 +270,140 @@ async def generate_next_segment(choice: str, context: Dict) -> Dict:
             
             logger.info("[GENERATOR] >>> Стриминг завершен, обрабатываем остаток")
             # Отправляем оставшийся текст в буфере, если он есть
-            if buffer:
-                story_text += buffer
-            
-            logger.info("[GENERATOR] >>> Отправляем финальный фрагмент")
-            # Сначала отправляем финальный фрагмент текста без иллюстрации
-            yield {
-                "text": story_text.strip() + " [DONE]",
-                "choices": [],
-                "chapter": current_chapter,
-                "done": True
-            }
-            logger.info("[GENERATOR] <<< Финальный фрагмент отправлен")
+            rest = sentences.flush()
+            if rest.strip():
+                chunks.append(rest)
+                yield {
+                    "type": SegmentEventType.TEXT,
+                    "delta": rest,
+                    "chapter": current_chapter
+                }
+    
+    except (asyncio.CancelledError, GeneratorExit):
+        # Читатель ушел или выбрал другое: ответ закрывается вместе с блоком, Ollama прекращает генерацию
+        cancellation_stats.cancelled("ollama", time.monotonic() - started)
+        raise
+    cancellation_stats.completed("ollama", time.monotonic() - started)
+        
+    # Ответ уже прочитан и закрыт: соединение и место в очереди к Ollama свободны
+    story_text = "".join(chunks).strip()
+        
+    # Варианты выбора разбираем на сервере, клиенту не нужно искать их в тексте
+    _, choices = extract_choices(story_text)
+    if choices:
+        yield {"type": SegmentEventType.CHOICES, "choices": choices}
+        
+    logger.info("[GENERATOR] >>> Отправляем финальный фрагмент")
+    yield {
+        "type": SegmentEventType.DONE,
+        "text": story_text,
+        "chapter": current_chapter
+    }
+    logger.info("[GENERATOR] <<< Финальный фрагмент отправлен")
+        
+    logger.info("[GENERATOR] <<< Генерация сегмента завершена")
             
-            # Теперь генерируем промпт для иллюстрации
-            illustration = None
-            if story_text.strip():
-                logger.info("[GENERATOR] >>> Начинаем генерацию промпта для иллюстрации")
+@tracer.traced("ollama.image_prompt")
+async def generate_image_prompt(text: str, max_attempts: int = 3) -> str:
+    """Генерирует промпт для изображения с проверкой на английский язык"""
+    def contains_cyrillic(text: str) -> bool:
+        return bool(re.search('[а-яА-Я]', text))
                 
-                async def generate_image_prompt(text: str, max_attempts: int = 3) -> str:
-                    """Генерирует промпт для изображения с проверкой на английский язык"""
-                    def contains_cyrillic(text: str) -> bool:
-                        return bool(re.search('[а-яА-Я]', text))
-                    
-                    def clean_story_text(text: str) -> str:
-                        """Очищает текст от диалогов и вопросов"""
-                        # Удаляем строки с цифрами и звездочками (обычно это опции выбора)
-                        lines = [line for line in text.split('\n') if not re.search(r'^\d+[\.\)]|^\*+', line.strip())]
-                        # Удаляем текст в кавычках (обычно это диалоги)
-                        text = ' '.join(lines)
-                        text = re.sub(r'"[^"]*"', '', text)
-                        # Удаляем вопросительные предложения
-                        text = re.sub(r'[^.!?]+\?', '', text)
-                        return text.strip()
-                    
-                    # Очищаем текст перед генерацией
-                    cleaned_text = clean_story_text(text)
-                    
-                    for attempt in range(max_attempts):
-                        prompt_response = await session.post(
-                            f"{OLLAMA_CONFIG['base_url']}/api/generate",
-                            json={
-                                "model": OLLAMA_CONFIG["model"],
-                                "prompt": f"""Create a summary of the scene in English, focusing ONLY on visual elements and atmosphere. 
-                                Include: location, lighting, main objects, and overall mood.
-                                Keep it under 30 words.
-                                
-                                IMPORTANT: 
-                                - Response must be in English only!
-                                - Describe ONLY what can be seen in the scene
-                                - NO dialogue or questions
-                                - NO numbered lists or choices
-                                
-                                Story text: {cleaned_text}""",
-                                "stream": False,
-                                **OLLAMA_CONFIG["generation_params"]
-                            }
-                        )
-                        
-                        if prompt_response.status == 200:
-                            response_text = ""
-                            async for line in prompt_response.content:
-                                if not line.strip():
-                                    continue
-                                try:
-                                    data = json.loads(line)
-                                    if "response" in data:
-                                        response_text += data["response"]
-                                except json.JSONDecodeError:
-                                    continue
+    def clean_story_text(text: str) -> str:
+        """Очищает текст от диалогов и вопросов"""
+        # Удаляем строки с цифрами и звездочками (обычно это опции выбора)
+        lines = [line for line in text.split('\n') if not re.search(r'^\d+[\.\)]|^\*+', line.strip())]
+        # Удаляем текст в кавычках (обычно это диалоги)
+        text = ' '.join(lines)
+        text = re.sub(r'"[^"]*"', '', text)
+        # Удаляем вопросительные предложения
+        text = re.sub(r'[^.!?]+\?', '', text)
+        return text.strip()
+                
+    # Очищаем текст перед генерацией
+    cleaned_text = clean_story_text(text)
+                
+    prompt = f"""Create a summary of the scene in English, focusing ONLY on visual elements and atmosphere.
+                Include: location, lighting, main objects, and overall mood.
+                Keep it under 30 words.
                             
-                            response_text = response_text.strip()
+                IMPORTANT:
+                - Response must be in English only!
+                - Describe ONLY what can be seen in the scene
+                - NO dialogue or questions
+                - NO numbered lists or choices
                             
-                            # Проверяем на наличие кириллицы
-                            if not contains_cyrillic(response_text):
-                                logger.info(f"[GENERATOR] Успешно сгенерирован промпт на английском (попытка {attempt + 1})")
-                                return response_text
-                            else:
-                                logger.warning(f"[GENERATOR] Промпт содержит кириллицу, пробуем еще раз (попытка {attempt + 1})")
-                                continue
-                    
-                    # Если все попытки неудачны, возвращаем базовый промпт
-                    logger.error("[GENERATOR] Не удалось сгенерировать промпт на английском")
-                    return "A mysterious scene with dark atmosphere"
+                Story text: {cleaned_text}"""
+    # Общий num_ctx и num_predict под короткий ответ. Остальные параметры генерации
+    # не передаем: с фиксированным seed повторные попытки давали бы тот же ответ
+    options = request_options("image_prompt", prompt)
                 
-                # Генерируем промпт с проверкой на английский
-                illustration_prompt = await generate_image_prompt(story_text)
-                logger.info(f"[GENERATOR] Подготовлен промпт для изображения: {illustration_prompt}")
-                
-                # Генерируем иллюстрацию
-                illustration = await story_image_generator.generate_story_illustration({
-                    'current_text': story_text,
-                    'current_chapter': current_chapter,
-                    'prompt': illustration_prompt,
-                    'session': session  # Передаем сессию в генератор изображений
-                })
+    for attempt in range(max_attempts):
+        async with ollama_connection.request(
+            "post",
+            "/api/generate",
+            priority=LLMPriority.IMAGE_PROMPT,
+            json={
+                "model": OLLAMA_CONFIG["model"],
+                "prompt": prompt,
+                "stream": False,
+                "options": options
+            }
+        ) as prompt_response:
+            if prompt_response.status == 200:
+                response_text = ""
+                async for line in prompt_response.content:
+                    if not line.strip():
+                        continue
+                    try:
+                        data = json.loads(line)
+                        if "response" in data:
+                            response_text += data["response"]
+                    except json.JSONDecodeError:
+                        continue
+                            
+                response_text = response_text.strip()
+                            
+                # Проверяем на наличие кириллицы
+                if not contains_cyrillic(response_text):
+                    logger.info(f"[GENERATOR] Успешно сгенерирован промпт на английском (попытка {attempt + 1})")
+                    return response_text
+                else:
+                    logger.warning(f"[GENERATOR] Промпт содержит кириллицу, пробуем еще раз (попытка {attempt + 1})")
+                    continue
                 
-                if illustration:
-                    logger.info("[GENERATOR] >>> Отправляем сгенерированную иллюстрацию")
-                    yield {
-                        "type": "image",
-                        "content": illustration,  # Теперь здесь base64 строка
-                        "prompt": illustration_prompt
-                    }
-                    logger.info("[GENERATOR] <<< Иллюстрация отправлена")
-            
-            logger.info("[GENERATOR] <<< Генерация сегмента завершена")
+    # Если все попытки неудачны, возвращаем базовый промпт
+    logger.error("[GENERATOR] Не удалось сгенерировать промпт на английском")
+    return "A mysterious scene with dark atmosphere"
+
+# Схема ответа analyze_context (передается Ollama в format)
+CONTEXT_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "character": {
+            "type": "object",
+            "properties": {
+                "gender": {"type": "string", "enum": ["мужской", "женский", "-"]},
+                "age": {"type": "string"},
+                "name": {"type": ["string", "null"]}
+            },
+            "required": ["gender", "age", "name"]
+        },
+        "location": {"type": "string"},
+        "time": {
+            "type": "object",
+            "properties": {
+                "day_time": {"type": "string"},
+                "season": {"type": "string"}
+            },
+            "required": ["day_time", "season"]
+        },
+        "events": {"type": "array", "items": {"type": "string"}}
+    },
+    "required": ["character", "location", "time", "events"]
+}
 
+@tracer.traced("ollama.analysis")
 async def analyze_context(text: str) -> dict:
     """Анализирует текст истории с помощью языковой модели"""
     system_prompt = """Ты - помощник для анализа текста истории. Прочитай текст и ответь на следующие вопросы:
@@ -441,43 +441,32 @@ async def analyze_context(text: str) -> dict:
 
     prompt = f"{system_prompt}\n\nТекст истории:\n{text}"
     
-    try:
-        logger.info("[CONTEXT] >>> Отправляем запрос на анализ контекста")
-        response = await generate_text(prompt)
-        logger.info(f"[CONTEXT] Получен ответ: {response}")
-        
-        # Очищаем ответ от markdown разметки
-        clean_response = response.strip()
-        if clean_response.startswith('```'):
-            clean_response = clean_response.split('\n', 1)[1]
-        if clean_response.endswith('```'):
-            clean_response = clean_response.rsplit('\n', 1)[0]
-        clean_response = clean_response.strip()
-        
-        logger.info(f"[CONTEXT] Очищенный ответ: {clean_response}")
-        context = json.loads(clean_response)
-        
-        # Проверяем и исправляем значение пола
-        if context["character"]["gender"] and "/" in context["character"]["gender"]:
-            # Если модель вернула несколько значений, берем первое
-            context["character"]["gender"] = context["character"]["gender"].split("/")[0]
-        
-        logger.info("[CONTEXT] Контекст успешно проанализирован")
-        return context
-    except Exception as e:
-        logger.error(f"Ошибка анализа контекста: {e}")
+    logger.info("[CONTEXT] >>> Отправляем запрос на анализ контекста")
+    # Ответ ограничен схемой; недопустимый gender обрывает генерацию и запускает повтор
+    context = await json_generator.generate(
+        prompt, CONTEXT_SCHEMA, LLMPriority.ANALYSIS, options=request_options("analysis", prompt)
+    )
+    if context is None:
+        logger.error("Ошибка анализа контекста: модель не вернула ответ по схеме")
         return {
             "character": {"gender": None, "age": None, "name": None},
             "location": "Неизвестно",
             "time": {"day_time": None, "season": None},
             "events": []
         }
+    
+    logger.info(f"[CONTEXT] Контекст успешно проанализирован: {context}")
+    return context
 
 async def update_story_context(text: str, choice: str, story_context: dict) -> dict:
     """Обновляет контекст истории на основе текущего текста и выбора"""
     
     # Анализируем текст с помощью модели
     context = await analyze_context(text)
+    return merge_story_context(context, choice, story_context)
+
+def merge_story_context(context: dict, choice: str, story_context: dict) -> dict:
+    """Переносит результат analyze_context и выбор в контекст истории"""
     
     # Обновляем информацию о персонаже
     if context["character"]["gender"]:
@@ -496,17 +485,16 @@ async def update_story_context(text: str, choice: str, story_context: dict) -> d
         story_context["current_state"]["day_time"] = context["time"]["day_time"]
         story_context["current_state"]["season"] = context["time"]["season"]
     
-    # Добавляем события в хронологию
+    # Добавляем события в хронологию: дубликаты и пустые значения пропускаются,
+    # старые события уходят в сводку
+    timeline = StoryTimeline.from_context(story_context)
     if context["events"]:
-        # Фильтруем события, убирая дубликаты и пустые значения
-        new_events = [event for event in context["events"] 
-                     if event and event not in story_context["timeline"]]
-        if new_events:
-            story_context["timeline"].extend(new_events)
+        timeline.extend(context["events"])
     
     # Добавляем выбор в хронологию, если он был сделан
     if choice and choice != "Начать историю":
-        story_context["timeline"].append(f"Выбор: {choice}")
+        timeline.add(f"{CHOICE_PREFIX}{choice}", unique=False)
+    timeline.save(story_context)
 
     # Обновляем текущее состояние
     story_context["current_state"]["current_scene"] = "Развитие истории"
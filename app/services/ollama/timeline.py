@@ -0,0 +1,93 @@
+import os
+from typing import Dict, Iterable, List, Optional
+
+# Заглушка хронологии до первого сегмента
+NOT_STARTED = "История еще не началась..."
+CHOICE_PREFIX = "Выбор: "
+
+def event_key(event: str) -> str:
+    """Ключ для поиска дубликатов: без учета регистра и лишних пробелов"""
+    return " ".join(event.casefold().split())
+
+class StoryTimeline:
+    """Хронология истории ограниченного размера.
+    
+    В контексте хранятся только последние max_events событий
+    ("timeline") и краткая сводка более ранних ("timeline_summary").
+    Вытесненные события дописываются в сводку, а сводка обрезается до
+    summary_chars с начала, поэтому память сессии и размер промпта не
+    растут с длиной истории. Выборы в сводку не попадают - они уже есть
+    в previous_choices.
+    
+    Дубликаты ищутся по словарю ключей событий, а не перебором списка.
+    """
+    
+    def __init__(self,
+                 events: Optional[Iterable[str]] = None,
+                 summary: str = "",
+                 max_events: Optional[int] = None,
+                 summary_chars: Optional[int] = None):
+        self.max_events = max_events or int(os.getenv("TIMELINE_MAX_EVENTS", "30"))
+        self.summary_chars = summary_chars or int(os.getenv("TIMELINE_SUMMARY_CHARS", "600"))
+        self.events: List[str] = []
+        self.summary = summary
+        # ключ события -> сколько раз оно есть в events
+        self._index: Dict[str, int] = {}
+        for event in events or []:
+            self._append(event)
+        self._fold()
+    
+    @classmethod
+    def from_context(cls, story_context: Dict, **kwargs) -> "StoryTimeline":
+        return cls(story_context.get("timeline", []), story_context.get("timeline_summary", ""), **kwargs)
+    
+    def save(self, story_context: Dict) -> None:
+        """Записывает хронологию обратно в контекст истории (обычные list и str для JSON)"""
+        story_context["timeline"] = list(self.events)
+        story_context["timeline_summary"] = self.summary
+    
+    def __contains__(self, event: str) -> bool:
+        return event_key(event) in self._index
+    
+    def __len__(self) -> int:
+        return len(self.events)
+    
+    def _append(self, event: str) -> None:
+        self.events.append(event)
+        key = event_key(event)
+        self._index[key] = self._index.get(key, 0) + 1
+    
+    def add(self, event: str, unique: bool = True) -> bool:
+        """Добавляет событие; повтор уже известного события пропускается"""
+        if not event or (unique and event in self):
+            return False
+        self._append(event)
+        self._fold()
+        return True
+    
+    def extend(self, events: Iterable[str]) -> List[str]:
+        """Добавляет новые события, возвращает добавленные"""
+        return [event for event in events if self.add(event)]
+    
+    def _fold(self) -> None:
+        """Переносит самые старые события в сводку, пока их больше max_events"""
+        overflow = len(self.events) - self.max_events
+        if overflow <= 0:
+            return
+        folded, self.events = self.events[:overflow], self.events[overflow:]
+        for event in folded:
+            key = event_key(event)
+            self._index[key] -= 1
+            if not self._index[key]:
+                del self._index[key]
+        parts = [self.summary] if self.summary else []
+        parts.extend(
+            event.strip().rstrip(".") for event in folded
+            if event != NOT_STARTED and not event.startswith(CHOICE_PREFIX)
+        )
+        summary = ". ".join(part for part in parts if part)
+        if len(summary) > self.summary_chars:
+            # Отбрасываем самое старое по границе события
+            cut = summary.find(". ", len(summary) - self.summary_chars)
+            summary = summary[cut + 2:] if cut != -1 else summary[-self.summary_chars:]
+        self.summary = summary
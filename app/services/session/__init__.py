@@ -0,0 +1,3 @@
+from .store import session_store, SessionSnapshot, StorySegment
+
+__all__ = ['session_store', 'SessionSnapshot', 'StorySegment']
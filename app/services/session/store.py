@@ -0,0 +1,257 @@
+import asyncio
+import json
+import logging
+import os
+import secrets
+import sqlite3
+import threading
+import time
+from dataclasses import asdict, dataclass, field
+from typing import Dict, Iterable, List, Optional, Set
+from app.services.image_generation.image_store import ImageStore, image_store
+
+# Настройка логирования
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+@dataclass
+class StorySegment:
+    choice: str
+    text: str
+    choices: List[str] = field(default_factory=list)
+    chapter: int = 1
+    # url, digest, size, prompt из хранилища изображений
+    image: Optional[Dict] = None
+
+@dataclass
+class SessionSnapshot:
+    """Состояние истории, восстановленное из журнала"""
+    token: str
+    segments: List[StorySegment] = field(default_factory=list)
+    story_context: Optional[Dict] = None
+    conversation_context: Optional[List[int]] = None
+    
+    @property
+    def choices(self) -> List[str]:
+        """Варианты, которые читатель видел последними"""
+        return self.segments[-1].choices if self.segments else []
+
+def apply_record(snapshot: SessionSnapshot, kind: str, payload: Dict) -> None:
+    """Применяет одну запись журнала к состоянию"""
+    if kind == "snapshot":
+        snapshot.segments = [StorySegment(**segment) for segment in payload["segments"]]
+        snapshot.story_context = payload.get("story_context")
+        snapshot.conversation_context = payload.get("conversation_context")
+    elif kind == "segment":
+        snapshot.segments.append(StorySegment(**payload["segment"]))
+        snapshot.story_context = payload.get("story_context")
+        snapshot.conversation_context = payload.get("conversation_context")
+    elif kind == "image":
+        index = payload["segment"]
+        if 0 <= index < len(snapshot.segments):
+            snapshot.segments[index].image = payload["image"]
+    elif kind == "context":
+        snapshot.story_context = payload["story_context"]
+    else:
+        logger.warning(f"[SESSION] Неизвестный тип записи: {kind}")
+
+class SessionStore:
+    """Журнал сессий историй в SQLite (режим WAL).
+    
+    Записи только добавляются: сегмент текста вместе с контекстом на
+    момент его завершения, ссылка на иллюстрацию, обновленный контекст.
+    Состояние сессии - свертка ее записей. Когда записей становится
+    много, они заменяются одной записью snapshot; сессии без активности
+    дольше TTL удаляются вместе с иллюстрациями, на которые больше
+    никто не ссылается.
+    """
+    
+    def __init__(self,
+                 path: Optional[str] = None,
+                 compact_every: Optional[int] = None,
+                 ttl_hours: Optional[float] = None,
+                 images: Optional[ImageStore] = None):
+        self.path = path or os.getenv("SESSION_DB_PATH", os.path.join("data", "sessions.db"))
+        self.compact_every = compact_every or int(os.getenv("SESSION_COMPACT_EVERY", "50"))
+        self.ttl_hours = ttl_hours if ttl_hours is not None else float(os.getenv("SESSION_TTL_HOURS", "72"))
+        self.images = images or image_store
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+        self.stats = {
+            "created": 0,
+            "resumed": 0,
+            "records_appended": 0,
+            "compactions": 0,
+            "expired": 0,
+        }
+    
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            # Журнал общий для всех воркеров: при записи ждем, пока другой процесс закончит транзакцию
+            conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS sessions ("
+                "token TEXT PRIMARY KEY, created REAL NOT NULL, updated REAL NOT NULL, records INTEGER NOT NULL DEFAULT 0)"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS records ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, token TEXT NOT NULL, kind TEXT NOT NULL, payload TEXT NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS records_token ON records (token, id)")
+            self._conn = conn
+        return self._conn
+    
+    def _load(self, token: str) -> Optional[SessionSnapshot]:
+        conn = self._connect()
+        if conn.execute("SELECT 1 FROM sessions WHERE token = ?", (token,)).fetchone() is None:
+            return None
+        snapshot = SessionSnapshot(token=token)
+        for kind, payload in conn.execute(
+                "SELECT kind, payload FROM records WHERE token = ? ORDER BY id", (token,)):
+            apply_record(snapshot, kind, json.loads(payload))
+        return snapshot
+    
+    def _open(self, token: Optional[str]) -> SessionSnapshot:
+        with self._lock:
+            if token:
+                snapshot = self._load(token)
+                if snapshot is not None:
+                    self.stats["resumed"] += 1
+                    return snapshot
+            token = secrets.token_urlsafe(24)
+            now = time.time()
+            self._connect().execute(
+                "INSERT INTO sessions (token, created, updated) VALUES (?, ?, ?)", (token, now, now)
+            )
+            self.stats["created"] += 1
+            return SessionSnapshot(token=token)
+    
+    def _append(self, token: str, kind: str, payload: Dict) -> None:
+        data = json.dumps(payload, ensure_ascii=False, default=str)
+        with self._lock:
+            conn = self._connect()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.execute("INSERT INTO records (token, kind, payload) VALUES (?, ?, ?)", (token, kind, data))
+                conn.execute(
+                    "UPDATE sessions SET updated = ?, records = records + 1 WHERE token = ?", (time.time(), token)
+                )
+                records = conn.execute("SELECT records FROM sessions WHERE token = ?", (token,)).fetchone()
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            self.stats["records_appended"] += 1
+            if records and records[0] >= self.compact_every:
+                self._compact(token)
+    
+    def _compact(self, token: str) -> None:
+        """Заменяет записи сессии одной записью snapshot (вызывается под блокировкой)"""
+        snapshot = self._load(token)
+        if snapshot is None:
+            return
+        payload = json.dumps({
+            "segments": [asdict(segment) for segment in snapshot.segments],
+            "story_context": snapshot.story_context,
+            "conversation_context": snapshot.conversation_context,
+        }, ensure_ascii=False, default=str)
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute("DELETE FROM records WHERE token = ?", (token,))
+            conn.execute("INSERT INTO records (token, kind, payload) VALUES (?, 'snapshot', ?)", (token, payload))
+            conn.execute("UPDATE sessions SET records = 1 WHERE token = ?", (token,))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        self.stats["compactions"] += 1
+        logger.info(f"[SESSION] Журнал сессии {token[:8]}... свернут в snapshot")
+    
+    def _purge_expired(self) -> int:
+        """Удаляет сессии без активности дольше TTL и возвращает их число"""
+        cutoff = time.time() - self.ttl_hours * 3600
+        with self._lock:
+            conn = self._connect()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.execute(
+                    "DELETE FROM records WHERE token IN (SELECT token FROM sessions WHERE updated < ?)", (cutoff,)
+                )
+                removed = conn.execute("DELETE FROM sessions WHERE updated < ?", (cutoff,)).rowcount
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            if removed:
+                # Возвращаем место из WAL в основной файл
+                conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+                self.stats["expired"] += removed
+                logger.info(f"[SESSION] Удалено устаревших сессий: {removed}")
+            return removed
+    
+    def _referenced_images(self) -> Set[str]:
+        """digest иллюстраций всех оставшихся сессий"""
+        digests = set()
+        with self._lock:
+            rows = self._connect().execute(
+                "SELECT kind, payload FROM records WHERE kind IN ('image', 'snapshot')"
+            ).fetchall()
+        for kind, payload in rows:
+            data = json.loads(payload)
+            images = [data["image"]] if kind == "image" else [segment.get("image") for segment in data["segments"]]
+            digests.update(image["digest"] for image in images if image and image.get("digest"))
+        return digests
+    
+    async def _run(self, func, *args):
+        # sqlite3 блокирующий - выполняем в пуле потоков
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, func, *args)
+    
+    async def open(self, token: Optional[str] = None) -> SessionSnapshot:
+        """Возвращает сохраненную сессию по токену или создает новую"""
+        return await self._run(self._open, token)
+    
+    async def add_segment(self,
+                          token: str,
+                          segment: StorySegment,
+                          story_context: Dict,
+                          conversation_context: Optional[List[int]] = None) -> None:
+        """Записывает завершенный сегмент вместе с контекстом на момент его окончания"""
+        await self._run(self._append, token, "segment", {
+            "segment": asdict(segment),
+            "story_context": story_context,
+            "conversation_context": conversation_context,
+        })
+    
+    async def add_image(self, token: str, segment_index: int, image: Dict) -> None:
+        await self._run(self._append, token, "image", {"segment": segment_index, "image": image})
+    
+    async def update_context(self, token: str, story_context: Dict) -> None:
+        await self._run(self._append, token, "context", {"story_context": story_context})
+    
+    async def purge_expired(self, keep: Iterable[str] = ()) -> int:
+        """Удаляет устаревшие сессии и иллюстрации, на которые не ссылаются
+        ни оставшиеся сессии, ни keep (записи кэша иллюстраций)"""
+        removed = await self._run(self._purge_expired)
+        referenced = await self._run(self._referenced_images)
+        await self.images.collect(referenced | set(keep))
+        return removed
+    
+    def close(self) -> None:
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+    
+    def get_stats(self) -> Dict:
+        """Возвращает счетчики журнала"""
+        return {**self.stats, "path": self.path}
+
+# Создаем экземпляр хранилища сессий
+session_store = SessionStore()
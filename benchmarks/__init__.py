@@ -0,0 +1 @@
+"""Микробенчмарки горячих путей внутри процесса (без сети, Ollama и ComfyUI)"""
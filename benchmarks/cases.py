@@ -0,0 +1,197 @@
+import base64
+import hashlib
+import itertools
+import json
+import random
+from dataclasses import dataclass
+from typing import Callable, List, Optional
+
+from app.services.ollama.segment_events import SentenceBuffer, extract_choices
+from app.services.ollama.story_generator import merge_story_context
+from app.services.ollama.timeline import StoryTimeline
+from config.comfy_config import ComfyUIConfig
+from services.ollama_service import OllamaService, SIMILARITY_THRESHOLD
+from services.phrase_index import PhraseIndex
+
+WORDS = (
+    "старый замок туман дорога лес тишина ветер свеча дверь письмо "
+    "рыцарь девушка странник река мост башня ключ тень голос шаги "
+    "холодный темный тихий далекий древний пустой узкий светлый"
+).split()
+
+@dataclass
+class BenchmarkCase:
+    name: str
+    description: str
+    # Возвращает функцию одной операции; подготовка данных не попадает в замер
+    setup: Callable[[], Callable[[], object]]
+    # Порог времени одной операции в микросекундах
+    threshold_us: float
+
+def _sentence(rng: random.Random, words: int = 8) -> str:
+    return " ".join(rng.choice(WORDS) for _ in range(words)).capitalize()
+
+def _story_text(rng: random.Random, sentences: int) -> str:
+    story = " ".join(_sentence(rng) + "." for _ in range(sentences))
+    return story + "\n\n1. Открыть дверь\n2. Вернуться к реке\n3. Позвать на помощь"
+
+def setup_sentence_split() -> Callable[[], object]:
+    """Поток NDJSON из Ollama по 3-4 символа на чанк, как в generate_next_segment"""
+    rng = random.Random(1)
+    text = _story_text(rng, 60)
+    lines = []
+    pos = 0
+    while pos < len(text):
+        step = rng.randint(3, 4)
+        lines.append(json.dumps({"response": text[pos:pos + step], "done": False}, ensure_ascii=False).encode("utf-8") + b"\n")
+        pos += step
+    lines.append(b'{"response": "", "done": true}\n')
+    
+    def run():
+        chunks = []
+        sentences = SentenceBuffer()
+        for line in lines:
+            data = json.loads(line)
+            delta = sentences.feed(data["response"])
+            if delta:
+                chunks.append(delta)
+        chunks.append(sentences.flush())
+        return extract_choices("".join(chunks).strip())
+    return run
+
+def setup_merge_story_context() -> Callable[[], object]:
+    """Слияние анализа в контекст после 10000 событий истории"""
+    rng = random.Random(2)
+    timeline = StoryTimeline()
+    timeline.extend(_sentence(rng) for _ in range(10000))
+    story_context = {
+        "current_state": {"gender": "", "age": "", "name": "", "current_location": "",
+                          "day_time": "", "season": "", "current_scene": "", "current_goal": ""},
+    }
+    timeline.save(story_context)
+    analysis = {
+        "character": {"gender": "женский", "age": "молодая", "name": "Анна"},
+        "location": "Старый замок",
+        "time": {"day_time": "вечер", "season": "осень"},
+        "events": [_sentence(rng) for _ in range(5)] + [story_context["timeline"][-1]],
+    }
+    
+    def run():
+        # Хронология ограничена, поэтому повторные слияния не увеличивают контекст
+        return merge_story_context(analysis, "Открыть дверь", story_context)
+    return run
+
+def setup_modify_workflow() -> Callable[[], object]:
+    config = ComfyUIConfig()
+    
+    def run():
+        return config.modify_workflow("old castle in the fog, oil painting", seed=12345, width=768, height=512)
+    return run
+
+# Формы слов для фраз истории: с окончаниями похожие фразы редки, как в настоящем тексте
+WORD_FORMS = [word + ending for word in WORDS for ending in ("", "а", "ом", "ы", "е", "ой", "ами", "у")]
+
+def _phrase(rng: random.Random, words: int = 10) -> str:
+    return " ".join(rng.choice(WORD_FORMS) for _ in range(words)).capitalize()
+
+def _repetition_service(rng: random.Random, phrases: int = 500) -> OllamaService:
+    service = OllamaService()
+    service.used_phrases = PhraseIndex(threshold=SIMILARITY_THRESHOLD, max_phrases=phrases)
+    service.used_phrases.update(_phrase(rng) for _ in range(phrases))
+    return service
+
+def _setup_is_repetitive(phrases: int) -> Callable[[], object]:
+    rng = random.Random(3)
+    service = _repetition_service(rng, phrases)
+    # Разные тексты по кругу, чтобы подписи фраз не брались из кэша индекса
+    texts = itertools.cycle([[_phrase(rng, 12) for _ in range(10)] for _ in range(100)])
+    
+    def run():
+        new_phrases = next(texts)
+        result = service.is_repetitive(". ".join(new_phrases) + ".")
+        # is_repetitive добавляет новые фразы в индекс - убираем их
+        for phrase in new_phrases:
+            service.used_phrases.discard(phrase)
+        return result
+    return run
+
+def setup_is_repetitive() -> Callable[[], object]:
+    """Новый текст из 10 фраз против 500 уже использованных"""
+    return _setup_is_repetitive(500)
+
+def setup_is_repetitive_10k() -> Callable[[], object]:
+    """Новый текст из 10 фраз против 10000 уже использованных, индекс MinHash/LSH"""
+    return _setup_is_repetitive(10000)
+
+def setup_is_repetitive_linear_10k() -> Callable[[], object]:
+    """Прежняя проверка: каждая новая фраза сравнивается со всеми 10000 использованными"""
+    rng = random.Random(3)
+    service = OllamaService()
+    used = {_phrase(rng) for _ in range(10000)}
+    phrases = [_phrase(rng, 12) for _ in range(10)]
+    
+    def run():
+        return any(
+            phrase in used or any(service.similar_phrases(phrase, old) for old in used)
+            for phrase in phrases
+        )
+    return run
+
+def setup_similar_phrases() -> Callable[[], object]:
+    rng = random.Random(4)
+    service = _repetition_service(rng)
+    first, second = _sentence(rng, 12), _sentence(rng, 12)
+    
+    def run():
+        return service.similar_phrases(first, second)
+    return run
+
+def _image_bytes() -> bytes:
+    # Случайные байты не сжимаются - по размеру как PNG 768x512
+    return random.Random(5).getrandbits(8 * 512 * 1024).to_bytes(512 * 1024, "little")
+
+def setup_base64_image() -> Callable[[], object]:
+    """Прежний способ отдачи иллюстрации клиенту: base64 в сообщении websocket"""
+    data = _image_bytes()
+    
+    def run():
+        return base64.b64encode(data).decode("utf-8")
+    return run
+
+def setup_image_digest() -> Callable[[], object]:
+    """Текущий способ: sha256 для адреса в хранилище изображений"""
+    data = _image_bytes()
+    
+    def run():
+        return hashlib.sha256(data).hexdigest()
+    return run
+
+CASES: List[BenchmarkCase] = [
+    BenchmarkCase("sentence_split_stream", "Разбор потока Ollama на предложения и варианты выбора",
+                  setup_sentence_split, 15000.0),
+    BenchmarkCase("merge_story_context_10k", "Слияние контекста истории после 10000 событий",
+                  setup_merge_story_context, 300.0),
+    BenchmarkCase("modify_workflow", "ComfyUIConfig.modify_workflow",
+                  setup_modify_workflow, 50.0),
+    BenchmarkCase("is_repetitive_500", "OllamaService.is_repetitive, 500 использованных фраз",
+                  setup_is_repetitive, 2500.0),
+    BenchmarkCase("is_repetitive_10k", "OllamaService.is_repetitive, 10000 использованных фраз",
+                  setup_is_repetitive_10k, 5000.0),
+    BenchmarkCase("is_repetitive_linear_10k", "Перебор всех фраз, как до индекса, 10000 использованных фраз",
+                  setup_is_repetitive_linear_10k, 2000000.0),
+    BenchmarkCase("similar_phrases", "OllamaService.similar_phrases для пары фраз",
+                  setup_similar_phrases, 50.0),
+    BenchmarkCase("base64_image_512k", "base64 изображения 512 КБ",
+                  setup_base64_image, 10000.0),
+    BenchmarkCase("image_digest_512k", "sha256 изображения 512 КБ",
+                  setup_image_digest, 10000.0),
+]
+
+def get_cases(names: Optional[List[str]] = None) -> List[BenchmarkCase]:
+    if not names:
+        return list(CASES)
+    known = {case.name: case for case in CASES}
+    unknown = [name for name in names if name not in known]
+    if unknown:
+        raise ValueError(f"Неизвестные бенчмарки: {', '.join(unknown)}")
+    return [known[name] for name in names]
@@ -0,0 +1,134 @@
+"""Запуск микробенчмарков.
+
+    python -m benchmarks.run                        # все бенчмарки, JSON в benchmarks/results/<commit>.json
+    python -m benchmarks.run --only modify_workflow
+    python -m benchmarks.run --compare benchmarks/results/abc1234.json
+
+Код возврата 1, если операция медленнее своего порога или медленнее
+базового прогона больше чем на --tolerance.
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from benchmarks.cases import BenchmarkCase, get_cases
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+
+def git_commit() -> str:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"],
+            stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+def measure(case: BenchmarkCase, repeat: int = 5, min_time: float = 0.2) -> Dict:
+    """Замеряет одну операцию: число циклов подбирается, чтобы повтор шел не меньше min_time"""
+    func = case.setup()
+    func()  # прогрев
+    
+    loops = 1
+    while True:
+        started = time.perf_counter()
+        for _ in range(loops):
+            func()
+        elapsed = time.perf_counter() - started
+        if elapsed >= min_time or loops >= 1_000_000:
+            break
+        loops *= 10 if elapsed < min_time / 10 else 2
+    
+    timings = [elapsed / loops]
+    for _ in range(repeat - 1):
+        started = time.perf_counter()
+        for _ in range(loops):
+            func()
+        timings.append((time.perf_counter() - started) / loops)
+    
+    return {
+        "description": case.description,
+        "loops": loops,
+        "repeat": repeat,
+        "min_us": min(timings) * 1e6,
+        "median_us": statistics.median(timings) * 1e6,
+        "max_us": max(timings) * 1e6,
+        "threshold_us": case.threshold_us,
+    }
+
+def run_all(cases: List[BenchmarkCase], repeat: int = 5, min_time: float = 0.2) -> Dict:
+    results = {}
+    for case in cases:
+        results[case.name] = measure(case, repeat, min_time)
+        print(f"{case.name:<28} {results[case.name]['median_us']:>12.2f} мкс/оп  (порог {case.threshold_us:.0f})")
+    return {
+        "commit": git_commit(),
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "results": results,
+    }
+
+def check_regressions(report: Dict, baseline: Optional[Dict] = None, tolerance: float = 0.25) -> List[str]:
+    """Возвращает описания регрессий: превышение порога и замедление относительно baseline"""
+    problems = []
+    for name, result in report["results"].items():
+        if result["median_us"] > result["threshold_us"]:
+            problems.append(f"{name}: {result['median_us']:.2f} мкс > порога {result['threshold_us']:.2f} мкс")
+        if baseline is None:
+            continue
+        previous = baseline.get("results", {}).get(name)
+        if previous is None:
+            continue
+        # Сравниваем минимумы: они меньше всего зависят от шума на машине
+        limit = previous["min_us"] * (1 + tolerance)
+        if result["min_us"] > limit:
+            slowdown = result["min_us"] / previous["min_us"] - 1
+            problems.append(
+                f"{name}: {result['min_us']:.2f} мкс против {previous['min_us']:.2f} мкс "
+                f"в {baseline.get('commit', '?')} (+{slowdown:.0%})"
+            )
+    return problems
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Микробенчмарки StoryCraft AI")
+    parser.add_argument("--only", nargs="*", help="Запустить только указанные бенчмарки")
+    parser.add_argument("--output", help="Файл для JSON с результатами")
+    parser.add_argument("--compare", help="JSON предыдущего прогона для сравнения")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="Допустимое замедление относительно --compare (0.25 = 25%%)")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--min-time", type=float, default=0.2)
+    args = parser.parse_args(argv)
+    
+    # Сервисы пишут в лог при создании - в выводе бенчмарков это лишнее
+    logging.disable(logging.INFO)
+    
+    report = run_all(get_cases(args.only), args.repeat, args.min_time)
+    
+    output = args.output or os.path.join(RESULTS_DIR, f"{report['commit']}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+    print(f"Результаты сохранены: {output}")
+    
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+    
+    problems = check_regressions(report, baseline, args.tolerance)
+    for problem in problems:
+        print(f"РЕГРЕССИЯ {problem}")
+    return 1 if problems else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,5 +1,6 @@
 from typing import Dict, Any, Optional
 import requests
+import copy
 import json
 import os
 from dataclasses import dataclass
@@ -130,7 +131,11 @@ class ComfyUIConfig:
     def modify_workflow(self, prompt: str, seed: Optional[int] = None,
                        width: Optional[int] = None, height: Optional[int] = None) -> Dict[str, Any]:
         """Модификация рабочего процесса с пользовательскими параметрами"""
-        workflow = self.default_workflow.copy()
+        # Копируются только изменяемые узлы (промпт, сэмплер, размер): иначе правки попадут
+        # в default_workflow и в соседние задачи; остальные узлы общие и не меняются
+        workflow = dict(self.default_workflow)
+        for node_id in ("3", "5", "6"):
+            workflow[node_id] = copy.deepcopy(workflow[node_id])
         
         # Обновляем параметры
         if seed is not None:
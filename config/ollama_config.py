@@ -52,6 +52,10 @@ OLLAMA_CONFIG = {
         "max_retries": get_env_int("OLLAMA_MAX_RETRIES", 3),
         "retry_delay": get_env_int("OLLAMA_RETRY_DELAY", 2),
         "backoff_factor": get_env_float("OLLAMA_BACKOFF_FACTOR", 1.5),
+        # Пул соединений: общий лимит, лимит на хост и время жизни keep-alive
+        "pool_limit": get_env_int("OLLAMA_POOL_LIMIT", 20),
+        "pool_limit_per_host": get_env_int("OLLAMA_POOL_LIMIT_PER_HOST", 8),
+        "keepalive_timeout": get_env_float("OLLAMA_KEEPALIVE_TIMEOUT", 60),
     },
     
     # Параметры контекста
@@ -59,6 +63,10 @@ OLLAMA_CONFIG = {
         "max_context_length": get_env_int("OLLAMA_MAX_CONTEXT_LENGTH", 5),
         "similarity_threshold": get_env_float("OLLAMA_SIMILARITY_THRESHOLD", 0.7),
         "max_retries_generation": get_env_int("OLLAMA_MAX_RETRIES_GENERATION", 3),
+        # Продолжение сегментов по массиву context вместо полного промпта
+        "reuse_context": os.getenv("OLLAMA_REUSE_CONTEXT", "true").lower() == "true",
+        # Сколько токенов окна оставить под ответ модели
+        "reserve_tokens": get_env_int("OLLAMA_CONTEXT_RESERVE", 1500),
     },
     
     # Параметры истории
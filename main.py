@@ -5,14 +5,45 @@ from fastapi.responses import HTMLResponse
 from fastapi import Request
 import uvicorn
 import os
+from contextlib import asynccontextmanager
 from dotenv import load_dotenv
 from app.api.routes.story import router as story_router
+from app.api.routes.images import router as images_router
+from app.api.routes.metrics import router as metrics_router
+from app.services.comfy.supervisor import comfy_supervisor
+from app.services.comfy.events import comfy_events
+from services.ollama_connection import ollama_connection
+from app.services.session import session_store
+from app.services.image_generation import illustration_cache
+from app.core.worker_registry import worker_registry
+from app.core.tracing import tracer
+from app.services.gpu import gpu_telemetry
 
 # Загружаем переменные окружения
 load_dotenv()
 load_dotenv(override=True)  # Добавляем override=True
 
-app = FastAPI(title="Interactive Book Generator")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Открываем общий пул соединений с Ollama на время жизни приложения
+    await ollama_connection.get_session()
+    # Сессии без активности дольше SESSION_TTL_HOURS больше не продолжить; их картинки,
+    # если на них не ссылается кэш иллюстраций, удаляются из хранилища
+    await session_store.purge_expired(keep=await illustration_cache.digests())
+    # Телеметрия GPU (GPU_TELEMETRY_SOURCE) для решений о видеопамяти и профиля этапов
+    gpu_telemetry.start()
+    yield
+    session_store.close()
+    await worker_registry.forget_worker()
+    worker_registry.close()
+    await ollama_connection.close()
+    await comfy_events.stop()
+    await tracer.flush()
+    await gpu_telemetry.stop()
+    # Останавливаем ComfyUI, если он был запущен приложением
+    await comfy_supervisor.shutdown()
+
+app = FastAPI(title="Interactive Book Generator", lifespan=lifespan)
 
 # Монтируем статические файлы
 app.mount("/static", StaticFiles(directory="static"), name="static")
@@ -22,15 +53,21 @@ templates = Jinja2Templates(directory="templates")
 
 # Подключаем роуты
 app.include_router(story_router, prefix="")
+app.include_router(images_router, prefix="")
+app.include_router(metrics_router, prefix="")
 
 @app.get("/", response_class=HTMLResponse)
 async def root(request: Request):
     return templates.TemplateResponse("book.html", {"request": request})
 
 if __name__ == "__main__":
+    # Общее состояние воркеров лежит в SQLite (data/), поэтому их можно запускать несколько
+    workers = int(os.getenv("WORKERS", "1"))
     uvicorn.run(
         "main:app",
         host=os.getenv("HOST", "0.0.0.0"),
         port=int(os.getenv("PORT", 8000)),
-        reload=os.getenv("RELOAD", "True").lower() == "true"
+        # reload в uvicorn работает только с одним процессом
+        reload=workers == 1 and os.getenv("RELOAD", "True").lower() == "true",
+        workers=workers
     )
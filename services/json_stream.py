@@ -0,0 +1,316 @@
+import json
+import logging
+import os
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from config.ollama_config import OLLAMA_CONFIG
+from services.ollama_connection import ollama_connection
+from services.llm_scheduler import LLMPriority
+
+logger = logging.getLogger(__name__)
+
+# Символы чисел, true, false и null вне строк
+LITERAL_CHARS = set("-+.0123456789eEtruefalsn")
+
+class SchemaViolation(ValueError):
+    """Ответ модели не соответствует JSON-схеме"""
+    pass
+
+class GuardViolation(ValueError):
+    """Текст ответа нарушает правила качества (повтор, язык, формат)"""
+    pass
+
+# Проверка строки ответа по мере генерации: путь, текст на данный момент, дописана ли строка
+Guard = Callable[[Tuple, str, bool], None]
+
+class IncrementalJSONParser:
+    """Разбирает JSON по мере поступления фрагментов.
+    
+    feed() возвращает скалярные значения, которые завершились в этом
+    фрагменте, вместе с путем до них: (("character", "gender"), "женский").
+    Так поле можно проверить, пока модель еще пишет остальной ответ.
+    """
+    
+    def __init__(self):
+        # Открытые контейнеры: [тип, текущий ключ или индекс, ждем ли ключ]
+        self._stack: List[list] = []
+        self._string: Optional[str] = None
+        self._escape = False
+        self._literal = ""
+        self._parts: List[str] = []
+        self.complete = False
+    
+    @property
+    def text(self) -> str:
+        return "".join(self._parts)
+    
+    def feed(self, chunk: str) -> List[Tuple[Tuple, Any]]:
+        self._parts.append(chunk)
+        values: List[Tuple[Tuple, Any]] = []
+        for ch in chunk:
+            self._step(ch, values)
+        return values
+    
+    @property
+    def partial(self) -> Optional[Tuple[Tuple, str]]:
+        """Недописанная строка-значение: путь и текст, полученный на данный момент"""
+        if self._string is None:
+            return None
+        frame = self._stack[-1] if self._stack else None
+        if frame is not None and frame[0] == "object" and frame[2]:
+            # Это ключ, а не значение
+            return None
+        raw = self._string[:-1] if self._escape else self._string
+        try:
+            return self._path(), json.loads(raw + '"')
+        except json.JSONDecodeError:
+            # Оборвана \u-последовательность - проверим на следующем фрагменте
+            return None
+    
+    def _path(self) -> Tuple:
+        return tuple(frame[1] for frame in self._stack)
+    
+    def _step(self, ch: str, values: list) -> None:
+        if self._string is not None:
+            self._string += ch
+            if self._escape:
+                self._escape = False
+            elif ch == "\\":
+                self._escape = True
+            elif ch == '"':
+                value = json.loads(self._string)
+                self._string = None
+                frame = self._stack[-1] if self._stack else None
+                if frame is not None and frame[0] == "object" and frame[2]:
+                    frame[1] = value
+                    frame[2] = False
+                else:
+                    values.append((self._path(), value))
+            return
+        
+        if ch in LITERAL_CHARS:
+            self._literal += ch
+            return
+        if self._literal:
+            values.append((self._path(), json.loads(self._literal)))
+            self._literal = ""
+        
+        if ch == '"':
+            self._string = '"'
+        elif ch == "{":
+            self._stack.append(["object", None, True])
+        elif ch == "[":
+            self._stack.append(["array", 0, False])
+        elif ch in "}]":
+            if not self._stack:
+                raise json.JSONDecodeError("Лишняя закрывающая скобка", self.text, 0)
+            self._stack.pop()
+            if not self._stack:
+                self.complete = True
+        elif ch == ",":
+            if not self._stack:
+                raise json.JSONDecodeError("Запятая вне контейнера", self.text, 0)
+            frame = self._stack[-1]
+            if frame[0] == "object":
+                frame[2] = True
+            else:
+                frame[1] += 1
+        # ':' и пробелы ничего не меняют
+
+JSON_TYPES = {
+    "string": str,
+    "number": (int, float),
+    "integer": int,
+    "boolean": bool,
+    "object": dict,
+    "array": list,
+    "null": type(None),
+}
+
+def _schema_at(schema: Dict, path: Tuple) -> Optional[Dict]:
+    for key in path:
+        if isinstance(key, int):
+            schema = schema.get("items")
+        else:
+            schema = schema.get("properties", {}).get(key)
+        if schema is None:
+            return None
+    return schema
+
+def _check_type(schema: Dict, path: Tuple, value: Any) -> None:
+    expected = schema.get("type")
+    if expected is not None:
+        types = expected if isinstance(expected, list) else [expected]
+        # bool в Python - подкласс int, но в JSON это разные типы
+        ok = any(
+            isinstance(value, JSON_TYPES[t]) and not (t in ("number", "integer") and isinstance(value, bool))
+            for t in types
+        )
+        if not ok:
+            raise SchemaViolation(f"{'.'.join(map(str, path))}: ожидался {expected}, получено {value!r}")
+    if "enum" in schema and value not in schema["enum"]:
+        raise SchemaViolation(f"{'.'.join(map(str, path))}: {value!r} не из {schema['enum']}")
+
+def check_value(schema: Dict, path: Tuple, value: Any) -> None:
+    """Проверяет одно скалярное значение по схеме (type и enum)"""
+    field_schema = _schema_at(schema, path)
+    if field_schema is not None:
+        _check_type(field_schema, path, value)
+
+def validate(schema: Dict, document: Any, path: Tuple = ()) -> None:
+    """Проверяет готовый документ: типы, enum и обязательные поля"""
+    _check_type(schema, path, document)
+    if isinstance(document, dict):
+        for key in schema.get("required", []):
+            if key not in document:
+                raise SchemaViolation(f"нет обязательного поля {'.'.join(map(str, path + (key,)))}")
+        for key, value in document.items():
+            if key in schema.get("properties", {}):
+                validate(schema["properties"][key], value, path + (key,))
+    elif isinstance(document, list) and "items" in schema:
+        for index, value in enumerate(document):
+            validate(schema["items"], value, path + (index,))
+
+def _schema_key(schema: Dict) -> str:
+    """Ответы одной схемы близки по длине - средняя длина считается по схеме"""
+    return ",".join(sorted(schema.get("properties", {})))
+
+class JSONGenerator:
+    """Запросы к Ollama с ответом по JSON-схеме.
+    
+    Схема передается в параметре format, поэтому модель сразу пишет
+    JSON нужной формы. Ответ читается потоком: каждое поле проверяется,
+    как только дописано, и при нарушении (например, недопустимый gender)
+    генерация обрывается и повторяется, не дожидаясь конца ответа.
+    Дополнительная проверка guard получает строки по мере генерации и
+    обрывает ответ так же (повторы, язык, разметка).
+    
+    Сэкономленные токены оцениваются как средняя длина завершенного
+    ответа той же схемы минус токены, полученные до обрыва.
+    """
+    
+    def __init__(self, max_attempts: Optional[int] = None):
+        self.max_attempts = max_attempts or int(os.getenv("OLLAMA_JSON_MAX_ATTEMPTS", "3"))
+        # Старые версии Ollama принимают только format: "json"
+        self.schema_supported = True
+        # ключ схемы -> [число завершенных ответов, сумма их токенов]
+        self._lengths: Dict[str, List[int]] = {}
+        # Получают последний чанк каждого ответа (eval_count, eval_duration и т.д.)
+        self._done_listeners: List[Callable[[Dict], None]] = []
+        self.stats = {
+            "requests": 0,
+            "succeeded": 0,
+            "aborted_early": 0,
+            "guard_aborts": 0,
+            "invalid_documents": 0,
+            "failed": 0,
+            "tokens_before_abort": 0,
+            "tokens_saved": 0,
+        }
+    
+    async def generate(self,
+                       prompt: str,
+                       schema: Dict,
+                       priority: LLMPriority,
+                       options: Optional[Dict] = None,
+                       model: Optional[str] = None,
+                       guard: Optional[Guard] = None) -> Optional[Dict]:
+        """Возвращает документ, прошедший проверку схемы, или None после всех попыток"""
+        for attempt in range(1, self.max_attempts + 1):
+            self.stats["requests"] += 1
+            payload = {
+                "model": model or OLLAMA_CONFIG["model"],
+                "prompt": prompt,
+                "format": schema if self.schema_supported else "json",
+                "stream": True,
+            }
+            if options:
+                payload["options"] = options
+            progress = {"tokens": 0}
+            try:
+                async with ollama_connection.request("post", "/api/generate", priority=priority, json=payload) as response:
+                    if response.status != 200:
+                        error = await response.text()
+                        if response.status == 400 and self.schema_supported:
+                            logger.warning(f"[JSON] Ollama не принимает JSON-схему ({error.strip()}), переходим на format=json")
+                            self.schema_supported = False
+                        else:
+                            logger.error(f"[JSON] Попытка {attempt}: статус {response.status}: {error.strip()}")
+                        continue
+                    try:
+                        document = await self._read(response, schema, guard, progress)
+                    except ValueError:
+                        # Закрываем соединение - Ollama прекращает генерацию
+                        response.close()
+                        raise
+                self.stats["succeeded"] += 1
+                return document
+            except GuardViolation as e:
+                self.stats["guard_aborts"] += 1
+                self._aborted(schema, progress["tokens"])
+                logger.warning(f"[JSON] Попытка {attempt}: ответ оборван после {progress['tokens']} токенов: {e}")
+            except SchemaViolation as e:
+                if not progress.get("complete"):
+                    self._aborted(schema, progress["tokens"])
+                logger.warning(f"[JSON] Попытка {attempt}: {e}")
+            except json.JSONDecodeError as e:
+                self.stats["invalid_documents"] += 1
+                logger.warning(f"[JSON] Попытка {attempt}: некорректный JSON: {e}")
+            except Exception as e:
+                logger.error(f"[JSON] Попытка {attempt}: ошибка запроса: {e}")
+        self.stats["failed"] += 1
+        return None
+    
+    def _aborted(self, schema: Dict, tokens: int) -> None:
+        count, total = self._lengths.get(_schema_key(schema), (0, 0))
+        self.stats["tokens_before_abort"] += tokens
+        if count:
+            self.stats["tokens_saved"] += max(total // count - tokens, 0)
+    
+    async def _read(self, response, schema: Dict, guard: Optional[Guard], progress: Dict) -> Dict:
+        parser = IncrementalJSONParser()
+        async for line in response.content:
+            if not line.strip():
+                continue
+            data = json.loads(line)
+            # Ollama присылает по токену в строке
+            progress["tokens"] += 1
+            for path, value in parser.feed(data.get("response", "")):
+                try:
+                    check_value(schema, path, value)
+                except SchemaViolation:
+                    self.stats["aborted_early"] += 1
+                    raise
+                if guard is not None and isinstance(value, str):
+                    guard(path, value, True)
+            partial = parser.partial if guard is not None else None
+            if partial is not None:
+                guard(*partial, False)
+            if data.get("done"):
+                progress["tokens"] = data.get("eval_count", progress["tokens"])
+                for listener in self._done_listeners:
+                    listener(data)
+                break
+        
+        progress["complete"] = True
+        entry = self._lengths.setdefault(_schema_key(schema), [0, 0])
+        entry[0] += 1
+        entry[1] += progress["tokens"]
+        
+        document = json.loads(parser.text)
+        try:
+            validate(schema, document)
+        except SchemaViolation:
+            self.stats["invalid_documents"] += 1
+            raise
+        return document
+    
+    def on_done(self, listener: Callable[[Dict], None]) -> None:
+        """Подписывает listener на последний чанк каждого ответа Ollama"""
+        self._done_listeners.append(listener)
+    
+    def get_stats(self) -> Dict:
+        """Возвращает счетчики запросов, ранних обрывов и сэкономленных токенов"""
+        return {**self.stats, "schema_supported": self.schema_supported}
+
+# Создаем экземпляр генератора JSON
+json_generator = JSONGenerator()
@@ -0,0 +1,249 @@
+import asyncio
+import itertools
+import logging
+import os
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from enum import IntEnum
+from typing import Awaitable, Callable, Deque, Dict, Optional, Set
+
+logger = logging.getLogger(__name__)
+
+class LLMPriority(IntEnum):
+    """Классы запросов к Ollama; меньшее значение обслуживается раньше"""
+    INTERACTIVE = 0   # текст истории, который читатель ждет прямо сейчас
+    ANALYSIS = 1      # анализ контекста после сегмента
+    IMAGE_PROMPT = 2  # промпт и перевод для иллюстрации
+    SPECULATIVE = 3   # заранее генерируемые продолжения
+
+# Сессия, от имени которой идут запросы (выставляется в websocket_endpoint и наследуется задачами)
+current_session: ContextVar[Optional[str]] = ContextVar("llm_session", default=None)
+# Нижняя граница приоритета для фоновых задач: запросы из них не обгоняют интерактивные
+priority_floor: ContextVar[Optional[LLMPriority]] = ContextVar("llm_priority_floor", default=None)
+
+QueueListener = Callable[[Dict], Awaitable[None]]
+
+def effective_priority(priority: LLMPriority) -> LLMPriority:
+    floor = priority_floor.get()
+    return LLMPriority(max(priority, floor)) if floor is not None else priority
+
+@dataclass
+class _Waiter:
+    future: asyncio.Future
+    priority: LLMPriority
+    session: str
+    task: Optional[asyncio.Task] = None
+    enqueued: float = field(default_factory=time.monotonic)
+    position: Optional[int] = None
+
+class LLMScheduler:
+    """Допуск запросов к Ollama: не больше max_concurrent одновременно.
+    
+    Очередь упорядочена по классу приоритета, внутри класса сессии
+    обслуживаются по кругу, чтобы одна сессия с множеством запросов не
+    занимала модель целиком. Подписчики сессии получают свою позицию в
+    очереди при каждом ее изменении.
+    
+    Заранее генерируемое продолжение может занимать модель минуту; если
+    в это время в очередь встает интерактивный запрос, задача, которая
+    держит место классом SPECULATIVE, отменяется.
+    """
+    
+    def __init__(self, max_concurrent: Optional[int] = None):
+        self.max_concurrent = max_concurrent or int(os.getenv("LLM_MAX_CONCURRENT", "1"))
+        self.active = 0
+        # приоритет -> сессия -> ожидающие запросы этой сессии (порядок сессий = очередь обхода)
+        self._queues: Dict[LLMPriority, "OrderedDict[str, Deque[_Waiter]]"] = {
+            priority: OrderedDict() for priority in LLMPriority
+        }
+        self._listeners: Dict[str, QueueListener] = {}
+        # Задачи, держащие место классом SPECULATIVE: их можно вытеснить
+        self._preemptible: Set[asyncio.Task] = set()
+        self.stats = {
+            "admitted": 0,
+            "admitted_immediately": 0,
+            "cancelled_in_queue": 0,
+            "max_queue_depth": 0,
+            "preempted": 0,
+        }
+        self.wait_seconds: Dict[str, float] = {priority.name.lower(): 0.0 for priority in LLMPriority}
+        self.admitted_by_class: Dict[str, int] = {priority.name.lower(): 0 for priority in LLMPriority}
+    
+    def subscribe(self, session: str, listener: QueueListener) -> None:
+        """Сессия будет получать {"position", "depth", "priority"} своих ожидающих запросов"""
+        self._listeners[session] = listener
+    
+    def unsubscribe(self, session: str) -> None:
+        self._listeners.pop(session, None)
+    
+    @property
+    def queue_depth(self) -> int:
+        return sum(len(waiters) for queue in self._queues.values() for waiters in queue.values())
+    
+    def _ordered_waiters(self):
+        """Ожидающие в том порядке, в котором их допустит планировщик"""
+        for priority in LLMPriority:
+            queues = [list(waiters) for waiters in self._queues[priority].values()]
+            # Круговой обход: по одному запросу от каждой сессии
+            for round_ in itertools.zip_longest(*queues):
+                for waiter in round_:
+                    if waiter is not None:
+                        yield waiter
+    
+    def _next_waiter(self) -> Optional[_Waiter]:
+        for priority in LLMPriority:
+            queue = self._queues[priority]
+            if not queue:
+                continue
+            session, waiters = queue.popitem(last=False)
+            waiter = waiters.popleft()
+            if waiters:
+                # Остальные запросы сессии ждут, пока свою очередь получат другие
+                queue[session] = waiters
+            return waiter
+        return None
+    
+    def _admit(self, waiter: Optional[_Waiter], immediately: bool = False) -> None:
+        self.active += 1
+        self.stats["admitted"] += 1
+        if immediately:
+            self.stats["admitted_immediately"] += 1
+        if waiter is not None:
+            name = waiter.priority.name.lower()
+            self.admitted_by_class[name] += 1
+            self.wait_seconds[name] += time.monotonic() - waiter.enqueued
+    
+    def _dispatch(self) -> None:
+        while self.active < self.max_concurrent:
+            waiter = self._next_waiter()
+            if waiter is None:
+                break
+            self._admit(waiter)
+            waiter.future.set_result(None)
+            self._notify(waiter, 0)
+        self._notify_positions()
+    
+    def _notify(self, waiter: _Waiter, position: int) -> None:
+        listener = self._listeners.get(waiter.session)
+        if listener is None or waiter.position == position:
+            return
+        waiter.position = position
+        info = {"position": position, "depth": self.queue_depth, "priority": waiter.priority.name.lower()}
+        task = asyncio.ensure_future(listener(info))
+        task.add_done_callback(lambda t: t.cancelled() or t.exception())
+    
+    def _notify_positions(self) -> None:
+        if not self._listeners:
+            return
+        for position, waiter in enumerate(self._ordered_waiters(), start=1):
+            self._notify(waiter, position)
+    
+    def _remove(self, waiter: _Waiter) -> None:
+        queue = self._queues[waiter.priority]
+        waiters = queue.get(waiter.session)
+        if waiters is None:
+            return
+        try:
+            waiters.remove(waiter)
+        except ValueError:
+            return
+        if not waiters:
+            del queue[waiter.session]
+    
+    def _preempt(self) -> None:
+        """Отменяет одну фоновую генерацию, чтобы интерактивный запрос не ждал ее конца"""
+        while self._preemptible:
+            task = self._preemptible.pop()
+            if not task.done():
+                task.cancel()
+                self.stats["preempted"] += 1
+                logger.info("[LLM] Фоновая генерация прервана ради интерактивного запроса")
+                return
+    
+    def promote(self, task: asyncio.Task) -> None:
+        """Запросы задачи становятся интерактивными: ветку, которую выбрал
+        читатель, больше нельзя вытеснить, а в очереди она идет первой"""
+        self._preemptible.discard(task)
+        moved = False
+        for priority in LLMPriority:
+            if priority == LLMPriority.INTERACTIVE:
+                continue
+            for waiters in list(self._queues[priority].values()):
+                for waiter in [w for w in waiters if w.task is task]:
+                    self._remove(waiter)
+                    waiter.priority = LLMPriority.INTERACTIVE
+                    self._queues[LLMPriority.INTERACTIVE].setdefault(waiter.session, deque()).append(waiter)
+                    moved = True
+        if moved:
+            self._notify_positions()
+            self._preempt()
+    
+    def _release(self) -> None:
+        self.active -= 1
+        self._dispatch()
+    
+    @asynccontextmanager
+    async def slot(self, priority: LLMPriority, session: Optional[str] = None):
+        """Занимает место для запроса на время блока"""
+        priority = effective_priority(priority)
+        session = session or current_session.get() or "-"
+        name = priority.name.lower()
+        
+        waiter = None
+        if self.active < self.max_concurrent and self.queue_depth == 0:
+            self._admit(None, immediately=True)
+            self.admitted_by_class[name] += 1
+        else:
+            waiter = _Waiter(asyncio.get_event_loop().create_future(), priority, session, asyncio.current_task())
+            self._queues[priority].setdefault(session, deque()).append(waiter)
+            self.stats["max_queue_depth"] = max(self.stats["max_queue_depth"], self.queue_depth)
+            logger.info(f"[LLM] Запрос {name} в очереди, глубина {self.queue_depth}")
+            self._notify_positions()
+            if priority == LLMPriority.INTERACTIVE:
+                self._preempt()
+            try:
+                await waiter.future
+            except asyncio.CancelledError:
+                if waiter.future.done() and not waiter.future.cancelled():
+                    # Место уже выдано, но задача отменена - возвращаем его
+                    self._release()
+                else:
+                    self._remove(waiter)
+                    self.stats["cancelled_in_queue"] += 1
+                    self._notify_positions()
+                raise
+        # Пока запрос ждал, ветку могли выбрать (promote) - тогда она уже не фоновая
+        if waiter is not None:
+            priority = waiter.priority
+        holder = asyncio.current_task() if priority == LLMPriority.SPECULATIVE else None
+        if holder is not None:
+            self._preemptible.add(holder)
+        try:
+            yield
+        finally:
+            self._preemptible.discard(holder)
+            self._release()
+    
+    def get_stats(self) -> Dict:
+        """Возвращает глубину очереди по классам и среднее ожидание"""
+        return {
+            **self.stats,
+            "max_concurrent": self.max_concurrent,
+            "active": self.active,
+            "queue_depth": self.queue_depth,
+            "queue_depth_by_class": {
+                priority.name.lower(): sum(len(w) for w in self._queues[priority].values())
+                for priority in LLMPriority
+            },
+            "admitted_by_class": dict(self.admitted_by_class),
+            "avg_wait_seconds": {
+                name: self.wait_seconds[name] / count if count else 0.0
+                for name, count in self.admitted_by_class.items()
+            },
+        }
+
+# Создаем экземпляр планировщика запросов к Ollama
+llm_scheduler = LLMScheduler()
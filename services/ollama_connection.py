@@ -1,10 +1,12 @@
 import aiohttp
 import asyncio
 import logging
-from typing import Optional, Dict, Any
+from contextlib import asynccontextmanager
+from typing import Optional, Dict, Any, AsyncIterator
 from datetime import datetime, timedelta
 
-from config.ollama_config import get_connection_params
+from config.ollama_config import OLLAMA_CONFIG, get_connection_params
+from services.llm_scheduler import LLMPriority, llm_scheduler
 
 logger = logging.getLogger(__name__)
 
@@ -16,6 +18,17 @@ class OllamaConnection:
         self.error_count = 0
         self.is_connected = False
         self.connection_params = get_connection_params()
+        self._session_lock: Optional[asyncio.Lock] = None
+        # Метрики пула соединений
+        self.pool_stats = {
+            "sessions_created": 0,
+            "requests_total": 0,
+            "requests_in_flight": 0,
+            "request_errors": 0,
+            "connections_created": 0,
+            "connections_reused": 0,
+            "connections_queued": 0,
+        }
         
     async def __aenter__(self):
         await self.ensure_connection()
@@ -24,12 +37,89 @@ class OllamaConnection:
     async def __aexit__(self, exc_type, exc_val, exc_tb):
         await self.close()
 
+    def _create_session(self) -> aiohttp.ClientSession:
+        """Создает сессию с пулом keep-alive соединений"""
+        connector = aiohttp.TCPConnector(
+            limit=self.connection_params["pool_limit"],
+            limit_per_host=self.connection_params["pool_limit_per_host"],
+            keepalive_timeout=self.connection_params["keepalive_timeout"]
+        )
+        
+        # Считаем новые и переиспользованные соединения
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_connection_create_end.append(self._on_connection_created)
+        trace_config.on_connection_reuseconn.append(self._on_connection_reused)
+        trace_config.on_connection_queued_start.append(self._on_connection_queued)
+        
+        self.pool_stats["sessions_created"] += 1
+        # Для потоковых ответов ограничиваем время между чанками, а не общее время
+        return aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=None, sock_read=self.connection_params["timeout"]),
+            trace_configs=[trace_config]
+        )
+    
+    async def _on_connection_created(self, session, context, params) -> None:
+        self.pool_stats["connections_created"] += 1
+    
+    async def _on_connection_reused(self, session, context, params) -> None:
+        self.pool_stats["connections_reused"] += 1
+    
+    async def _on_connection_queued(self, session, context, params) -> None:
+        self.pool_stats["connections_queued"] += 1
+    
+    async def get_session(self) -> aiohttp.ClientSession:
+        """Возвращает общую сессию пула, создавая её при первом обращении"""
+        if self.session and not self.session.closed:
+            return self.session
+        if self._session_lock is None:
+            self._session_lock = asyncio.Lock()
+        async with self._session_lock:
+            if not self.session or self.session.closed:
+                self.session = self._create_session()
+                logger.info(f"Created pooled Ollama session for {self.base_url}")
+        return self.session
+    
+    @asynccontextmanager
+    async def request(self,
+                      method: str,
+                      endpoint: str,
+                      priority: Optional[LLMPriority] = None,
+                      **kwargs) -> AsyncIterator[aiohttp.ClientResponse]:
+        """Выполняет запрос через общий пул и отдает ответ (в т.ч. потоковый).
+        
+        Запросы с priority сначала ждут места у llm_scheduler и держат его,
+        пока читается ответ. Служебные запросы (/api/ps, выгрузка модели)
+        передаются без priority и очередь не проходят.
+        """
+        if priority is None:
+            async with self._request(method, endpoint, **kwargs) as response:
+                yield response
+            return
+        async with llm_scheduler.slot(priority):
+            async with self._request(method, endpoint, **kwargs) as response:
+                yield response
+    
+    @asynccontextmanager
+    async def _request(self, method: str, endpoint: str, **kwargs) -> AsyncIterator[aiohttp.ClientResponse]:
+        session = await self.get_session()
+        self.pool_stats["requests_total"] += 1
+        self.pool_stats["requests_in_flight"] += 1
+        try:
+            async with session.request(method, f"{self.base_url}{endpoint}", **kwargs) as response:
+                self.is_connected = True
+                yield response
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            self.pool_stats["request_errors"] += 1
+            self.is_connected = False
+            raise
+        finally:
+            self.pool_stats["requests_in_flight"] -= 1
+    
     async def ensure_connection(self) -> None:
         """Проверяет и восстанавливает подключение при необходимости"""
         if not self.session or self.session.closed:
-            self.session = aiohttp.ClientSession(
-                timeout=aiohttp.ClientTimeout(total=self.connection_params["timeout"])
-            )
+            await self.get_session()
             try:
                 # Проверяем подключение
                 async with self.session.get(f"{self.base_url}/api/version") as response:
@@ -78,8 +168,9 @@ class OllamaConnection:
             try:
                 await self.ensure_connection()
                 
-                async with getattr(self.session, method)(
-                    f"{self.base_url}{endpoint}",
+                async with self.request(
+                    method,
+                    endpoint,
                     json=data if method == "post" else None
                 ) as response:
                     if response.status == 200:
@@ -108,11 +199,30 @@ class OllamaConnection:
             logger.error(f"Health check failed: {str(e)}")
             return False
 
+    def get_pool_stats(self) -> Dict[str, Any]:
+        """Возвращает метрики пула соединений"""
+        stats = dict(self.pool_stats)
+        stats["limit"] = self.connection_params["pool_limit"]
+        stats["limit_per_host"] = self.connection_params["pool_limit_per_host"]
+        
+        connector = self.session.connector if self.session and not self.session.closed else None
+        if connector is not None:
+            stats["connections_in_use"] = len(getattr(connector, "_acquired", ()))
+            stats["connections_idle"] = sum(len(conns) for conns in getattr(connector, "_conns", {}).values())
+        else:
+            stats["connections_in_use"] = 0
+            stats["connections_idle"] = 0
+        return stats
+    
     def get_status(self) -> Dict[str, Any]:
         """Возвращает текущий статус соединения"""
         return {
             "is_connected": self.is_connected,
             "error_count": self.error_count,
             "last_error_time": self.last_error_time.isoformat() if self.last_error_time else None,
-            "base_url": self.base_url
+            "base_url": self.base_url,
+            "pool": self.get_pool_stats()
         }
+
+# Общий пул соединений с Ollama для всего приложения
+ollama_connection = OllamaConnection(OLLAMA_CONFIG["base_url"])
@@ -1,6 +1,5 @@
 import logging
 from typing import Dict, Optional
-import json
 
 from config.ollama_config import (
     OLLAMA_CONFIG,
@@ -9,20 +8,66 @@ from config.ollama_config import (
     get_context_params,
     get_history_params
 )
-from services.ollama_connection import OllamaConnection
+from services.ollama_connection import ollama_connection
+from services.llm_scheduler import LLMPriority
+from services.json_stream import Guard, json_generator
+from services.prompt_budget import request_options
+from services.phrase_index import PhraseIndex, split_phrases
+from services.text_guard import TextGuard
 
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
+# Порог схожести фраз (доля общих слов)
+SIMILARITY_THRESHOLD = 0.7
+
+# Параметры генерации, которые передаются в options. seed и temperature не передаем:
+# с фиксированным seed и почти нулевой температурой повторные попытки JSONGenerator
+# возвращали бы тот же ответ. num_threads Ollama не принимает
+SAMPLING_KEYS = ("top_p", "top_k", "stop", "repeat_last_n", "repeat_penalty")
+
+def _strings(*names: str) -> Dict:
+    return {name: {"type": "string"} for name in names}
+
+# Схемы ответов из generate_story_prompt и generate_next_prompt
+STORY_START_SCHEMA = {
+    "type": "object",
+    "properties": _strings(
+        "scene_description", "character_name", "character_description",
+        "initial_situation", "mood", "time_of_day"
+    ),
+    "required": [
+        "scene_description", "character_name", "character_description",
+        "initial_situation", "mood", "time_of_day"
+    ]
+}
+
+SCENE_SCHEMA = {
+    "type": "object",
+    "properties": {
+        **_strings("scene_description", "character_name", "dialog", "emotion", "mood", "time_of_day"),
+        "choices": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": _strings("text", "consequence"),
+                "required": ["text", "consequence"]
+            }
+        }
+    },
+    "required": ["scene_description", "character_name", "dialog", "choices"]
+}
+
 class OllamaService:
     def __init__(self):
         self.base_url = OLLAMA_CONFIG["base_url"]
         self.model = OLLAMA_CONFIG["model"]
         self.story_context = []
-        self.used_phrases = set()
+        # Индекс использованных фраз: поиск похожих без перебора всей истории
+        self.used_phrases = PhraseIndex(threshold=SIMILARITY_THRESHOLD)
         self.scene_history = []
         self.is_error_state = False
-        self.connection = OllamaConnection(self.base_url)
+        self.connection = ollama_connection
         self.context_params = get_context_params()
         self.history_params = get_history_params()
         logger.info(f"OllamaService initialized with model: {self.model}")
@@ -123,12 +168,10 @@ class OllamaService:
     def is_repetitive(self, text: str) -> bool:
         """Проверяет текст на повторы"""
         # Разбиваем текст на фразы
-        phrases = [p.strip() for p in text.split('.') if p.strip()]
+        phrases = split_phrases(text)
         
         for phrase in phrases:
-            if phrase in self.used_phrases:
-                return True
-            if any(self.similar_phrases(phrase, used) for used in self.used_phrases):
+            if self.used_phrases.find_similar(phrase) is not None:
                 return True
         
         # Добавляем новые фразы в использованные
@@ -148,7 +191,7 @@ class OllamaService:
             return False
             
         similarity = len(common_words) / total_words
-        return similarity > 0.7  # Порог схожести
+        return similarity > SIMILARITY_THRESHOLD
 
     def is_technical_message(self, message: Dict) -> bool:
         """Проверяет, является ли сообщение техническим"""
@@ -188,50 +231,27 @@ class OllamaService:
         self.story_context.append(event)
         logger.debug(f"Added event to context: {event_type} - {content[:50]}...")
 
-    async def generate(self, prompt: str) -> Dict:
-        """Отправляет запрос к Ollama API и получает ответ"""
+    async def generate(self, prompt: str, schema: Optional[Dict] = None, guard: Optional[Guard] = None) -> Dict:
+        """Отправляет запрос к Ollama API и получает ответ по JSON-схеме"""
         logger.debug(f"Sending request to Ollama API with prompt: {prompt[:100]}...")
         
-        request_data = {
-            "model": self.model,
-            "prompt": prompt,
-            "stream": False,
-            "options": get_generation_params()
-        }
-        
-        try:
-            result = await self.connection.make_request(
-                "post",
-                "/api/generate",
-                request_data
-            )
-            
-            if result and "response" in result:
-                try:
-                    # Пытаемся распарсить JSON из ответа
-                    return json.loads(result['response'])
-                except json.JSONDecodeError as e:
-                    logger.warning(f"Failed to parse JSON from response: {e}")
-                    # Если не получилось распарсить JSON, пробуем найти JSON в тексте
-                    text = result['response']
-                    try:
-                        # Ищем начало и конец JSON
-                        start = text.find('{')
-                        end = text.rfind('}') + 1
-                        if start >= 0 and end > start:
-                            json_str = text[start:end]
-                            logger.debug(f"Extracted JSON string: {json_str}")
-                            return json.loads(json_str)
-                    except Exception as e:
-                        logger.error(f"Failed to extract JSON from text: {e}")
-                    
-                    return self.create_error_response(f"Ошибка парсинга ответа: {str(e)}")
-            else:
-                return self.create_error_response("Неверный формат ответа от сервера")
-                
-        except Exception as e:
-            logger.error(f"Error generating content: {str(e)}")
-            return self.create_error_response(f"Ошибка генерации: {str(e)}")
+        # Поля проверяются по мере генерации, неверный ответ обрывается и повторяется
+        # (не больше OLLAMA_JSON_MAX_ATTEMPTS попыток)
+        result = await json_generator.generate(
+            prompt,
+            schema or {"type": "object"},
+            LLMPriority.INTERACTIVE,
+            # num_predict по бюджету окна вместо общего OLLAMA_NUM_PREDICT
+            options={
+                **{key: get_generation_params()[key] for key in SAMPLING_KEYS},
+                **request_options("scene", prompt),
+            },
+            model=self.model,
+            guard=guard
+        )
+        if result is None:
+            return self.create_error_response("Ответ модели не соответствует схеме")
+        return result
 
     def create_error_response(self, error_message: str) -> Dict:
         """Создает структурированный ответ с ошибкой"""
@@ -252,7 +272,7 @@ class OllamaService:
         logger.info("Starting new story generation")
         self.story_context = []  # Очищаем контекст
         prompt = await self.generate_story_prompt()
-        result = await self.generate(prompt)
+        result = await self.generate(prompt, STORY_START_SCHEMA)
         
         if "error" not in result:
             # Сохраняем начало истории в контекст
@@ -293,26 +313,21 @@ class OllamaService:
                     elif item["type"] == "dialog":
                         formatted_context.append(f"Диалог: {item['content']}")
             
-            # Генерируем новую сцену
+            # Генерируем новую сцену; повторы, язык и формат проверяются по мере генерации,
+            # и при нарушении запрос обрывается сразу, а не после полного ответа
             prompt = await self.generate_next_prompt("\n".join(formatted_context))
-            result = await self.generate(prompt)
+            result = await self.generate(prompt, SCENE_SCHEMA, guard=TextGuard(self.used_phrases))
             
             if "error" not in result and not self.is_technical_message(result):
                 self.is_error_state = False  # Сбрасываем флаг ошибки при успешной генерации
                 
-                # Проверяем на повторы
+                # Ответ прошел проверку повторов - запоминаем его фразы
                 if result.get('scene_description'):
-                    if self.is_repetitive(result['scene_description']):
-                        logger.warning("Detected scene repetition, requesting regeneration")
-                        return await self.generate_next_scene(selected_choice)
-                    
+                    self.used_phrases.update(split_phrases(result['scene_description']))
                     self.add_to_story_context("scene", result['scene_description'])
                     
                 if result.get('dialog'):
-                    if self.is_repetitive(result['dialog']):
-                        logger.warning("Detected dialog repetition, requesting regeneration")
-                        return await self.generate_next_scene(selected_choice)
-                    
+                    self.used_phrases.update(split_phrases(result['dialog']))
                     self.add_to_story_context("dialog", result['dialog'])
             else:
                 self.is_error_state = True  # Устанавливаем флаг ошибки
@@ -0,0 +1,179 @@
+import hashlib
+import os
+import random
+from array import array
+from collections import OrderedDict
+from typing import Dict, FrozenSet, Iterable, List, Optional, Set, Tuple
+
+# Простое число Мерсенна 2^61-1 для универсального хеширования
+MERSENNE_PRIME = (1 << 61) - 1
+# Сколько последних посчитанных фраз держать, чтобы не считать подпись дважды
+RECENT_ENTRIES = 64
+
+def split_phrases(text: str) -> List[str]:
+    """Фразы текста, как их разбивает is_repetitive"""
+    return [p.strip() for p in text.split('.') if p.strip()]
+
+def phrase_words(phrase: str) -> FrozenSet[str]:
+    """Множество слов фразы в нижнем регистре, как в similar_phrases"""
+    return frozenset(word.lower() for word in phrase.split())
+
+def jaccard(words1: FrozenSet[str], words2: FrozenSet[str]) -> float:
+    total = len(words1 | words2)
+    return len(words1 & words2) / total if total else 0.0
+
+class MinHasher:
+    """MinHash-подписи множеств слов.
+    
+    Значения всех перестановок для слова считаются один раз и хранятся
+    массивом; подпись фразы - поэлементный минимум массивов ее слов.
+    Кэш общий для всех сессий и ограничен max_words словами.
+    """
+    
+    def __init__(self, num_perm: int, seed: int = 1, max_words: Optional[int] = None):
+        rng = random.Random(seed)
+        self._permutations = [
+            (rng.randrange(1, MERSENNE_PRIME), rng.randrange(0, MERSENNE_PRIME))
+            for _ in range(num_perm)
+        ]
+        self.max_words = max_words or int(os.getenv("PHRASE_INDEX_WORD_CACHE", "50000"))
+        self._words: Dict[str, array] = {}
+    
+    def _word(self, word: str) -> array:
+        values = self._words.get(word)
+        if values is None:
+            h = int.from_bytes(hashlib.blake2b(word.encode("utf-8"), digest_size=8).digest(), "little") & MERSENNE_PRIME
+            values = array("Q", [(a * h + b) % MERSENNE_PRIME for a, b in self._permutations])
+            if len(self._words) >= self.max_words:
+                self._words.clear()
+            self._words[word] = values
+        return values
+    
+    def signature(self, words: FrozenSet[str]) -> List[int]:
+        arrays = [self._word(word) for word in words]
+        if len(arrays) == 1:
+            return list(arrays[0])
+        return list(map(min, *arrays))
+
+_hashers: Dict[int, MinHasher] = {}
+
+def get_hasher(num_perm: int) -> MinHasher:
+    """Общий MinHasher для подписей из num_perm значений"""
+    if num_perm not in _hashers:
+        _hashers[num_perm] = MinHasher(num_perm)
+    return _hashers[num_perm]
+
+class PhraseIndex:
+    """Индекс почти одинаковых фраз на MinHash и LSH.
+    
+    Для каждой фразы считается MinHash-подпись из bands * rows значений;
+    подпись режется на полосы, и фраза попадает в корзину каждой полосы.
+    Похожие фразы совпадают хотя бы в одной полосе с высокой
+    вероятностью, поэтому сравнивать новую фразу нужно только с
+    кандидатами из ее корзин, а не со всей историей. Кандидаты
+    проверяются точным коэффициентом Жаккара по множествам слов.
+    
+    Фраз хранится не больше max_phrases, самые старые вытесняются.
+    """
+    
+    def __init__(self,
+                 threshold: float = 0.7,
+                 bands: Optional[int] = None,
+                 rows: Optional[int] = None,
+                 max_phrases: Optional[int] = None):
+        self.threshold = threshold
+        self.bands = bands or int(os.getenv("PHRASE_INDEX_BANDS", "12"))
+        self.rows = rows or int(os.getenv("PHRASE_INDEX_ROWS", "3"))
+        self.max_phrases = max_phrases or int(os.getenv("PHRASE_INDEX_MAX_PHRASES", "5000"))
+        self._hasher = get_hasher(self.bands * self.rows)
+        # фраза -> (множество слов, ключи корзин), от старых к новым
+        self._phrases: "OrderedDict[str, Tuple[FrozenSet[str], List[Tuple]]]" = OrderedDict()
+        self._buckets: Dict[Tuple, Set[str]] = {}
+        # Последние посчитанные фразы: is_repetitive сначала ищет фразы текста, потом добавляет их
+        self._recent: "OrderedDict[str, Tuple[FrozenSet[str], List[Tuple]]]" = OrderedDict()
+        self.stats = {
+            "lookups": 0,
+            "candidates": 0,
+            "matches": 0,
+            "evictions": 0,
+        }
+    
+    def _entry(self, phrase: str) -> Tuple[FrozenSet[str], List[Tuple]]:
+        """Множество слов и ключи корзин фразы"""
+        entry = self._recent.get(phrase)
+        if entry is not None:
+            return entry
+        words = phrase_words(phrase)
+        signature = self._hasher.signature(words) if words else []
+        keys = [
+            (band, tuple(signature[band * self.rows:(band + 1) * self.rows]))
+            for band in range(self.bands)
+        ] if signature else []
+        self._recent[phrase] = (words, keys)
+        if len(self._recent) > RECENT_ENTRIES:
+            self._recent.popitem(last=False)
+        return words, keys
+    
+    def __contains__(self, phrase: str) -> bool:
+        return phrase in self._phrases
+    
+    def __len__(self) -> int:
+        return len(self._phrases)
+    
+    def __iter__(self):
+        return iter(self._phrases)
+    
+    def find_similar(self, phrase: str) -> Optional[str]:
+        """Сохраненная фраза, похожая на phrase больше порога, или None"""
+        self.stats["lookups"] += 1
+        if phrase in self._phrases:
+            self.stats["matches"] += 1
+            return phrase
+        words, keys = self._entry(phrase)
+        checked: Set[str] = set()
+        for key in keys:
+            for candidate in self._buckets.get(key, ()):
+                if candidate in checked:
+                    continue
+                checked.add(candidate)
+                if jaccard(words, self._phrases[candidate][0]) > self.threshold:
+                    self.stats["candidates"] += len(checked)
+                    self.stats["matches"] += 1
+                    return candidate
+        self.stats["candidates"] += len(checked)
+        return None
+    
+    def add(self, phrase: str) -> None:
+        if phrase in self._phrases:
+            self._phrases.move_to_end(phrase)
+            return
+        words, keys = self._entry(phrase)
+        self._phrases[phrase] = (words, keys)
+        for key in keys:
+            self._buckets.setdefault(key, set()).add(phrase)
+        while len(self._phrases) > self.max_phrases:
+            self.discard(next(iter(self._phrases)))
+            self.stats["evictions"] += 1
+    
+    def update(self, phrases: Iterable[str]) -> None:
+        for phrase in phrases:
+            self.add(phrase)
+    
+    def discard(self, phrase: str) -> None:
+        entry = self._phrases.pop(phrase, None)
+        if entry is None:
+            return
+        for key in entry[1]:
+            bucket = self._buckets.get(key)
+            if bucket is not None:
+                bucket.discard(phrase)
+                if not bucket:
+                    del self._buckets[key]
+    
+    def get_stats(self) -> Dict:
+        return {
+            **self.stats,
+            "phrases": len(self._phrases),
+            "buckets": len(self._buckets),
+            "max_phrases": self.max_phrases,
+        }
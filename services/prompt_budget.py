@@ -0,0 +1,240 @@
+import logging
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+from config.ollama_config import OLLAMA_CONFIG, get_env_int
+
+logger = logging.getLogger(__name__)
+
+# Начальная оценка для русского текста, уточняется по prompt_eval_count от Ollama
+CHARS_PER_TOKEN = 3.0
+MIN_CHARS_PER_TOKEN = 1.5
+MAX_CHARS_PER_TOKEN = 6.0
+
+class TokenCounter:
+    """Оценка числа токенов по длине текста.
+    
+    Токенайзера модели на сервере нет, поэтому токены считаются по
+    символам. Отношение символов к токену уточняется по prompt_eval_count,
+    который Ollama возвращает для полных промптов.
+    """
+    
+    def __init__(self, chars_per_token: float = CHARS_PER_TOKEN):
+        self.chars_per_token = chars_per_token
+        self.observations = 0
+    
+    def count(self, text: str) -> int:
+        return int(len(text) / self.chars_per_token) + 1
+    
+    def observe(self, text: str, prompt_eval_count: int) -> None:
+        """Учитывает точное число токенов промпта (скользящее среднее)"""
+        if not prompt_eval_count or not text:
+            return
+        ratio = len(text) / prompt_eval_count
+        # Если Ollama взяла начало промпта из кэша, prompt_eval_count меньше полного - такие замеры пропускаем
+        if not MIN_CHARS_PER_TOKEN <= ratio <= MAX_CHARS_PER_TOKEN:
+            return
+        self.observations += 1
+        weight = max(1 / self.observations, 0.1)
+        self.chars_per_token += (ratio - self.chars_per_token) * weight
+
+# Общий счетчик токенов
+token_counter = TokenCounter()
+
+def estimate_tokens(text: str) -> int:
+    return token_counter.count(text)
+
+class PromptOverflow(ValueError):
+    """Обязательная часть промпта не оставляет в окне места даже под min_predict"""
+
+@dataclass
+class RequestProfile:
+    """Сколько токенов ответа нужно запросу данного типа"""
+    kind: str
+    num_predict: int
+    # Меньше этого ответ бесполезен: сокращаем промпт, а не ответ
+    min_predict: int
+
+def _profile(kind: str, num_predict: int, min_predict: int) -> RequestProfile:
+    # OLLAMA_NUM_PREDICT остается общим верхним пределом
+    limit = OLLAMA_CONFIG["generation_params"]["num_predict"]
+    value = min(get_env_int(f"OLLAMA_NUM_PREDICT_{kind.upper()}", num_predict), limit)
+    return RequestProfile(kind, value, min(min_predict, value))
+
+REQUEST_PROFILES: Dict[str, RequestProfile] = {
+    profile.kind: profile for profile in (
+        _profile("story", 1500, 600),
+        _profile("scene", 1500, 600),
+        _profile("analysis", 400, 200),
+        _profile("image_prompt", 120, 60),
+    )
+}
+
+@dataclass
+class PromptSection:
+    name: str
+    lines: List[str]
+    # 0 - обязательная секция, дальше чем больше число, тем раньше она отбрасывается
+    priority: int
+    # Заголовок выводится, только если от секции что-то осталось
+    header: Optional[str] = None
+
+@dataclass
+class BudgetReport:
+    kind: str
+    num_ctx: int
+    num_predict: int
+    prompt_tokens: int
+    # Токены по включенным секциям и число отброшенных строк по секциям
+    sections: Dict[str, int] = field(default_factory=dict)
+    dropped: Dict[str, int] = field(default_factory=dict)
+    
+    @property
+    def utilization(self) -> float:
+        return (self.prompt_tokens + self.num_predict) / self.num_ctx
+
+class PromptBudgetStats:
+    """Использование окна по типам запросов"""
+    
+    def __init__(self):
+        self.kinds: Dict[str, Dict] = {}
+    
+    def record(self, report: BudgetReport) -> None:
+        entry = self.kinds.setdefault(report.kind, {
+            "requests": 0,
+            "prompt_tokens": 0,
+            "max_prompt_tokens": 0,
+            "trimmed_requests": 0,
+            "dropped_lines": 0,
+            "shrunk_predict": 0,
+        })
+        entry["requests"] += 1
+        entry["prompt_tokens"] += report.prompt_tokens
+        entry["max_prompt_tokens"] = max(entry["max_prompt_tokens"], report.prompt_tokens)
+        if report.dropped:
+            entry["trimmed_requests"] += 1
+            entry["dropped_lines"] += sum(report.dropped.values())
+        if report.num_predict < REQUEST_PROFILES[report.kind].num_predict:
+            entry["shrunk_predict"] += 1
+        entry["last_utilization"] = round(report.utilization, 3)
+    
+    def get_stats(self) -> Dict:
+        return {
+            "num_ctx": OLLAMA_CONFIG["generation_params"]["num_ctx"],
+            "chars_per_token": round(token_counter.chars_per_token, 3),
+            "kinds": {
+                kind: {**entry, "avg_prompt_tokens": entry["prompt_tokens"] / entry["requests"]}
+                for kind, entry in self.kinds.items()
+            },
+        }
+
+class PromptBuilder:
+    """Собирает промпт в бюджет окна num_ctx.
+    
+    num_ctx один для всех запросов: при смене num_ctx Ollama заново
+    выделяет KV-кэш и перезагружает модель. Под ответ резервируется
+    num_predict профиля, остальное заполняется секциями по приоритету:
+    обязательные входят всегда, у необязательных при нехватке места
+    отбрасываются самые старые строки, затем секция целиком. Если даже
+    обязательным секциям не хватает места, уменьшается num_predict, но
+    не ниже min_predict: сверх этого у обязательных секций отбрасываются
+    самые старые строки (последняя строка секции остается), а если и
+    этого мало, build() выбрасывает PromptOverflow.
+    """
+    
+    def __init__(self, kind: str, num_ctx: Optional[int] = None):
+        self.profile = REQUEST_PROFILES[kind]
+        self.num_ctx = num_ctx or OLLAMA_CONFIG["generation_params"]["num_ctx"]
+        self._fixed_tokens = 0
+        self._sections: List[PromptSection] = []
+        self.report: Optional[BudgetReport] = None
+    
+    def fixed(self, text: str) -> None:
+        """Учитывает текст, который войдет в промпт целиком (инструкции, шаблон)"""
+        self._fixed_tokens += estimate_tokens(text)
+    
+    def add(self, name: str, lines: List[str], priority: int = 0, header: Optional[str] = None) -> None:
+        self._sections.append(PromptSection(name, [line for line in lines if line], priority, header))
+    
+    def _required_counts(self) -> Dict[str, int]:
+        """Сколько строк обязательных секций входит в окно вместе с min_predict"""
+        limit = self.num_ctx - self.profile.min_predict
+        required = [section for section in self._sections if section.priority == 0]
+        counts = {section.name: len(section.lines) for section in required}
+        overflow = self._fixed_tokens - limit + sum(
+            (estimate_tokens(section.header) if section.header and section.lines else 0)
+            + sum(estimate_tokens(line) for line in section.lines)
+            for section in required
+        )
+        # Сначала уходят самые старые строки, последняя строка секции остается всегда
+        for section in required:
+            while overflow > 0 and counts[section.name] > 1:
+                line = section.lines[len(section.lines) - counts[section.name]]
+                overflow -= estimate_tokens(line)
+                counts[section.name] -= 1
+        if overflow > 0:
+            raise PromptOverflow(f"{self.profile.kind}: обязательная часть промпта превышает окно {self.num_ctx} "
+                                 f"на ~{overflow} токенов с учетом min_predict {self.profile.min_predict}")
+        return counts
+    
+    def build(self, separator: str = "\n") -> str:
+        """Возвращает текст включенных секций в порядке добавления"""
+        budget = self.num_ctx - self.profile.num_predict
+        used = self._fixed_tokens
+        kept: Dict[str, List[str]] = {}
+        report = BudgetReport(self.profile.kind, self.num_ctx, self.profile.num_predict, 0)
+        required = self._required_counts()
+        
+        for section in sorted(self._sections, key=lambda s: s.priority):
+            header_tokens = estimate_tokens(section.header) if section.header else 0
+            costs = [estimate_tokens(line) for line in section.lines]
+            if section.priority == 0:
+                count = required[section.name]
+            else:
+                # Берем самые новые строки, пока они помещаются
+                count, total = 0, header_tokens
+                for cost in reversed(costs):
+                    if used + total + cost > budget:
+                        break
+                    total += cost
+                    count += 1
+            if count:
+                kept[section.name] = section.lines[len(section.lines) - count:]
+                tokens = header_tokens + sum(costs[len(costs) - count:])
+                report.sections[section.name] = tokens
+                used += tokens
+            if count < len(section.lines):
+                report.dropped[section.name] = len(section.lines) - count
+        
+        report.prompt_tokens = used
+        if used > budget:
+            report.num_predict = max(self.num_ctx - used, self.profile.min_predict)
+            logger.warning(f"[BUDGET] {self.profile.kind}: промпт ~{used} токенов не оставляет места под ответ, "
+                           f"num_predict снижен до {report.num_predict}")
+        self.report = report
+        prompt_budget_stats.record(report)
+        dropped = ", ".join(f"{name}: -{count}" for name, count in report.dropped.items())
+        logger.info(f"[BUDGET] {report.kind}: промпт ~{used}/{self.num_ctx} токенов, num_predict {report.num_predict}"
+                    + (f", отброшено ({dropped})" if dropped else ""))
+        
+        parts: List[str] = []
+        for section in self._sections:
+            if section.name in kept:
+                if section.header:
+                    parts.append(section.header)
+                parts.extend(kept[section.name])
+        return separator.join(parts)
+    
+    def options(self) -> Dict[str, int]:
+        """num_ctx и num_predict для поля options запроса; вызывать после build()"""
+        num_predict = self.report.num_predict if self.report else self.profile.num_predict
+        return {"num_ctx": self.num_ctx, "num_predict": num_predict}
+
+def request_options(kind: str, text: str) -> Dict[str, int]:
+    """Бюджет для запроса из одного готового промпта"""
+    builder = PromptBuilder(kind)
+    builder.fixed(text)
+    builder.build()
+    return builder.options()
+
+# Создаем экземпляр статистики бюджета промптов
+prompt_budget_stats = PromptBudgetStats()
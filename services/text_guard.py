@@ -0,0 +1,67 @@
+import logging
+import os
+from typing import Dict, Iterable, Optional, Tuple
+from services.json_stream import GuardViolation
+from services.phrase_index import PhraseIndex, split_phrases
+
+logger = logging.getLogger(__name__)
+
+# Следы промпта и разметки, которых не должно быть в тексте сцены
+FORBIDDEN_MARKERS = ("[INST]", "[/INST]", "```", "System:", "User:")
+
+class TextGuard:
+    """Проверки текста сцены, пока модель его пишет.
+    
+    Вызывается JSONGenerator для каждой строки ответа: с недописанным
+    текстом на каждом фрагменте и с итоговым текстом в конце строки.
+    Нарушение (повтор уже использованной фразы, текст не на русском,
+    разметка или лишний вариант выбора) сразу обрывает генерацию.
+    Повторы проверяются по законченным фразам: для полей из fields -
+    с индексом использованных фраз и с фразами этого же ответа.
+    """
+    
+    def __init__(self,
+                 used_phrases: PhraseIndex,
+                 fields: Iterable[str] = ("scene_description", "dialog"),
+                 max_choices: int = 3,
+                 min_letters: Optional[int] = None,
+                 max_latin_share: Optional[float] = None):
+        self.used_phrases = used_phrases
+        self.fields = set(fields)
+        self.max_choices = max_choices
+        self.min_letters = min_letters or int(os.getenv("TEXT_GUARD_MIN_LETTERS", "40"))
+        self.max_latin_share = max_latin_share or float(os.getenv("TEXT_GUARD_MAX_LATIN_SHARE", "0.3"))
+        # Фразы этого ответа: повтор внутри ответа - тоже повтор
+        self.own_phrases = PhraseIndex(threshold=used_phrases.threshold, max_phrases=used_phrases.max_phrases)
+        # путь -> сколько законченных фраз уже проверено
+        self._checked: Dict[Tuple, int] = {}
+    
+    def __call__(self, path: Tuple, text: str, complete: bool) -> None:
+        if path and path[0] == "choices" and len(path) > 1 and path[1] >= self.max_choices:
+            raise GuardViolation(f"больше {self.max_choices} вариантов выбора")
+        for marker in FORBIDDEN_MARKERS:
+            if marker in text:
+                raise GuardViolation(f"разметка {marker!r} в {'.'.join(map(str, path))}")
+        self._check_language(path, text)
+        if path and path[0] in self.fields:
+            self._check_repetition(path, text, complete)
+    
+    def _check_language(self, path: Tuple, text: str) -> None:
+        letters = [ch for ch in text if ch.isalpha()]
+        if len(letters) < self.min_letters:
+            return
+        latin = sum(1 for ch in letters if ch.isascii())
+        if latin / len(letters) > self.max_latin_share:
+            raise GuardViolation(f"{'.'.join(map(str, path))}: текст не на русском")
+    
+    def _check_repetition(self, path: Tuple, text: str, complete: bool) -> None:
+        # Пока строка не дописана, последняя фраза может быть оборвана
+        finished = text if complete else text[:text.rfind('.') + 1]
+        phrases = split_phrases(finished)
+        checked = self._checked.get(path, 0)
+        for phrase in phrases[checked:]:
+            similar = self.used_phrases.find_similar(phrase) or self.own_phrases.find_similar(phrase)
+            if similar is not None:
+                raise GuardViolation(f"повтор фразы {phrase[:40]!r}")
+            self.own_phrases.add(phrase)
+        self._checked[path] = len(phrases)
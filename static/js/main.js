@@ -1,11 +1,13 @@
 let ws = null;
 let currentStory = null;
 let isGenerating = false;  // Флаг для предотвращения множественных запросов
+let sessionToken = localStorage.getItem('storySessionToken');  // Токен для продолжения истории
 
 // Инициализация WebSocket соединения
 function initWebSocket() {
     console.log('Initializing WebSocket...');
-    ws = new WebSocket(`ws://${window.location.host}/ws`);
+    const query = sessionToken ? `?session=${encodeURIComponent(sessionToken)}` : '';
+    ws = new WebSocket(`ws://${window.location.host}/ws${query}`);
     
     ws.onopen = () => {
         console.log('WebSocket connected');
@@ -19,7 +21,10 @@ function initWebSocket() {
             const data = JSON.parse(event.data);
             console.log('Parsed data:', data);
             
-            if (data.type === 'story_start') {
+            if (data.type === 'session') {
+                sessionToken = data.token;
+                localStorage.setItem('storySessionToken', sessionToken);
+            } else if (data.type === 'story_start') {
                 handleStoryStart(data.data);
             } else if (data.type === 'story_update') {
                 handleStoryUpdate(data.data);
@@ -0,0 +1,61 @@
+import logging
+import unittest
+from benchmarks.cases import get_cases
+from benchmarks.run import check_regressions, measure
+from app.services.ollama.story_generator import merge_story_context
+
+def report(**medians):
+    return {
+        "commit": "test",
+        "results": {
+            name: {"min_us": value, "median_us": value, "threshold_us": 100.0}
+            for name, value in medians.items()
+        }
+    }
+
+class TestBenchmarks(unittest.TestCase):
+    def setUp(self):
+        logging.disable(logging.INFO)
+    
+    def tearDown(self):
+        logging.disable(logging.NOTSET)
+    
+    def test_all_cases_run(self):
+        """Каждый бенчмарк выполняется без сети и дает замер"""
+        for case in get_cases():
+            with self.subTest(case=case.name):
+                result = measure(case, repeat=1, min_time=0.0)
+                self.assertGreater(result["median_us"], 0)
+    
+    def test_unknown_case(self):
+        with self.assertRaises(ValueError):
+            get_cases(["nope"])
+    
+    def test_threshold_regression(self):
+        problems = check_regressions(report(fast=10.0, slow=150.0))
+        self.assertEqual(len(problems), 1)
+        self.assertTrue(problems[0].startswith("slow"))
+    
+    def test_compare_regression(self):
+        baseline = report(a=10.0, b=10.0)
+        problems = check_regressions(report(a=12.0, b=14.0, new=5.0), baseline, tolerance=0.25)
+        self.assertEqual(len(problems), 1)
+        self.assertTrue(problems[0].startswith("b"))
+
+class TestMergeStoryContext(unittest.TestCase):
+    def test_merge(self):
+        story_context = {"current_state": {}, "timeline": ["Встреча у реки"]}
+        analysis = {
+            "character": {"gender": "женский", "age": "", "name": "Анна"},
+            "location": "Мост",
+            "time": None,
+            "events": ["Встреча у реки", "Найден ключ", ""],
+        }
+        merge_story_context(analysis, "Открыть дверь", story_context)
+        self.assertEqual(story_context["timeline"], ["Встреча у реки", "Найден ключ", "Выбор: Открыть дверь"])
+        self.assertEqual(story_context["current_state"]["name"], "Анна")
+        self.assertEqual(story_context["current_state"]["current_location"], "Мост")
+        self.assertNotIn("age", story_context["current_state"])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,129 @@
+import asyncio
+import json
+import unittest
+import aiohttp
+from aiohttp import web
+from app.core.cancellation import CancellationStats, cancellation_stats
+from app.services.comfy.events import ComfyEventListener
+from app.services.comfy.render_queue import RenderQueue
+from app.services.ollama.segment_events import SegmentEventType
+from app.services.ollama.story_generator import generate_next_segment
+from services.llm_scheduler import llm_scheduler
+from services.ollama_connection import ollama_connection
+
+class StubServer:
+    """Ollama с бесконечным потоком и ComfyUI с очередью"""
+    
+    def __init__(self):
+        self.disconnected = asyncio.Event()
+        self.queue = {"queue_running": [[1, "running-id", {}]], "queue_pending": [[2, "pending-id", {}]]}
+        self.deleted = []
+        self.interrupted = []
+    
+    async def generate(self, request):
+        response = web.StreamResponse(headers={"Content-Type": "application/x-ndjson"})
+        await response.prepare(request)
+        try:
+            while True:
+                chunk = {"response": "Туман стелился над замком. ", "done": False}
+                await response.write(json.dumps(chunk, ensure_ascii=False).encode("utf-8") + b"\n")
+                await asyncio.sleep(0.02)
+        except (ConnectionResetError, asyncio.CancelledError):
+            self.disconnected.set()
+        return response
+    
+    async def get_queue(self, request):
+        return web.json_response(self.queue)
+    
+    async def post_queue(self, request):
+        self.deleted.extend((await request.json())["delete"])
+        return web.json_response({})
+    
+    async def interrupt(self, request):
+        self.interrupted.append((await request.json()).get("prompt_id"))
+        return web.json_response({})
+    
+    async def start(self) -> str:
+        app = web.Application()
+        app.router.add_post('/api/generate', self.generate)
+        app.router.add_get('/queue', self.get_queue)
+        app.router.add_post('/queue', self.post_queue)
+        app.router.add_post('/interrupt', self.interrupt)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, '127.0.0.1', 0)
+        await site.start()
+        return f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}"
+
+class SlowQueue(RenderQueue):
+    def __init__(self):
+        super().__init__(window=0.01)
+        self.render_cancelled = asyncio.Event()
+    
+    async def _render_batch(self, workflows):
+        try:
+            await asyncio.sleep(30)
+        except asyncio.CancelledError:
+            self.render_cancelled.set()
+            raise
+
+class TestCancellationStats(unittest.TestCase):
+    def test_saved_seconds(self):
+        stats = CancellationStats()
+        self.assertEqual(stats.cancelled("comfyui", 1.0), 0.0)
+        stats.completed("comfyui", 10.0)
+        stats.completed("comfyui", 20.0)
+        self.assertEqual(stats.cancelled("comfyui", 5.0), 10.0)
+        self.assertEqual(stats.cancelled("comfyui", 40.0), 0.0)
+        self.assertEqual(stats.get_stats()["gpu_seconds_saved"], 10.0)
+
+class TestCancellation(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.stub = StubServer()
+        self.base_url = await self.stub.start()
+        self.original_url = ollama_connection.base_url
+        ollama_connection.base_url = self.base_url
+    
+    async def asyncTearDown(self):
+        ollama_connection.base_url = self.original_url
+        await ollama_connection.close()
+        await self.stub.runner.cleanup()
+    
+    async def test_closing_segment_aborts_ollama_stream(self):
+        """Прерванный сегмент сразу закрывает поток Ollama и освобождает место в очереди"""
+        context = {"current_chapter": 1, "previous_choices": [], "timeline": []}
+        cancelled_before = cancellation_stats.get_stats()["kinds"].get("ollama", {}).get("cancelled", 0)
+        events = generate_next_segment("Открыть ворота", context)
+        event = await asyncio.wait_for(events.__anext__(), timeout=10)
+        self.assertEqual(event["type"], SegmentEventType.TEXT)
+        
+        await events.aclose()
+        await asyncio.wait_for(self.stub.disconnected.wait(), timeout=5)
+        self.assertEqual(llm_scheduler.active, 0)
+        self.assertEqual(cancellation_stats.get_stats()["kinds"]["ollama"]["cancelled"], cancelled_before + 1)
+    
+    async def test_cancel_prompt(self):
+        events = ComfyEventListener(base_url=self.base_url)
+        async with aiohttp.ClientSession() as session:
+            self.assertEqual(await events.cancel_prompt("pending-id", session), "deleted")
+            self.assertEqual(await events.cancel_prompt("running-id", session), "interrupted")
+            self.assertIsNone(await events.cancel_prompt("finished-id", session))
+        self.assertEqual(self.stub.deleted, ["pending-id"])
+        self.assertEqual(self.stub.interrupted, ["running-id"])
+    
+    async def test_abandoned_batch_cancelled(self):
+        """Пакет отменяется, только когда картинки не нужны ни одной сессии"""
+        queue = SlowQueue()
+        first = asyncio.ensure_future(queue.render({"6": {"inputs": {"text": "a"}}}))
+        second = asyncio.ensure_future(queue.render({"6": {"inputs": {"text": "b"}}}))
+        await asyncio.sleep(0.05)
+        first.cancel()
+        await asyncio.sleep(0.05)
+        self.assertFalse(queue.render_cancelled.is_set())
+        second.cancel()
+        await asyncio.wait_for(queue.render_cancelled.wait(), timeout=1)
+        await asyncio.sleep(0)
+        self.assertEqual(queue.stats["cancelled_batches"], 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -36,6 +36,10 @@ class TestComfyUIConfig(unittest.TestCase):
         self.assertEqual(workflow["3"]["inputs"]["seed"], test_seed)
         self.assertEqual(workflow["5"]["inputs"]["width"], 768)
         self.assertEqual(workflow["5"]["inputs"]["height"], 768)
+        
+        # Шаблон не меняется: следующая задача получает исходные параметры
+        self.assertNotEqual(self.config.default_workflow["6"]["inputs"]["text"], test_prompt)
+        self.assertNotEqual(self.config.default_workflow["3"]["inputs"]["seed"], test_seed)
 
 if __name__ == '__main__':
     unittest.main()
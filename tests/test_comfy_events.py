@@ -0,0 +1,123 @@
+import asyncio
+import json
+import unittest
+import aiohttp
+from aiohttp import web
+from app.services.comfy.events import ComfyEventListener, ComfyUIExecutionError
+
+IMAGE_OUTPUT = {"images": [{"filename": "ComfyUI_00001_.png", "type": "output"}]}
+
+class StubComfyUI:
+    """Заглушка ComfyUI: /ws с событиями и /history"""
+    
+    def __init__(self, with_ws: bool = True, fail: bool = False):
+        self.with_ws = with_ws
+        self.fail = fail
+        self.sockets = []
+        self.history = {}
+        self.history_requests = 0
+    
+    async def ws_handler(self, request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        self.sockets.append(ws)
+        async for _ in ws:
+            pass
+        return ws
+    
+    async def history_handler(self, request):
+        self.history_requests += 1
+        prompt_id = request.match_info['prompt_id']
+        return web.json_response({prompt_id: self.history[prompt_id]} if prompt_id in self.history else {})
+    
+    async def run_prompt(self, prompt_id: str) -> None:
+        """Имитирует выполнение задачи и рассылку событий"""
+        events = [
+            {"type": "execution_start", "data": {"prompt_id": prompt_id}},
+            {"type": "progress", "data": {"prompt_id": prompt_id, "node": "3", "value": 1, "max": 1}},
+        ]
+        if self.fail:
+            events.append({"type": "execution_error", "data": {"prompt_id": prompt_id, "exception_message": "OOM"}})
+        else:
+            events.append({"type": "executed", "data": {"prompt_id": prompt_id, "node": "9", "output": IMAGE_OUTPUT}})
+            events.append({"type": "executing", "data": {"prompt_id": prompt_id, "node": None}})
+        for ws in self.sockets:
+            for event in events:
+                await ws.send_str(json.dumps(event))
+        self.history[prompt_id] = {"outputs": {"9": IMAGE_OUTPUT}, "status": {"completed": True}}
+    
+    async def start(self) -> str:
+        app = web.Application()
+        if self.with_ws:
+            app.router.add_get('/ws', self.ws_handler)
+        app.router.add_get('/history/{prompt_id}', self.history_handler)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, '127.0.0.1', 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        return f"http://127.0.0.1:{port}"
+    
+    async def stop(self) -> None:
+        for ws in self.sockets:
+            await ws.close()
+        await self.runner.cleanup()
+
+class TestComfyEventListener(unittest.IsolatedAsyncioTestCase):
+    async def start_stub(self, **kwargs):
+        self.stub = StubComfyUI(**kwargs)
+        base_url = await self.stub.start()
+        self.listener = ComfyEventListener(base_url)
+        self.session = aiohttp.ClientSession()
+    
+    async def asyncTearDown(self):
+        await self.listener.stop()
+        await self.session.close()
+        await self.stub.stop()
+    
+    async def test_completion_event_resolves_without_polling(self):
+        """Завершение приходит событием, /history не опрашивается"""
+        await self.start_stub()
+        self.assertTrue(await self.listener.ensure_connected())
+        progress = []
+        waiter = asyncio.create_task(self.listener.wait_for_prompt(
+            "p1", self.session, timeout=5, on_progress=lambda event, data: progress.append(event)))
+        await asyncio.sleep(0.05)
+        await self.stub.run_prompt("p1")
+        outputs = await asyncio.wait_for(waiter, timeout=1)
+        self.assertEqual(outputs["9"], IMAGE_OUTPUT)
+        self.assertIn("progress", progress)
+        self.assertEqual(self.stub.history_requests, 0)
+        self.assertEqual(self.listener.stats["completed_via_ws"], 1)
+    
+    async def test_event_before_wait_is_not_lost(self):
+        """Событие, пришедшее раньше ожидания, не теряется"""
+        await self.start_stub()
+        await self.listener.ensure_connected()
+        await self.stub.run_prompt("p2")
+        await asyncio.sleep(0.1)
+        outputs = await self.listener.wait_for_prompt("p2", self.session, timeout=1)
+        self.assertEqual(outputs["9"], IMAGE_OUTPUT)
+    
+    async def test_execution_error(self):
+        """execution_error завершает ожидание исключением"""
+        await self.start_stub(fail=True)
+        await self.listener.ensure_connected()
+        waiter = asyncio.create_task(self.listener.wait_for_prompt("p3", self.session, timeout=5))
+        await asyncio.sleep(0.05)
+        await self.stub.run_prompt("p3")
+        with self.assertRaises(ComfyUIExecutionError):
+            await asyncio.wait_for(waiter, timeout=1)
+    
+    async def test_polling_fallback_without_websocket(self):
+        """Без WebSocket результат берется из /history"""
+        await self.start_stub(with_ws=False)
+        self.listener.poll_interval_disconnected = 0.05
+        self.assertFalse(await self.listener.ensure_connected(timeout=0.2))
+        await self.stub.run_prompt("p4")
+        outputs = await self.listener.wait_for_prompt("p4", self.session, timeout=2)
+        self.assertEqual(outputs["9"], IMAGE_OUTPUT)
+        self.assertEqual(self.listener.stats["completed_via_poll"], 1)
+
+if __name__ == '__main__':
+    unittest.main()
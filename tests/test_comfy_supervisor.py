@@ -0,0 +1,139 @@
+import asyncio
+import os
+import socket
+import sys
+import tempfile
+import unittest
+from app.core.worker_registry import WorkerRegistry
+from app.services.comfy.supervisor import ComfyUISupervisor
+
+# Минимальный "ComfyUI": отвечает 200 на /system_stats
+STUB_SERVER = """
+import sys
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+class Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.send_response(200 if self.path == '/system_stats' else 404)
+        self.send_header('Content-Type', 'application/json')
+        self.end_headers()
+        self.wfile.write(b'{}')
+
+    def log_message(self, *args):
+        pass
+
+HTTPServer(('127.0.0.1', int(sys.argv[1])), Handler).serve_forever()
+"""
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+class TestComfyUISupervisor(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        with open(os.path.join(self.tmpdir.name, 'main.py'), 'w') as f:
+            f.write(STUB_SERVER)
+        port = free_port()
+        self.registry = WorkerRegistry(os.path.join(self.tmpdir.name, 'registry.db'))
+        self.supervisor = ComfyUISupervisor(
+            command=[sys.executable, 'main.py', str(port)],
+            cwd=self.tmpdir.name,
+            base_url=f"http://127.0.0.1:{port}",
+            idle_timeout=0.2,
+            startup_timeout=10,
+            registry=self.registry,
+            log_file=os.path.join(self.tmpdir.name, 'comfyui.log')
+        )
+
+    async def asyncTearDown(self):
+        await self.supervisor.shutdown()
+        self.registry.close()
+        self.tmpdir.cleanup()
+
+    async def test_concurrent_sessions_share_one_process(self):
+        """Параллельные сессии используют один и тот же процесс"""
+        async def use():
+            async with self.supervisor.acquire():
+                await asyncio.sleep(0.1)
+                return self.supervisor.process.pid
+
+        pids = await asyncio.gather(use(), use(), use())
+        self.assertEqual(len(set(pids)), 1)
+        self.assertEqual(self.supervisor.stats["starts"], 1)
+
+        # Повторное обращение до idle_timeout попадает в прогретый процесс
+        async with self.supervisor.acquire():
+            self.assertEqual(self.supervisor.process.pid, pids[0])
+        self.assertEqual(self.supervisor.stats["starts"], 1)
+
+    async def test_idle_shutdown(self):
+        """После простоя процесс останавливается"""
+        async with self.supervisor.acquire():
+            self.assertTrue(self.supervisor.is_ready)
+        await asyncio.sleep(0.5)
+        self.assertIsNone(self.supervisor.process)
+        self.assertEqual(self.supervisor.stats["idle_shutdowns"], 1)
+
+    async def test_crash_restart(self):
+        """Упавший процесс перезапускается, пока им пользуются"""
+        async with self.supervisor.acquire():
+            first_pid = self.supervisor.process.pid
+            self.supervisor.process.kill()
+            for _ in range(100):
+                await asyncio.sleep(0.1)
+                if self.supervisor.is_ready and self.supervisor.process.pid != first_pid:
+                    break
+            self.assertEqual(self.supervisor.stats["crashes"], 1)
+            self.assertEqual(self.supervisor.stats["restarts"], 1)
+            self.assertNotEqual(self.supervisor.process.pid, first_pid)
+
+    async def test_second_worker_shares_process(self):
+        """Второй воркер использует процесс первого, и тот не останавливается под ним"""
+        other = ComfyUISupervisor(
+            command=self.supervisor.comfyui_command,
+            cwd=self.tmpdir.name,
+            base_url=self.supervisor.base_url,
+            idle_timeout=0.2,
+            registry=WorkerRegistry(self.registry.path)
+        )
+        async with self.supervisor.acquire():
+            pid = self.supervisor.process.pid
+        async with other.acquire():
+            self.assertTrue(other.is_external)
+            self.assertIsNone(other.process)
+            await asyncio.sleep(0.5)
+            # Владелец простаивает дольше idle_timeout, но процесс нужен второму воркеру
+            self.assertEqual(self.supervisor.process.pid, pid)
+        await asyncio.sleep(0.5)
+        self.assertIsNone(self.supervisor.process)
+        self.assertEqual(self.supervisor.stats["starts"], 1)
+        await other.shutdown()
+        other.registry.close()
+
+    async def test_shutdown_leaves_process_to_other_worker(self):
+        """Остановка воркера не убивает ComfyUI, пока им пользуется другой воркер"""
+        other = ComfyUISupervisor(
+            command=self.supervisor.comfyui_command,
+            cwd=self.tmpdir.name,
+            base_url=self.supervisor.base_url,
+            registry=WorkerRegistry(self.registry.path)
+        )
+        async with self.supervisor.acquire():
+            pass
+        async with other.acquire():
+            await self.supervisor.shutdown()
+            self.assertEqual(self.supervisor.stats["handed_over"], 1)
+            self.assertIsNone(self.supervisor.process.returncode)
+            # Процесс в своей сессии и пишет в файл: выход этого воркера его не затронет
+            self.assertNotEqual(os.getsid(self.supervisor.process.pid), os.getsid(0))
+            self.assertTrue(os.path.exists(self.supervisor.log_file))
+            self.assertTrue(await other.probe())
+        other.registry.close()
+        # Без аренд процесс останавливается
+        await self.supervisor.shutdown()
+        self.assertIsNone(self.supervisor.process)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,76 @@
+import json
+import unittest
+from aiohttp import web
+from app.services.ollama.conversation import ConversationState, conversation_stats
+from app.services.ollama.story_generator import open_story_stream
+from services.ollama_connection import ollama_connection
+
+class TestConversationState(unittest.TestCase):
+    def test_continuation_after_full_prompt(self):
+        """После первого ответа отправляется только продолжение с context"""
+        state = ConversationState(num_ctx=4096, reserve_tokens=1000, enabled=True)
+        prompt, context = state.prepare("полный промпт", "выбор")
+        self.assertEqual((prompt, context), ("полный промпт", None))
+        state.record({"done": True, "context": [1, 2, 3], "prompt_eval_count": 1200}, used_context=False)
+        
+        saved_before = conversation_stats.stats["prefill_tokens_saved"]
+        prompt, context = state.prepare("полный промпт", "выбор")
+        self.assertEqual((prompt, context), ("выбор", [1, 2, 3]))
+        state.record({"done": True, "context": [1, 2, 3, 4], "prompt_eval_count": 50}, used_context=True)
+        self.assertEqual(conversation_stats.stats["prefill_tokens_saved"] - saved_before, 1150)
+        self.assertEqual(state.context, [1, 2, 3, 4])
+    
+    def test_overflow_falls_back_to_full_prompt(self):
+        state = ConversationState(num_ctx=100, reserve_tokens=50, enabled=True)
+        state.context = list(range(80))
+        prompt, context = state.prepare("полный промпт", "выбор")
+        self.assertIsNone(context)
+        self.assertIsNone(state.context)
+    
+    def test_fork_is_independent(self):
+        state = ConversationState(enabled=True)
+        state.context = [1, 2]
+        branch = state.fork()
+        branch.record({"context": [1, 2, 3]}, used_context=True)
+        self.assertEqual(state.context, [1, 2])
+
+class TestOpenStoryStream(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.requests = []
+        app = web.Application()
+        app.router.add_post('/api/generate', self.generate)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, '127.0.0.1', 0)
+        await site.start()
+        self.original_url = ollama_connection.base_url
+        ollama_connection.base_url = f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}"
+    
+    async def asyncTearDown(self):
+        ollama_connection.base_url = self.original_url
+        await ollama_connection.close()
+        await self.runner.cleanup()
+    
+    async def generate(self, request):
+        data = await request.json()
+        self.requests.append(data)
+        # Имитируем отказ от устаревшего context
+        if "context" in data:
+            return web.Response(status=400, text="invalid context")
+        return web.Response(text=json.dumps({"response": "", "done": True, "context": [7]}) + "\n")
+    
+    async def test_rejected_context_falls_back(self):
+        """Если Ollama отклонила context, запрос повторяется полным промптом"""
+        state = ConversationState(enabled=True)
+        state.context = [1, 2, 3]
+        params = {"model": "m", "prompt": "полный промпт", "stream": True}
+        async with open_story_stream(params, state, "налево") as (response, used_context):
+            self.assertEqual(response.status, 200)
+            self.assertFalse(used_context)
+        self.assertEqual(len(self.requests), 2)
+        self.assertIn("налево", self.requests[0]["prompt"])
+        self.assertEqual(self.requests[1]["prompt"], "полный промпт")
+        self.assertIsNone(state.context)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,138 @@
+import os
+import tempfile
+import time
+import unittest
+from aiohttp import web
+from app.core.worker_registry import WorkerRegistry
+from app.services.gpu.scheduler import GPUResidencyScheduler, GPUStage
+from app.services.gpu.telemetry import GPUTelemetry
+from config.ollama_config import OLLAMA_CONFIG
+from services.ollama_connection import OllamaConnection
+
+MB = 1024 * 1024
+
+class StubGPU:
+    """Заглушка ComfyUI и Ollama на одной видеокарте"""
+    
+    def __init__(self, total_mb: int, comfy_mb: int, ollama_mb: int):
+        self.total_mb = total_mb
+        self.comfy_mb = comfy_mb
+        self.ollama_mb = ollama_mb
+        self.free_calls = 0
+        self.unload_calls = 0
+    
+    async def system_stats(self, request):
+        free = self.total_mb - self.comfy_mb - self.ollama_mb
+        return web.json_response({"devices": [{"vram_total": self.total_mb * MB, "vram_free": free * MB}]})
+    
+    async def free(self, request):
+        self.free_calls += 1
+        self.comfy_mb = 0
+        return web.json_response({})
+    
+    async def ps(self, request):
+        models = []
+        if self.ollama_mb:
+            models.append({"name": OLLAMA_CONFIG['model'], "size_vram": self.ollama_mb * MB})
+        return web.json_response({"models": models})
+    
+    async def generate(self, request):
+        data = await request.json()
+        if data.get("keep_alive") == 0:
+            self.unload_calls += 1
+            self.ollama_mb = 0
+        return web.json_response({"done": True, "done_reason": "unload"})
+    
+    async def start(self) -> str:
+        app = web.Application()
+        app.router.add_get('/system_stats', self.system_stats)
+        app.router.add_post('/free', self.free)
+        app.router.add_get('/api/ps', self.ps)
+        app.router.add_post('/api/generate', self.generate)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, '127.0.0.1', 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        return f"http://127.0.0.1:{port}"
+
+class TestGPUResidencyScheduler(unittest.IsolatedAsyncioTestCase):
+    async def start_stub(self, total_mb: int, comfy_mb: int, ollama_mb: int):
+        self.stub = StubGPU(total_mb, comfy_mb, ollama_mb)
+        base_url = await self.stub.start()
+        self.ollama = OllamaConnection(base_url)
+        self.tmp = tempfile.TemporaryDirectory()
+        self.registry = WorkerRegistry(os.path.join(self.tmp.name, "registry.db"))
+        self.scheduler = GPUResidencyScheduler(
+            comfy_url=base_url,
+            ollama=self.ollama,
+            text_model_mb=5000,
+            image_model_mb=3000,
+            reserve_mb=500,
+            registry=self.registry
+        )
+    
+    async def asyncTearDown(self):
+        await self.ollama.close()
+        await self.stub.runner.cleanup()
+        self.registry.close()
+        self.tmp.cleanup()
+    
+    async def test_both_models_fit(self):
+        """Если памяти хватает на обе модели, ничего не выгружается"""
+        await self.start_stub(total_mb=12000, comfy_mb=0, ollama_mb=5000)
+        decision = await self.scheduler.prepare(GPUStage.IMAGE)
+        await self.scheduler.mark_loaded(GPUStage.IMAGE)
+        self.assertEqual(decision.action, "keep")
+        self.assertTrue(decision.fits)
+        
+        decision = await self.scheduler.prepare(GPUStage.TEXT)
+        self.assertEqual(decision.action, "keep")
+        self.assertEqual(self.stub.unload_calls, 0)
+        self.assertEqual(self.stub.free_calls, 0)
+        self.assertEqual(self.scheduler.get_stats()["kept_resident"], 2)
+    
+    async def test_image_evicts_ollama_when_short(self):
+        """Для картинки Ollama выгружается, только если иначе не хватит памяти"""
+        await self.start_stub(total_mb=8000, comfy_mb=0, ollama_mb=5000)
+        decision = await self.scheduler.prepare(GPUStage.IMAGE)
+        self.assertEqual(decision.action, "evict_ollama")
+        self.assertTrue(decision.fits)
+        self.assertEqual(decision.free_after_mb, 8000)
+        self.assertEqual(self.stub.unload_calls, 1)
+        self.assertEqual(self.scheduler.get_stats()["evicted_ollama"], 1)
+    
+    async def test_text_evicts_comfyui_when_short(self):
+        """Для текста выгружается ComfyUI, если модели Ollama нет в памяти"""
+        await self.start_stub(total_mb=8000, comfy_mb=3000, ollama_mb=0)
+        await self.scheduler.mark_loaded(GPUStage.IMAGE)
+        decision = await self.scheduler.prepare(GPUStage.TEXT)
+        self.assertEqual(decision.action, "evict_comfyui")
+        self.assertEqual(self.stub.free_calls, 1)
+        self.assertFalse(self.scheduler.comfy_resident)
+    
+    async def test_comfyui_down_text_keeps(self):
+        """Без ComfyUI текстовому этапу вытеснять нечего"""
+        await self.start_stub(total_mb=8000, comfy_mb=0, ollama_mb=0)
+        self.scheduler.comfy_url = "http://127.0.0.1:1"
+        decision = await self.scheduler.prepare(GPUStage.TEXT)
+        self.assertEqual(decision.action, "keep")
+        self.assertIsNone(decision.free_mb)
+    
+    async def test_image_uses_fresh_telemetry(self):
+        """Свежая телеметрия GPU важнее /system_stats: по ней видно чужие процессы на видеокарте"""
+        await self.start_stub(total_mb=12000, comfy_mb=0, ollama_mb=5000)
+        telemetry = GPUTelemetry(source="", max_age=5)
+        # Занято 10000 из 12000 МБ, хотя ComfyUI считает свободными 7000
+        telemetry.feed(f"{time.time():.6f}: bus 03, gpu 5.00%, vram 83.33% 10000.00mb, sclk 3.89% 0.068ghz")
+        self.scheduler.telemetry = telemetry
+        decision = await self.scheduler.prepare(GPUStage.IMAGE)
+        self.assertEqual(decision.vram_source, "telemetry")
+        self.assertAlmostEqual(decision.free_mb, 2000, delta=5)
+        self.assertEqual(decision.action, "evict_ollama")
+        # Отсчета после выгрузки нет - память после нее читается из ComfyUI
+        self.assertEqual(decision.free_after_mb, 12000)
+        self.assertEqual([window.name for window in telemetry.stages], ["prepare.image.evict_ollama"])
+
+if __name__ == '__main__':
+    unittest.main()
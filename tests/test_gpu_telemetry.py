@@ -0,0 +1,72 @@
+import asyncio
+import os
+import tempfile
+import time
+import unittest
+from app.services.gpu.telemetry import GPUTelemetry, StageWindow, parse_line
+
+def radeontop_line(timestamp: float, gpu: float, vram_mb: float, total_mb: float = 8124.0) -> str:
+    return (
+        f"{timestamp:.6f}: bus 03, gpu {gpu:.2f}%, ee 0.00%, vgt 1.67%, ta 1.67%, sx 1.67%, sh 1.67%, "
+        f"spi 1.67%, sc 1.67%, pa 0.00%, db 1.67%, cb 1.67%, vram {vram_mb / total_mb * 100:.2f}% {vram_mb:.2f}mb, "
+        f"gtt 0.76% 60.06mb, mclk 100.00% 0.875ghz, sclk 3.89% 0.068ghz\n"
+    )
+
+class TestGPUTelemetry(unittest.IsolatedAsyncioTestCase):
+    def test_parse_radeontop_line(self):
+        sample = parse_line(
+            "1732769289.199306: bus 03, gpu 2.50%, ee 0.00%, vgt 1.67%, ta 1.67%, sx 1.67%, sh 1.67%, "
+            "spi 1.67%, sc 1.67%, pa 0.00%, db 1.67%, cb 1.67%, vram 53.68% 4361.34mb, gtt 0.76% 60.06mb, "
+            "mclk 100.00% 0.875ghz, sclk 3.89% 0.068ghz"
+        )
+        self.assertEqual(sample.timestamp, 1732769289.199306)
+        self.assertEqual(sample.gpu_percent, 2.5)
+        self.assertEqual((sample.vram_percent, sample.vram_mb), (53.68, 4361.34))
+        self.assertEqual(sample.sclk_ghz, 0.068)
+        self.assertIsNone(parse_line("Dumping to -, until termination."))
+        self.assertIsNone(parse_line("1732769290.1: bus 03, gpu 2.50%, vram 53"))
+    
+    def test_ring_buffer_wraps_and_profiles_stage(self):
+        telemetry = GPUTelemetry(source="", capacity=8)
+        # Ollama выгружается (6000 -> 2000 МБ), затем грузится модель ComfyUI (2000 -> 5000 МБ)
+        vram = [6000, 6000, 6000, 4000, 2000, 2000, 3500, 5000, 5000, 5000, 5000, 5000]
+        telemetry.feed_lines(radeontop_line(100.0 + i, 50.0, mb) for i, mb in enumerate(vram))
+        telemetry.feed("мусор\n")
+        self.assertEqual(len(telemetry.samples), 8)
+        self.assertEqual(list(telemetry.samples.column(0)), [104.0 + i for i in range(8)])
+        self.assertEqual(telemetry.stats["parse_errors"], 1)
+        
+        image = telemetry.profile(StageWindow("image", 105.5, 107.5))
+        self.assertEqual(image["vram_start_mb"], 2000)
+        self.assertEqual(image["vram_end_mb"], 5000)
+        self.assertEqual(image["vram_delta_mb"], 3000)
+        self.assertEqual(image["samples"], 2)
+        # Начало этапа вытеснено из буфера - до него нет отсчета
+        self.assertIsNone(telemetry.profile(StageWindow("swap", 100.5, 103.5)))
+        
+        telemetry.stages.append(StageWindow("image", 105.5, 107.5))
+        self.assertEqual(telemetry.get_stats()["stages"]["image"]["vram_delta_mb"], 3000)
+    
+    async def test_follow_file_and_fresh_vram(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "radeontop.log")
+            with open(path, "w") as f:
+                # Старые строки файла не читаются: телеметрия начинает с конца
+                f.write(radeontop_line(time.time() - 100, 1.0, 1000.0))
+            telemetry = GPUTelemetry(source=path, max_age=5)
+            telemetry.start()
+            try:
+                await asyncio.sleep(0.1)
+                self.assertIsNone(telemetry.vram())
+                since = time.time()
+                with open(path, "a") as f:
+                    f.write(radeontop_line(time.time(), 40.0, 2124.0))
+                vram = await telemetry.wait_vram(since, timeout=3)
+            finally:
+                await telemetry.stop()
+        self.assertEqual(telemetry.stats["samples"], 1)
+        self.assertAlmostEqual(vram["total_mb"], 8124, delta=5)
+        self.assertAlmostEqual(vram["free_mb"], 6000, delta=5)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,65 @@
+import os
+import tempfile
+import unittest
+from config.comfy_config import ComfyUIConfig
+from app.services.image_generation.illustration_cache import IllustrationCache, workflow_key
+from app.services.image_generation.image_store import ImageStore
+
+class TestIllustrationCache(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.root = os.path.join(self.tmp.name, "cache")
+        self.store = ImageStore(os.path.join(self.tmp.name, "images"))
+        self.config = ComfyUIConfig()
+    
+    def tearDown(self):
+        self.tmp.cleanup()
+    
+    async def image(self, name: str, size: int):
+        return await self.store.save(name.encode() * (size // len(name)))
+    
+    async def test_hit_after_put(self):
+        cache = IllustrationCache(self.root, max_bytes=10_000, store=self.store)
+        workflow = self.config.modify_workflow("A mysterious scene with dark atmosphere")
+        self.assertIsNone(await cache.get(workflow))
+        
+        image = await self.image("first.png", 100)
+        await cache.put(workflow, image)
+        # Ключ - итоговый workflow: тот же промпт и сид дают попадание, другой сид - нет
+        self.assertEqual(await cache.get(self.config.modify_workflow("A mysterious scene with dark atmosphere")), image)
+        self.assertIsNone(await cache.get(self.config.modify_workflow("A mysterious scene with dark atmosphere", seed=1)))
+        self.assertEqual(cache.stats["hits"], 1)
+        self.assertEqual(cache.stats["misses"], 2)
+        self.assertEqual([n for n in os.listdir(os.path.join(self.root, workflow_key(workflow)[:2])) if n.endswith(".tmp")], [])
+        # Картинка хранится один раз - в хранилище изображений, кэш только ссылается на нее
+        self.assertEqual(self.store.stats["saved"], 1)
+        self.assertFalse(any(n.endswith(".png") for _, _, files in os.walk(self.root) for n in files))
+    
+    async def test_entry_dropped_when_image_collected(self):
+        cache = IllustrationCache(self.root, max_bytes=10_000, store=self.store)
+        workflow = self.config.modify_workflow("castle")
+        image = await self.image("gone", 100)
+        await cache.put(workflow, image)
+        os.unlink(self.store.path_for(image.digest))
+        
+        self.assertIsNone(await cache.get(workflow))
+        self.assertEqual(cache.get_stats()["entries"], 0)
+    
+    async def test_lru_eviction_survives_restart(self):
+        cache = IllustrationCache(self.root, max_bytes=250, store=self.store)
+        first, second, third = (self.config.modify_workflow(p) for p in ("castle", "forest", "sea"))
+        await cache.put(first, await self.image("aaaa", 100))
+        await cache.put(second, await self.image("bbbb", 100))
+        # first использован недавно - вытесняется second
+        self.assertIsNotNone(await cache.get(first))
+        await cache.put(third, await self.image("cccc", 100))
+        self.assertEqual(cache.stats["evictions"], 1)
+        self.assertIsNone(await cache.get(second))
+        
+        reopened = IllustrationCache(self.root, max_bytes=250, store=self.store)
+        self.assertIsNotNone(await reopened.get(first))
+        self.assertIsNotNone(await reopened.get(third))
+        self.assertEqual(reopened.get_stats()["size_bytes"], 200)
+
+if __name__ == '__main__':
+    unittest.main()
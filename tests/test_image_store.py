@@ -0,0 +1,73 @@
+import tempfile
+import unittest
+from starlette.requests import Request
+from app.api.routes.images import get_image, parse_range, RangeNotSatisfiable
+from app.services.image_generation.image_store import ImageStore, image_store
+
+PNG = b"\x89PNG\r\n\x1a\n" + bytes(range(256)) * 4
+
+def make_request(headers=None, method="GET") -> Request:
+    raw = [(k.lower().encode(), v.encode()) for k, v in (headers or {}).items()]
+    return Request({"type": "http", "method": method, "headers": raw})
+
+class TestParseRange(unittest.TestCase):
+    def test_ranges(self):
+        self.assertIsNone(parse_range(None, 100))
+        self.assertEqual(parse_range("bytes=0-9", 100), (0, 9))
+        self.assertEqual(parse_range("bytes=90-", 100), (90, 99))
+        self.assertEqual(parse_range("bytes=-10", 100), (90, 99))
+        self.assertEqual(parse_range("bytes=50-500", 100), (50, 99))
+        # Несколько диапазонов отдаем целым файлом
+        self.assertIsNone(parse_range("bytes=0-1,5-6", 100))
+        with self.assertRaises(RangeNotSatisfiable):
+            parse_range("bytes=100-", 100)
+
+class TestImageStore(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.original_root = image_store.root
+        image_store.root = self.tmpdir.name
+    
+    def tearDown(self):
+        image_store.root = self.original_root
+        self.tmpdir.cleanup()
+    
+    async def test_content_addressed_save(self):
+        """Одинаковое содержимое сохраняется один раз под одним URL"""
+        store = ImageStore(root=self.tmpdir.name)
+        first = await store.save(PNG)
+        second = await store.save(PNG)
+        self.assertEqual(first, second)
+        self.assertEqual(first.url, f"/images/{first.digest}.png")
+        self.assertEqual(store.stats["saved"], 1)
+        self.assertEqual(store.stats["deduplicated"], 1)
+        with open(store.path_for(first.digest), "rb") as f:
+            self.assertEqual(f.read(), PNG)
+        self.assertIsNone(store.path_for("../etc/passwd"))
+    
+    async def test_endpoint_caching_and_range(self):
+        """ETag, 304, Range и 416"""
+        image = await image_store.save(PNG)
+        
+        response = await get_image(image.digest, make_request())
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.body, PNG)
+        self.assertEqual(response.headers["etag"], f'"{image.digest}"')
+        self.assertIn("immutable", response.headers["cache-control"])
+        
+        response = await get_image(image.digest, make_request({"If-None-Match": f'"{image.digest}"'}))
+        self.assertEqual(response.status_code, 304)
+        
+        response = await get_image(image.digest, make_request({"Range": "bytes=0-7"}))
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response.body, PNG[:8])
+        self.assertEqual(response.headers["content-range"], f"bytes 0-7/{len(PNG)}")
+        
+        response = await get_image(image.digest, make_request({"Range": f"bytes={len(PNG)}-"}))
+        self.assertEqual(response.status_code, 416)
+        
+        response = await get_image("0" * 64, make_request())
+        self.assertEqual(response.status_code, 404)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,105 @@
+import asyncio
+import json
+import unittest
+from aiohttp import web
+from app.services.ollama.story_generator import CONTEXT_SCHEMA, analyze_context
+from services.json_stream import IncrementalJSONParser, JSONGenerator, SchemaViolation, check_value, validate
+from services.llm_scheduler import LLMPriority
+from services.ollama_connection import ollama_connection
+
+ANALYSIS = {
+    "character": {"gender": "женский", "age": "неизвестно", "name": None},
+    "location": 'Старый "замок"',
+    "time": {"day_time": "вечер", "season": "осень"},
+    "events": ["Анна пришла к замку", "Ворота открылись"]
+}
+
+def chunks(text: str, size: int = 5):
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+class TestIncrementalJSONParser(unittest.TestCase):
+    def test_values_with_paths(self):
+        parser = IncrementalJSONParser()
+        values = []
+        text = json.dumps({**ANALYSIS, "score": -1.5e2, "ok": True}, ensure_ascii=False)
+        for chunk in chunks(text, 3):
+            values.extend(parser.feed(chunk))
+        self.assertTrue(parser.complete)
+        self.assertEqual(dict(values)[("character", "gender")], "женский")
+        self.assertIsNone(dict(values)[("character", "name")])
+        self.assertEqual(dict(values)[("location",)], 'Старый "замок"')
+        self.assertEqual(dict(values)[("events", 1)], "Ворота открылись")
+        self.assertEqual(dict(values)[("score",)], -150.0)
+        self.assertIs(dict(values)[("ok",)], True)
+        self.assertEqual(json.loads(parser.text)["events"], ANALYSIS["events"])
+    
+    def test_gender_checked_before_end(self):
+        parser = IncrementalJSONParser()
+        values = parser.feed('{"character": {"gender": "мужской/женский", "age": "')
+        self.assertFalse(parser.complete)
+        with self.assertRaises(SchemaViolation):
+            for path, value in values:
+                check_value(CONTEXT_SCHEMA, path, value)
+    
+    def test_validate_required(self):
+        with self.assertRaises(SchemaViolation):
+            validate(CONTEXT_SCHEMA, {"character": ANALYSIS["character"], "location": "замок", "events": []})
+
+class TestJSONGenerator(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.requests = []
+        self.finished = []
+        app = web.Application()
+        app.router.add_post('/api/generate', self.generate)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, '127.0.0.1', 0)
+        await site.start()
+        self.original_url = ollama_connection.base_url
+        ollama_connection.base_url = f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}"
+    
+    async def asyncTearDown(self):
+        ollama_connection.base_url = self.original_url
+        await ollama_connection.close()
+        await self.runner.cleanup()
+    
+    async def generate(self, request):
+        data = await request.json()
+        self.requests.append(data)
+        # Первый ответ с недопустимым gender и очень медленным хвостом
+        first = len(self.requests) == 1
+        document = dict(ANALYSIS)
+        if first:
+            document = {**ANALYSIS, "character": {**ANALYSIS["character"], "gender": "мужской/женский"}}
+        response = web.StreamResponse(headers={"Content-Type": "application/x-ndjson"})
+        await response.prepare(request)
+        try:
+            parts = chunks(json.dumps(document, ensure_ascii=False))
+            for index, chunk in enumerate(parts):
+                await response.write(json.dumps({"response": chunk, "done": False}).encode() + b"\n")
+                if first and index == len(parts) // 2:
+                    await asyncio.sleep(30)
+            await response.write(b'{"response": "", "done": true}\n')
+            self.finished.append(first)
+        except (ConnectionResetError, asyncio.CancelledError):
+            pass
+        return response
+    
+    async def test_violation_aborts_and_retries(self):
+        generator = JSONGenerator(max_attempts=3)
+        result = await asyncio.wait_for(generator.generate("текст", CONTEXT_SCHEMA, LLMPriority.ANALYSIS), timeout=10)
+        self.assertEqual(result["character"]["gender"], "женский")
+        self.assertEqual(self.requests[0]["format"], CONTEXT_SCHEMA)
+        self.assertEqual(generator.stats["aborted_early"], 1)
+        # Первый ответ оборван, до конца дописан только второй
+        self.assertEqual(self.finished, [False])
+    
+    async def test_analyze_context_uses_schema(self):
+        # Заглушка портит только первый ответ - здесь он нужен корректным
+        self.requests.append({})
+        context = await analyze_context("Анна подошла к замку.")
+        self.assertEqual(context["time"]["season"], "осень")
+        self.assertEqual(self.requests[1]["format"]["required"], CONTEXT_SCHEMA["required"])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,176 @@
+import asyncio
+import unittest
+from services.llm_scheduler import LLMPriority, LLMScheduler, priority_floor
+
+class TestLLMScheduler(unittest.IsolatedAsyncioTestCase):
+    async def run_requests(self, scheduler, requests):
+        """Запускает запросы, пока место занято, и возвращает порядок допуска"""
+        order = []
+        release = asyncio.Event()
+        
+        async def blocker():
+            async with scheduler.slot(LLMPriority.INTERACTIVE, "blocker"):
+                await release.wait()
+        
+        async def request(name, priority, session):
+            async with scheduler.slot(priority, session):
+                order.append(name)
+                await asyncio.sleep(0)
+        
+        blocking = asyncio.ensure_future(blocker())
+        await asyncio.sleep(0)
+        tasks = []
+        for name, priority, session in requests:
+            tasks.append(asyncio.ensure_future(request(name, priority, session)))
+            await asyncio.sleep(0)
+        release.set()
+        await asyncio.gather(blocking, *tasks)
+        return order
+    
+    async def test_priority_classes(self):
+        scheduler = LLMScheduler(max_concurrent=1)
+        order = await self.run_requests(scheduler, [
+            ("image", LLMPriority.IMAGE_PROMPT, "a"),
+            ("analysis", LLMPriority.ANALYSIS, "b"),
+            ("story", LLMPriority.INTERACTIVE, "c"),
+        ])
+        self.assertEqual(order, ["story", "analysis", "image"])
+        self.assertEqual(scheduler.get_stats()["max_queue_depth"], 3)
+    
+    async def test_sessions_round_robin(self):
+        """Сессия с тремя запросами не обгоняет сессию с одним"""
+        scheduler = LLMScheduler(max_concurrent=1)
+        order = await self.run_requests(scheduler, [
+            ("a1", LLMPriority.ANALYSIS, "a"),
+            ("a2", LLMPriority.ANALYSIS, "a"),
+            ("a3", LLMPriority.ANALYSIS, "a"),
+            ("b1", LLMPriority.ANALYSIS, "b"),
+        ])
+        self.assertEqual(order, ["a1", "b1", "a2", "a3"])
+    
+    async def test_priority_floor(self):
+        scheduler = LLMScheduler(max_concurrent=1)
+        order = []
+        
+        async def speculative():
+            priority_floor.set(LLMPriority.SPECULATIVE)
+            async with scheduler.slot(LLMPriority.INTERACTIVE, "a"):
+                order.append("speculative")
+        
+        async def blocker(release):
+            async with scheduler.slot(LLMPriority.INTERACTIVE, "x"):
+                await release.wait()
+        
+        release = asyncio.Event()
+        blocking = asyncio.ensure_future(blocker(release))
+        await asyncio.sleep(0)
+        spec = asyncio.ensure_future(speculative())
+        await asyncio.sleep(0)
+        
+        async def image():
+            async with scheduler.slot(LLMPriority.IMAGE_PROMPT, "b"):
+                order.append("image")
+        
+        img = asyncio.ensure_future(image())
+        await asyncio.sleep(0)
+        release.set()
+        await asyncio.gather(blocking, spec, img)
+        self.assertEqual(order, ["image", "speculative"])
+    
+    async def test_cancel_in_queue_and_positions(self):
+        scheduler = LLMScheduler(max_concurrent=1)
+        positions = []
+        
+        async def listener(info):
+            positions.append(info["position"])
+        
+        scheduler.subscribe("b", listener)
+        release = asyncio.Event()
+        
+        async def hold(priority, session):
+            async with scheduler.slot(priority, session):
+                await release.wait()
+        
+        first = asyncio.ensure_future(hold(LLMPriority.INTERACTIVE, "a"))
+        await asyncio.sleep(0)
+        second = asyncio.ensure_future(hold(LLMPriority.INTERACTIVE, "a"))
+        third = asyncio.ensure_future(hold(LLMPriority.INTERACTIVE, "b"))
+        await asyncio.sleep(0.01)
+        self.assertEqual(scheduler.queue_depth, 2)
+        
+        # Отмененный запрос уходит из очереди, следующий сдвигается вперед
+        second.cancel()
+        await asyncio.sleep(0.01)
+        self.assertEqual(scheduler.queue_depth, 1)
+        self.assertEqual(scheduler.stats["cancelled_in_queue"], 1)
+        release.set()
+        await asyncio.gather(first, third)
+        await asyncio.sleep(0)
+        self.assertEqual(positions, [2, 1, 0])
+        self.assertEqual(scheduler.active, 0)
+    
+    async def test_interactive_preempts_speculative(self):
+        """Интерактивный запрос другой сессии не ждет конца заранее генерируемой ветки"""
+        scheduler = LLMScheduler(max_concurrent=1)
+        order = []
+        
+        async def speculative():
+            priority_floor.set(LLMPriority.SPECULATIVE)
+            async with scheduler.slot(LLMPriority.INTERACTIVE, "a"):
+                order.append("speculative")
+                await asyncio.sleep(10)
+        
+        async def request(name, priority, session):
+            async with scheduler.slot(priority, session):
+                order.append(name)
+                await asyncio.sleep(0.01)
+        
+        branch = asyncio.ensure_future(speculative())
+        await asyncio.sleep(0)
+        # Промпт картинки ждет, но ветку не вытесняет
+        image = asyncio.ensure_future(request("image", LLMPriority.IMAGE_PROMPT, "c"))
+        await asyncio.sleep(0.01)
+        self.assertFalse(branch.done())
+        
+        story = asyncio.ensure_future(request("story", LLMPriority.INTERACTIVE, "b"))
+        await asyncio.wait_for(asyncio.gather(story, image), timeout=1)
+        self.assertTrue(branch.cancelled())
+        self.assertEqual(order, ["speculative", "story", "image"])
+        self.assertEqual(scheduler.stats["preempted"], 1)
+        self.assertEqual(scheduler.active, 0)
+    
+    async def test_promoted_branch_is_not_preempted(self):
+        """Ветку, которую выбрал читатель, интерактивный запрос другой сессии не прерывает"""
+        scheduler = LLMScheduler(max_concurrent=1)
+        order = []
+        release = asyncio.Event()
+        
+        async def speculative(name):
+            priority_floor.set(LLMPriority.SPECULATIVE)
+            async with scheduler.slot(LLMPriority.INTERACTIVE, name):
+                order.append(name)
+                await release.wait()
+        
+        async def request(name, priority, session):
+            async with scheduler.slot(priority, session):
+                order.append(name)
+        
+        taken = asyncio.ensure_future(speculative("taken"))
+        await asyncio.sleep(0)
+        queued = asyncio.ensure_future(speculative("queued"))
+        image = asyncio.ensure_future(request("image", LLMPriority.IMAGE_PROMPT, "c"))
+        await asyncio.sleep(0)
+        scheduler.promote(taken)
+        # Ожидающая ветка после promote обгоняет промпт картинки
+        scheduler.promote(queued)
+        
+        story = asyncio.ensure_future(request("story", LLMPriority.INTERACTIVE, "b"))
+        await asyncio.sleep(0.01)
+        self.assertFalse(taken.done())
+        self.assertEqual(scheduler.stats["preempted"], 0)
+        release.set()
+        await asyncio.wait_for(asyncio.gather(taken, queued, image, story), timeout=1)
+        self.assertEqual(order, ["taken", "queued", "story", "image"])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,61 @@
+import unittest
+from app.core.metrics import ComfyTimings, MetricsRegistry, comfyui_queue_wait_seconds, comfyui_sampling_seconds
+
+class MetricsRegistryTest(unittest.TestCase):
+    def setUp(self):
+        self.registry = MetricsRegistry()
+    
+    def test_histogram_buckets_are_cumulative(self):
+        histogram = self.registry.histogram("latency_seconds", "Задержка", (1, 5), labels=("speculative",))
+        for value in (0.5, 3, 3, 10):
+            histogram.observe(value, speculative="false")
+        lines = self.registry.render().splitlines()
+        self.assertIn('storycraft_latency_seconds_bucket{speculative="false",le="1"} 1', lines)
+        self.assertIn('storycraft_latency_seconds_bucket{speculative="false",le="5"} 3', lines)
+        self.assertIn('storycraft_latency_seconds_bucket{speculative="false",le="+Inf"} 4', lines)
+        self.assertIn('storycraft_latency_seconds_sum{speculative="false"} 16.5', lines)
+        self.assertIn('storycraft_latency_seconds_count{speculative="false"} 4', lines)
+        self.assertIn("# TYPE storycraft_latency_seconds histogram", lines)
+    
+    def test_collectors_flatten_numeric_stats(self):
+        self.registry.register_collector("render_queue", lambda: {
+            "jobs": 3,
+            "connected": True,
+            "by_class": {"interactive": 2},
+            "path": "data/x.db",
+            "recent": [{"jobs": 1}],
+        })
+        self.registry.register_collector("broken", lambda: 1 / 0)
+        lines = self.registry.render().splitlines()
+        self.assertIn("storycraft_render_queue_jobs 3", lines)
+        self.assertIn("storycraft_render_queue_connected 1", lines)
+        self.assertIn("storycraft_render_queue_by_class_interactive 2", lines)
+        self.assertFalse(any("path" in line or "recent" in line for line in lines))
+        self.assertTrue(any(line.startswith("# broken:") for line in lines))
+    
+    def test_unlabeled_gauge_starts_at_zero(self):
+        gauge = self.registry.gauge("websocket_sessions", "Сессии")
+        self.assertIn("storycraft_websocket_sessions 0", self.registry.render().splitlines())
+        gauge.inc()
+        gauge.inc()
+        gauge.dec()
+        self.assertEqual(gauge.value(), 1)
+
+class ComfyTimingsTest(unittest.TestCase):
+    def test_queue_wait_and_sampling_from_events(self):
+        clock = iter([2.0, 3.0, 5.5, 6.0])
+        waits = comfyui_queue_wait_seconds.count()
+        samplings = comfyui_sampling_seconds.count()
+        timings = ComfyTimings(submitted=0.5, clock=lambda: next(clock))
+        timings("execution_start", {})
+        timings("progress", {"value": 1, "max": 20})
+        timings("progress", {"value": 20, "max": 20})
+        timings("executing", {"node": "8"})
+        timings.finish()
+        self.assertEqual(comfyui_queue_wait_seconds.count(), waits + 1)
+        self.assertEqual(comfyui_sampling_seconds.count(), samplings + 1)
+        self.assertEqual(timings.started - timings.submitted, 1.5)
+        self.assertEqual(timings.last_progress - timings.first_progress, 2.5)
+
+if __name__ == "__main__":
+    unittest.main()
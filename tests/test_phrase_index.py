@@ -0,0 +1,46 @@
+import random
+import unittest
+from services.ollama_service import OllamaService
+from services.phrase_index import PhraseIndex
+from benchmarks.cases import _phrase
+
+class TestPhraseIndex(unittest.TestCase):
+    def test_matches_linear_check(self):
+        """Индекс находит те же похожие фразы, что и перебор similar_phrases"""
+        rng = random.Random(7)
+        service = OllamaService()
+        stored = [_phrase(rng) for _ in range(2000)]
+        index = PhraseIndex(max_phrases=len(stored))
+        index.update(stored)
+        
+        queries = [_phrase(rng) for _ in range(100)]
+        # Почти повторы: одно слово из десяти заменено
+        for phrase in rng.sample(stored, 100):
+            words = phrase.split()
+            words[rng.randrange(len(words))] = "туманом"
+            queries.append(" ".join(words))
+        
+        for query in queries:
+            expected = any(service.similar_phrases(query, old) for old in stored)
+            self.assertEqual(index.find_similar(query) is not None, expected, query)
+        self.assertLess(index.stats["candidates"], len(queries) * len(stored) / 20)
+    
+    def test_bounded_with_eviction(self):
+        index = PhraseIndex(max_phrases=3)
+        index.update(["старый замок в тумане", "тихая река под мостом", "ключ от башни", "голос за дверью"])
+        self.assertEqual(list(index), ["тихая река под мостом", "ключ от башни", "голос за дверью"])
+        self.assertIsNone(index.find_similar("Старый замок в  тумане"))
+        self.assertEqual(index.find_similar("Ключ от башни"), "ключ от башни")
+        
+        for phrase in list(index):
+            index.discard(phrase)
+        self.assertEqual(index.get_stats()["buckets"], 0)
+    
+    def test_is_repetitive(self):
+        service = OllamaService()
+        self.assertFalse(service.is_repetitive("Рыцарь вошел в старый замок. Ветер выл в башне."))
+        self.assertTrue(service.is_repetitive("Рыцарь вошел в старый замок."))
+        self.assertFalse(service.is_repetitive("Девушка ждала у реки."))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+import unittest
+from services.prompt_budget import PromptBuilder, PromptOverflow, TokenCounter, REQUEST_PROFILES, request_options
+
+class TestPromptBuilder(unittest.TestCase):
+    def setUp(self):
+        self.profile = REQUEST_PROFILES["story"]
+    
+    def builder(self, prompt_tokens: int) -> PromptBuilder:
+        """Окно, в котором под промпт остается prompt_tokens токенов"""
+        return PromptBuilder("story", num_ctx=self.profile.num_predict + prompt_tokens)
+    
+    def test_everything_fits(self):
+        builder = self.builder(1000)
+        builder.add("chapter", ["Глава 1"])
+        builder.add("events", ["- Встреча у реки", "- Найден ключ"], priority=2, header="События:")
+        self.assertEqual(builder.build(), "Глава 1\nСобытия:\n- Встреча у реки\n- Найден ключ")
+        self.assertEqual(builder.report.dropped, {})
+        self.assertEqual(builder.options(), {"num_ctx": self.profile.num_predict + 1000, "num_predict": self.profile.num_predict})
+    
+    def test_low_priority_oldest_lines_dropped_first(self):
+        builder = self.builder(45)
+        builder.fixed("x" * 60)  # ~21 токен
+        builder.add("choices", ["- Налево", "- Направо"], priority=1)
+        builder.add("events", ["- Старое событие у реки", "- Новое событие"], priority=2)
+        builder.add("choice", ["Выбор: открыть дверь"])
+        state = builder.build()
+        # Порядок секций сохраняется, из событий осталось самое новое
+        self.assertEqual(state, "- Налево\n- Направо\n- Новое событие\nВыбор: открыть дверь")
+        self.assertEqual(builder.report.dropped, {"events": 1})
+        self.assertLessEqual(builder.report.prompt_tokens, 45)
+    
+    def test_required_sections_shrink_num_predict(self):
+        builder = PromptBuilder("story", num_ctx=self.profile.num_predict + 10)
+        builder.add("text", ["слово " * 100])
+        builder.add("events", ["- событие"], priority=1)
+        self.assertEqual(builder.build(), "слово " * 100)
+        self.assertLess(builder.options()["num_predict"], self.profile.num_predict)
+        self.assertGreaterEqual(builder.options()["num_predict"], self.profile.min_predict)
+    
+    def test_required_sections_trimmed_to_min_predict(self):
+        """Промпт и min_predict вместе не выходят за num_ctx: у обязательных секций уходят старые строки"""
+        builder = PromptBuilder("story", num_ctx=self.profile.min_predict + 100)
+        builder.fixed("x" * 60)  # ~21 токен
+        builder.add("timeline", [f"- событие {i} " + "y" * 30 for i in range(10)])
+        builder.add("choice", ["Выбор: открыть дверь"])
+        state = builder.build()
+        options = builder.options()
+        self.assertLessEqual(builder.report.prompt_tokens + options["num_predict"], options["num_ctx"])
+        self.assertGreaterEqual(options["num_predict"], self.profile.min_predict)
+        self.assertTrue(state.startswith("- событие"))
+        self.assertTrue(state.endswith("- событие 9 " + "y" * 30 + "\nВыбор: открыть дверь"))
+        self.assertGreater(builder.report.dropped["timeline"], 0)
+    
+    def test_required_overflow_raises(self):
+        builder = PromptBuilder("story", num_ctx=self.profile.min_predict + 10)
+        builder.add("choice", ["слово " * 100])
+        with self.assertRaises(PromptOverflow):
+            builder.build()
+    
+    def test_same_num_ctx_for_every_request_type(self):
+        options = [request_options(kind, "текст") for kind in REQUEST_PROFILES]
+        self.assertEqual(len({o["num_ctx"] for o in options}), 1)
+        self.assertTrue(all(o["num_predict"] < o["num_ctx"] for o in options))
+
+class TestTokenCounter(unittest.TestCase):
+    def test_calibration_skips_cached_prefix(self):
+        counter = TokenCounter(3.0)
+        counter.observe("a" * 400, 100)
+        self.assertEqual(counter.count("a" * 400), 101)
+        # Ollama разобрала только хвост промпта - замер не учитывается
+        counter.observe("a" * 4000, 20)
+        self.assertEqual(counter.chars_per_token, 4.0)
+
+if __name__ == '__main__':
+    unittest.main()
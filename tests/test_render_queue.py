@@ -0,0 +1,91 @@
+import asyncio
+import unittest
+from config.comfy_config import ComfyUIConfig
+from app.services.comfy.render_queue import RenderQueue, batch_key, build_batch_workflow
+
+class RecordingQueue(RenderQueue):
+    """Очередь без ComfyUI: запоминает пакеты и возвращает промпты вместо картинок"""
+    
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.batches = []
+    
+    async def _render_batch(self, workflows):
+        self.batches.append(workflows)
+        return [workflow["6"]["inputs"]["text"] for workflow in workflows]
+
+class TestBuildBatchWorkflow(unittest.TestCase):
+    def setUp(self):
+        self.config = ComfyUIConfig()
+    
+    def test_modify_workflow_keeps_defaults(self):
+        self.config.modify_workflow("castle", seed=7, width=512)
+        self.assertEqual(self.config.default_workflow["6"]["inputs"]["text"], "")
+        self.assertNotEqual(self.config.default_workflow["3"]["inputs"]["seed"], 7)
+    
+    def test_single_workflow_unchanged(self):
+        workflow = self.config.modify_workflow("castle")
+        combined, save_nodes = build_batch_workflow([workflow])
+        self.assertEqual(combined, workflow)
+        self.assertEqual(save_nodes, ["9"])
+    
+    def test_shared_nodes_and_chains(self):
+        workflows = [self.config.modify_workflow(p) for p in ("castle", "forest", "castle")]
+        self.assertEqual(len({batch_key(w) for w in workflows}), 1)
+        
+        combined, save_nodes = build_batch_workflow(workflows)
+        # Чекпоинт, LoRA, негативный промпт и латент - один раз; промпт и все после него - на цепочку
+        self.assertEqual(sorted(combined), sorted(["4", "5", "7", "10", "3", "6", "8", "9", "3.1", "6.1", "8.1", "9.1"]))
+        self.assertEqual(save_nodes, ["9", "9.1", "9"])
+        self.assertEqual(combined["6.1"]["inputs"]["text"], "forest")
+        self.assertEqual(combined["3.1"]["inputs"]["positive"], ["6.1", 0])
+        self.assertEqual(combined["3.1"]["inputs"]["model"], ["4", 0])
+        self.assertEqual(combined["9.1"]["inputs"]["images"], ["8.1", 0])
+    
+    def test_different_size_not_batched(self):
+        small = self.config.modify_workflow("castle", width=400)
+        large = self.config.modify_workflow("castle", width=768)
+        self.assertNotEqual(batch_key(small), batch_key(large))
+
+class TestRenderQueue(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.config = ComfyUIConfig()
+    
+    async def test_jobs_within_window_batched(self):
+        queue = RecordingQueue(window=0.05, max_batch=4)
+        results = await asyncio.gather(
+            queue.render(self.config.modify_workflow("castle")),
+            queue.render(self.config.modify_workflow("forest")),
+            queue.render(self.config.modify_workflow("sea", width=768)),
+        )
+        # Каждая сессия получает свой результат, разные размеры - разные пакеты
+        self.assertEqual(results, ["castle", "forest", "sea"])
+        self.assertEqual(sorted(len(batch) for batch in queue.batches), [1, 2])
+        self.assertEqual(queue.stats["batched_jobs"], 2)
+    
+    async def test_full_batch_flushed_without_window(self):
+        queue = RecordingQueue(window=60, max_batch=2)
+        results = await asyncio.wait_for(asyncio.gather(
+            queue.render(self.config.modify_workflow("castle")),
+            queue.render(self.config.modify_workflow("forest")),
+        ), timeout=1)
+        self.assertEqual(results, ["castle", "forest"])
+        self.assertEqual(queue.stats["batches"], 1)
+    
+    async def test_batch_error_reaches_every_job(self):
+        queue = RecordingQueue(window=0.01)
+        
+        async def failing(workflows):
+            raise RuntimeError("ComfyUI упал")
+        queue._render_batch = failing
+        
+        results = await asyncio.gather(
+            queue.render(self.config.modify_workflow("castle")),
+            queue.render(self.config.modify_workflow("forest")),
+            return_exceptions=True
+        )
+        self.assertTrue(all(isinstance(r, RuntimeError) for r in results))
+        self.assertEqual(queue.stats["failures"], 1)
+
+if __name__ == '__main__':
+    unittest.main()
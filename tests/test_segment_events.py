@@ -0,0 +1,30 @@
+import unittest
+from app.services.ollama.segment_events import SentenceBuffer, extract_choices
+
+class TestSentenceBuffer(unittest.TestCase):
+    def test_deltas_rebuild_exact_text(self):
+        """Склеенные фрагменты совпадают с ответом модели"""
+        chunks = ["Дверь ", "скрипнула", ". Тишина", "!\n\nКто ", "там?", " Никого"]
+        buffer = SentenceBuffer()
+        deltas = [d for d in (buffer.feed(c) for c in chunks) if d]
+        self.assertEqual(deltas, ["Дверь скрипнула.", " Тишина!", "\n\nКто там?"])
+        deltas.append(buffer.flush())
+        self.assertEqual("".join(deltas), "".join(chunks))
+
+class TestExtractChoices(unittest.TestCase):
+    def test_numbered_choices(self):
+        text = "Герой стоит у ворот.\n\n1. Войти в замок\n2) **Обойти стену**\n3. Вернуться домой\n"
+        story, choices = extract_choices(text)
+        self.assertEqual(story, "Герой стоит у ворот.")
+        self.assertEqual(choices, ["Войти в замок", "Обойти стену", "Вернуться домой"])
+    
+    def test_bullet_choices(self):
+        _, choices = extract_choices("Текст.\n* Бежать\n* Остаться")
+        self.assertEqual(choices, ["Бежать", "Остаться"])
+    
+    def test_no_choices(self):
+        text = "Просто текст.\n- один пункт"
+        self.assertEqual(extract_choices(text), (text, []))
+
+if __name__ == '__main__':
+    unittest.main()
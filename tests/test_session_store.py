@@ -0,0 +1,94 @@
+import os
+import tempfile
+import time
+import unittest
+from app.services.image_generation.image_store import ImageStore
+from app.services.session.store import SessionStore, StorySegment
+
+def story_context(choices):
+    return {"current_chapter": 1, "previous_choices": list(choices), "timeline": ["Начало"], "current_state": {}}
+
+class TestSessionStore(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, "sessions.db")
+        self.images = ImageStore(os.path.join(self.tmp.name, "images"))
+        self.store = SessionStore(self.path, compact_every=100, ttl_hours=1, images=self.images)
+    
+    def tearDown(self):
+        self.store.close()
+        self.tmp.cleanup()
+    
+    async def fill(self, store, token):
+        await store.add_segment(token, StorySegment("Начать историю", "Текст 1", ["А", "Б"]), story_context([]), [1, 2, 3])
+        await store.add_image(token, 0, {"url": "/images/x.png", "prompt": "castle"})
+        await store.update_context(token, {**story_context([]), "timeline": ["Начало", "Замок"]})
+        await store.add_segment(token, StorySegment("А", "Текст 2", ["В", "Г"]), story_context(["А"]), [1, 2, 3, 4])
+    
+    async def test_new_session(self):
+        session = await self.store.open("unknown-token")
+        self.assertNotEqual(session.token, "unknown-token")
+        self.assertEqual(session.segments, [])
+        self.assertIsNone(session.story_context)
+    
+    async def test_resume_after_restart(self):
+        token = (await self.store.open()).token
+        await self.fill(self.store, token)
+        self.store.close()
+        
+        # Новый экземпляр читает тот же файл, как после перезапуска сервера
+        reopened = SessionStore(self.path)
+        session = await reopened.open(token)
+        reopened.close()
+        self.assertEqual(session.token, token)
+        self.assertEqual([s.text for s in session.segments], ["Текст 1", "Текст 2"])
+        self.assertEqual(session.segments[0].image["url"], "/images/x.png")
+        self.assertIsNone(session.segments[1].image)
+        self.assertEqual(session.choices, ["В", "Г"])
+        self.assertEqual(session.story_context["previous_choices"], ["А"])
+        self.assertEqual(session.conversation_context, [1, 2, 3, 4])
+    
+    async def test_compaction_keeps_state(self):
+        store = SessionStore(os.path.join(self.tmp.name, "compact.db"), compact_every=3)
+        token = (await store.open()).token
+        await self.fill(store, token)
+        self.assertEqual(store.stats["compactions"], 1)
+        rows = store._connect().execute("SELECT kind FROM records WHERE token = ?", (token,)).fetchall()
+        self.assertEqual([kind for kind, in rows], ["snapshot", "segment"])
+        
+        session = await store.open(token)
+        store.close()
+        self.assertEqual([s.text for s in session.segments], ["Текст 1", "Текст 2"])
+        self.assertEqual(session.segments[0].image["prompt"], "castle")
+        self.assertEqual(session.conversation_context, [1, 2, 3, 4])
+    
+    async def test_purge_expired(self):
+        old = (await self.store.open()).token
+        fresh = (await self.store.open()).token
+        await self.store.add_segment(old, StorySegment("Начать историю", "Текст"), story_context([]))
+        self.store._connect().execute("UPDATE sessions SET updated = ? WHERE token = ?", (time.time() - 7200, old))
+        
+        self.assertEqual(await self.store.purge_expired(), 1)
+        self.assertNotEqual((await self.store.open(old)).token, old)
+        self.assertEqual((await self.store.open(fresh)).token, fresh)
+
+    async def test_purge_collects_unreferenced_images(self):
+        old = (await self.store.open()).token
+        fresh = (await self.store.open()).token
+        expired, live, cached, orphan, recent = [await self.images.save(name.encode()) for name in ("a", "b", "c", "d", "e")]
+        for token, image in ((old, expired), (fresh, live)):
+            await self.store.add_segment(token, StorySegment("Начать историю", "Текст"), story_context([]))
+            await self.store.add_image(token, 0, {"url": image.url, "digest": image.digest})
+        self.store._connect().execute("UPDATE sessions SET updated = ? WHERE token = ?", (time.time() - 7200, old))
+        long_ago = time.time() - 7200
+        for image in (expired, live, cached, orphan):
+            os.utime(self.images.path_for(image.digest), (long_ago, long_ago))
+        
+        self.assertEqual(await self.store.purge_expired(keep={cached.digest}), 1)
+        remaining = {image.digest for image in (expired, live, cached, orphan, recent) if self.images.stored(image.digest)}
+        # Только что сохраненная картинка еще может быть не записана в сессию - ее не трогаем
+        self.assertEqual(remaining, {live.digest, cached.digest, recent.digest})
+        self.assertEqual(self.images.stats["collected"], 2)
+
+if __name__ == '__main__':
+    unittest.main()
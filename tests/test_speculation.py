@@ -0,0 +1,88 @@
+import asyncio
+import unittest
+from unittest import mock
+from app.services.ollama import speculation
+from app.services.ollama.segment_events import SegmentEventType
+from app.services.ollama.speculation import StorySpeculator
+
+closed = []
+
+async def fake_segment(choice, context, conversation=None):
+    """Имитация generate_next_segment: текст, done, затем иллюстрация"""
+    try:
+        yield {"type": SegmentEventType.TEXT, "delta": f"Вы выбрали {choice}.", "chapter": 1}
+        await asyncio.sleep(0.01)
+        yield {"type": SegmentEventType.DONE, "text": f"Вы выбрали {choice}.", "chapter": 1}
+        yield {"type": SegmentEventType.IMAGE, "url": f"/images/{choice}.png"}
+    finally:
+        closed.append(choice)
+
+class TestSpeculation(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        closed.clear()
+        self.patch = mock.patch.object(speculation, "generate_next_segment", fake_segment)
+        self.patch.start()
+        self.speculator = StorySpeculator()
+        self.speculator.enabled = True
+        self.speculator.max_branches = 2
+        self.context = {"previous_choices": [], "timeline": []}
+    
+    def tearDown(self):
+        self.patch.stop()
+    
+    async def test_hit_replays_and_cancels_others(self):
+        """Выбранная ветка отдается сразу, остальные отменяются"""
+        cache = self.speculator.session_cache()
+        cache.start(["Налево", "Направо", "Назад"], self.context)
+        self.assertEqual(len(cache.branches), 2)
+        await asyncio.sleep(0.1)
+        
+        branch = cache.take("Налево", self.context)
+        self.assertIsNotNone(branch)
+        self.assertTrue(branch.is_done)
+        events = [event async for event in branch.stream()]
+        self.assertEqual([e["type"] for e in events],
+                         [SegmentEventType.TEXT, SegmentEventType.DONE, SegmentEventType.IMAGE])
+        await asyncio.sleep(0.01)
+        self.assertIn("Направо", closed)
+        self.assertEqual(self.speculator.get_stats()["hit_rate"], 1.0)
+        self.assertEqual(self.speculator.stats["cancelled"], 1)
+    
+    async def test_miss_on_other_choice_or_context(self):
+        """Другой выбор или изменившийся контекст - промах"""
+        cache = self.speculator.session_cache()
+        cache.start(["Налево"], self.context)
+        self.assertIsNone(cache.take("Свой вариант", self.context))
+        cache.start(["Налево"], self.context)
+        self.assertIsNone(cache.take("Налево", {"previous_choices": ["другое"], "timeline": []}))
+        self.assertEqual(self.speculator.stats["misses"], 2)
+    
+    async def test_preempted_branch_is_a_miss(self):
+        """Ветку, прерванную ради интерактивного запроса, не продолжить - генерируем заново"""
+        cache = self.speculator.session_cache()
+        cache.start(["Налево"], self.context)
+        await asyncio.sleep(0)
+        cache.branches[next(iter(cache.branches))].task.cancel()
+        await asyncio.sleep(0.01)
+        self.assertIsNone(cache.take("Налево", self.context))
+        self.assertEqual(self.speculator.stats["misses"], 1)
+    
+    async def test_take_while_still_generating(self):
+        """Ветку можно забрать до окончания генерации - поток догоняет её"""
+        cache = self.speculator.session_cache()
+        cache.start(["Налево"], self.context)
+        branch = cache.take("Налево", self.context)
+        # Выбранная ветка больше не фоновая: llm_scheduler ее не вытеснит
+        self.assertTrue(branch.claimed)
+        self.assertNotIn(branch.task, speculation.llm_scheduler._preemptible)
+        events = [event async for event in branch.stream()]
+        self.assertEqual(events[-1]["url"], "/images/Налево.png")
+    
+    async def test_disabled(self):
+        self.speculator.enabled = False
+        cache = self.speculator.session_cache()
+        cache.start(["Налево"], self.context)
+        self.assertEqual(cache.branches, {})
+
+if __name__ == '__main__':
+    unittest.main()
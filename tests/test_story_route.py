@@ -0,0 +1,152 @@
+import asyncio
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+import aiohttp
+from aiohttp import web
+from test_multi_worker import ROOT, StubOllama, free_port
+
+MB = 1024 * 1024
+
+class StubComfyUI:
+    """ComfyUI, который принимает задачи и никогда их не завершает"""
+    
+    def __init__(self):
+        self.prompts = 0
+    
+    async def system_stats(self, request):
+        return web.json_response({"devices": [{"vram_total": 24000 * MB, "vram_free": 20000 * MB}]})
+    
+    async def prompt(self, request):
+        self.prompts += 1
+        return web.json_response({"prompt_id": f"p{self.prompts}"})
+    
+    async def history(self, request):
+        return web.json_response({})
+    
+    async def start(self, port: int) -> None:
+        app = web.Application()
+        app.router.add_get('/system_stats', self.system_stats)
+        app.router.add_post('/prompt', self.prompt)
+        app.router.add_get('/history/{prompt_id}', self.history)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, '127.0.0.1', port).start()
+
+class SlowAnalysisOllama(StubOllama):
+    """С slow_analysis анализ контекста отвечает по чанку в 0.1 с; оборванные клиентом ответы считаются"""
+    
+    def __init__(self):
+        super().__init__()
+        self.slow_analysis = False
+        self.analysis_aborted = 0
+    
+    async def generate(self, request):
+        data = await request.json()
+        if "format" not in data or not self.slow_analysis:
+            return await super().generate(request)
+        response = web.StreamResponse(headers={"Content-Type": "application/x-ndjson"})
+        await response.prepare(request)
+        try:
+            for _ in range(100):
+                await response.write(b'{"response": " ", "done": false}\n')
+                await asyncio.sleep(0.1)
+        except (ConnectionError, aiohttp.ClientConnectionError):
+            self.analysis_aborted += 1
+        return response
+
+class TestStoryRoute(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.ollama = SlowAnalysisOllama()
+        ollama_url = await self.ollama.start()
+        comfy_port = free_port()
+        self.comfy = StubComfyUI()
+        await self.comfy.start(comfy_port)
+        
+        env = dict(os.environ)
+        env.update({
+            "OLLAMA_HOST": ollama_url,
+            "COMFYUI_HOST": "127.0.0.1",
+            "COMFYUI_PORT": str(comfy_port),
+            "SESSION_DB_PATH": os.path.join(self.tmp.name, "sessions.db"),
+            "WORKER_REGISTRY_PATH": os.path.join(self.tmp.name, "registry.db"),
+            "IMAGE_STORE_PATH": os.path.join(self.tmp.name, "images"),
+            "TRACE_FILE": os.path.join(self.tmp.name, "traces.jsonl"),
+            "ILLUSTRATION_CACHE_PATH": os.path.join(self.tmp.name, "cache"),
+            "SPECULATIVE_ENABLED": "false",
+        })
+        port = free_port()
+        self.url = f"127.0.0.1:{port}"
+        self.process = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(port)],
+            cwd=ROOT,
+            env=env,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL
+        )
+        self.session = aiohttp.ClientSession()
+        for _ in range(150):
+            try:
+                async with self.session.get(f"http://{self.url}/") as response:
+                    if response.status == 200:
+                        return
+            except aiohttp.ClientError:
+                pass
+            await asyncio.sleep(0.1)
+        self.fail("Сервер не запустился")
+    
+    async def asyncTearDown(self):
+        await self.session.close()
+        self.process.terminate()
+        self.process.wait(timeout=10)
+        await self.ollama.runner.cleanup()
+        await self.comfy.runner.cleanup()
+        self.tmp.cleanup()
+    
+    async def receive_until(self, ws, predicate, timeout: float = 15) -> list:
+        messages = []
+        while True:
+            message = await asyncio.wait_for(ws.receive_json(), timeout)
+            messages.append(message)
+            if predicate(message):
+                return messages
+    
+    async def test_choice_not_blocked_by_illustration(self):
+        """Выбор во время рисования картинки сразу запускает следующий сегмент"""
+        async with self.session.ws_connect(f"ws://{self.url}/ws") as ws:
+            await self.receive_until(ws, lambda m: m["type"] == "choices")
+            await ws.send_json({"type": "choice", "content": "Начать историю"})
+            await self.receive_until(ws, lambda m: m["type"] == "context")
+            # Иллюстрация ушла в ComfyUI и не завершится
+            for _ in range(100):
+                if self.comfy.prompts:
+                    break
+                await asyncio.sleep(0.05)
+            self.assertEqual(self.comfy.prompts, 1)
+            
+            started = time.monotonic()
+            await ws.send_json({"type": "choice", "content": "Открыть ворота"})
+            messages = await self.receive_until(ws, lambda m: m["type"] == "story" and m["done"])
+            self.assertLess(time.monotonic() - started, 10)
+            self.assertTrue(any(m["type"] == "story" and m["content"] for m in messages))
+            self.assertEqual(self.ollama.story_requests, 2)
+
+    async def test_disconnect_cancels_context_analysis(self):
+        """Ушедший читатель не держит очередь к Ollama анализом контекста"""
+        self.ollama.slow_analysis = True
+        async with self.session.ws_connect(f"ws://{self.url}/ws") as ws:
+            await self.receive_until(ws, lambda m: m["type"] == "choices")
+            await ws.send_json({"type": "choice", "content": "Начать историю"})
+            await self.receive_until(ws, lambda m: m["type"] == "choices")
+        for _ in range(50):
+            if self.ollama.analysis_aborted:
+                break
+            await asyncio.sleep(0.1)
+        self.assertEqual(self.ollama.analysis_aborted, 1)
+
+if __name__ == '__main__':
+    unittest.main()
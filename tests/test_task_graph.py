@@ -0,0 +1,61 @@
+import asyncio
+import time
+import unittest
+from app.core.task_graph import DependencyFailed, StageTimings, TaskGraph
+
+class TestTaskGraph(unittest.IsolatedAsyncioTestCase):
+    async def test_independent_steps_run_together(self):
+        """Независимые шаги идут параллельно, результат уходит сразу по готовности"""
+        delivered = []
+        
+        async def slow(value, delay):
+            await asyncio.sleep(delay)
+            return value
+        
+        async def deliver(result):
+            delivered.append(result)
+        
+        graph = TaskGraph("test", timings=StageTimings())
+        graph.add("context", lambda: slow("context", 0.05), on_done=deliver)
+        graph.add("prompt", lambda: slow("prompt", 0.1))
+        graph.add("image", lambda prompt: slow(f"image({prompt})", 0.1), deps=["prompt"], on_done=deliver)
+        
+        started = time.perf_counter()
+        results = await graph.run()
+        elapsed = time.perf_counter() - started
+        
+        self.assertEqual(delivered, ["context", "image(prompt)"])
+        self.assertEqual(results["image"], "image(prompt)")
+        self.assertLess(elapsed, 0.25)
+        self.assertEqual(set(graph.durations), {"context", "prompt", "image"})
+        self.assertEqual(graph.timings.get_stats()["test.prompt"]["count"], 1)
+    
+    async def test_failed_step_skips_dependents_only(self):
+        """Ошибка шага пропускает зависимые шаги, но не остальные"""
+        async def fail():
+            raise RuntimeError("Ollama недоступна")
+        
+        async def ok():
+            return "ok"
+        
+        async def never(prompt):
+            raise AssertionError("не должен запускаться")
+        
+        graph = TaskGraph("test", timings=StageTimings())
+        graph.add("context", ok)
+        graph.add("prompt", fail)
+        graph.add("image", never, deps=["prompt"])
+        results = await graph.run()
+        
+        self.assertEqual(results, {"context": "ok"})
+        self.assertIsInstance(graph.errors["prompt"], RuntimeError)
+        self.assertIsInstance(graph.errors["image"], DependencyFailed)
+        self.assertEqual(graph.timings.get_stats()["test.prompt"]["errors"], 1)
+    
+    def test_unknown_dependency(self):
+        graph = TaskGraph("test", timings=StageTimings())
+        with self.assertRaises(ValueError):
+            graph.add("image", lambda prompt: None, deps=["prompt"])
+
+if __name__ == '__main__':
+    unittest.main()
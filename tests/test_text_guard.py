@@ -0,0 +1,111 @@
+import asyncio
+import json
+import random
+import unittest
+from aiohttp import web
+from benchmarks.cases import _phrase
+from services.json_stream import GuardViolation, json_generator
+from services.ollama_connection import ollama_connection
+from services.ollama_service import OllamaService
+from services.phrase_index import PhraseIndex
+from services.text_guard import TextGuard
+
+def scene(description: str, dialog: str = "Кто здесь?") -> dict:
+    return {
+        "scene_description": description,
+        "character_name": "Анна",
+        "dialog": dialog,
+        "choices": [{"text": "Подняться в башню", "consequence": "Откроется вид на долину"}]
+    }
+
+class TestTextGuard(unittest.TestCase):
+    def setUp(self):
+        self.used = PhraseIndex()
+        self.used.add("Рыцарь вошел в старый замок")
+        self.guard = TextGuard(self.used)
+    
+    def test_repetition_found_before_string_ends(self):
+        self.guard(("scene_description",), "Ветер гнал листья по двору. Рыцарь вошел в стар", False)
+        with self.assertRaises(GuardViolation):
+            self.guard(("scene_description",), "Ветер гнал листья по двору. Рыцарь вошел в старый замок. Он", False)
+    
+    def test_repetition_inside_answer(self):
+        self.guard(("scene_description",), "Над рекой стоял густой туман.", True)
+        with self.assertRaises(GuardViolation):
+            self.guard(("dialog",), "Над рекой стоял густой туман", True)
+    
+    def test_language_and_format(self):
+        with self.assertRaises(GuardViolation):
+            self.guard(("mood",), "The old castle was silent and dark, and nobody came to the gate", False)
+        with self.assertRaises(GuardViolation):
+            self.guard(("dialog",), "Кто здесь? [/INST]", False)
+        with self.assertRaises(GuardViolation):
+            self.guard(("choices", 3, "text"), "Четвертый вариант", True)
+        # Короткие английские вставки допустимы
+        self.guard(("mood",), "Тревожное ожидание, OK", False)
+
+class TestGuardedScene(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.documents = []
+        self.finished = []
+        self.options = []
+        app = web.Application()
+        app.router.add_post('/api/generate', self.generate)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, '127.0.0.1', 0)
+        await site.start()
+        self.original_url = ollama_connection.base_url
+        ollama_connection.base_url = f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}"
+    
+    async def asyncTearDown(self):
+        ollama_connection.base_url = self.original_url
+        await ollama_connection.close()
+        await self.runner.cleanup()
+    
+    async def generate(self, request):
+        self.options.append((await request.json()).get("options", {}))
+        document = self.documents.pop(0)
+        text = json.dumps(document, ensure_ascii=False)
+        parts = [text[i:i + 4] for i in range(0, len(text), 4)]
+        response = web.StreamResponse(headers={"Content-Type": "application/x-ndjson"})
+        await response.prepare(request)
+        try:
+            for part in parts:
+                await response.write(json.dumps({"response": part, "done": False}).encode() + b"\n")
+                await asyncio.sleep(0.001)
+            await response.write(json.dumps({"response": "", "done": True, "eval_count": len(parts)}).encode() + b"\n")
+            self.finished.append(document["scene_description"][:20])
+        except (ConnectionResetError, asyncio.CancelledError):
+            pass
+        return response
+    
+    async def test_repeated_scene_aborted_and_retried(self):
+        service = OllamaService()
+        rng = random.Random(5)
+        tail = " ".join(_phrase(rng) + "." for _ in range(20))
+        self.documents = [
+            scene("Рыцарь вошел в старый замок. Факелы горели ровно. " + tail),
+            scene("Ветер гнал листья по двору. Рыцарь вошел в старый замок. " + tail),
+            scene("Наверху скрипнула дверь. Анна подняла фонарь повыше.", "Здесь кто-то был недавно"),
+        ]
+        before = json_generator.get_stats()
+        
+        first = await service.generate_next_scene("Войти в замок")
+        self.assertTrue(first["scene_description"].startswith("Рыцарь"))
+        second = await asyncio.wait_for(service.generate_next_scene("Подняться в башню"), timeout=10)
+        self.assertTrue(second["scene_description"].startswith("Наверху"))
+        
+        stats = json_generator.get_stats()
+        self.assertEqual(stats["guard_aborts"] - before["guard_aborts"], 1)
+        self.assertGreater(stats["tokens_saved"], before["tokens_saved"])
+        # Повторный ответ не дописан до конца
+        self.assertEqual(self.finished, ["Рыцарь вошел в стары", "Наверху скрипнула дв"])
+        # Повтор не закреплен seed, в options только ключи, которые принимает Ollama
+        for options in self.options:
+            self.assertNotIn("seed", options)
+            self.assertNotIn("num_threads", options)
+            self.assertIn("num_predict", options)
+
+if __name__ == '__main__':
+    unittest.main()
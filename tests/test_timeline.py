@@ -0,0 +1,42 @@
+import json
+import unittest
+from app.services.ollama.story_generator import merge_story_context
+from app.services.ollama.timeline import NOT_STARTED, StoryTimeline
+
+def analysis(*events):
+    return {"character": {"gender": None, "age": None, "name": None}, "location": None, "time": None, "events": list(events)}
+
+class TestStoryTimeline(unittest.TestCase):
+    def test_duplicates_ignore_case_and_spaces(self):
+        timeline = StoryTimeline(["Найден ключ"])
+        self.assertEqual(timeline.extend(["найден  ключ", "Открыта дверь", "Открыта дверь", ""]), ["Открыта дверь"])
+        self.assertEqual(timeline.events, ["Найден ключ", "Открыта дверь"])
+    
+    def test_old_events_fold_into_summary(self):
+        timeline = StoryTimeline([NOT_STARTED], max_events=3, summary_chars=40)
+        timeline.extend(["Встреча у реки", "Найден ключ"])
+        timeline.add("Выбор: Открыть дверь", unique=False)
+        timeline.add("Дверь открыта")
+        self.assertEqual(timeline.events, ["Найден ключ", "Выбор: Открыть дверь", "Дверь открыта"])
+        # Заглушка и выборы в сводку не попадают
+        self.assertEqual(timeline.summary, "Встреча у реки")
+        # Вытесненное событие снова считается новым
+        self.assertNotIn("Встреча у реки", timeline)
+        
+        timeline.extend(["Башня в тумане", "Голос за стеной", "Старый мост рухнул"])
+        self.assertLessEqual(len(timeline.summary), 40)
+        self.assertTrue(timeline.summary.endswith("Дверь открыта"))
+    
+    def test_long_session_keeps_context_bounded(self):
+        story_context = {"current_state": {}, "timeline": [NOT_STARTED]}
+        sizes = []
+        for i in range(300):
+            merge_story_context(analysis(f"Событие номер {i}"), f"Вариант {i}", story_context)
+            sizes.append(len(json.dumps(story_context, ensure_ascii=False)))
+        self.assertLessEqual(len(story_context["timeline"]), StoryTimeline().max_events)
+        self.assertEqual(story_context["timeline"][-1], "Выбор: Вариант 299")
+        self.assertIn("Событие номер", story_context["timeline_summary"])
+        self.assertLess(max(sizes[150:]) - min(sizes[150:]), 50)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,141 @@
+import asyncio
+import os
+import tempfile
+import unittest
+from aiohttp import web
+from app.core.tracing import JSONLExporter, OTLPExporter, Tracer, format_trace, load_traces
+
+class ListExporter:
+    def __init__(self):
+        self.traces = []
+    
+    def export(self, spans):
+        self.traces.append(spans)
+
+class TracerTest(unittest.IsolatedAsyncioTestCase):
+    async def test_trace_follows_tasks_and_exports_when_all_spans_end(self):
+        exporter = ListExporter()
+        tracer = Tracer(exporter)
+        release = asyncio.Event()
+        
+        @tracer.traced("illustration")
+        async def illustration():
+            with tracer.span("comfyui.execute"):
+                tracer.annotate(queue_wait_seconds=0.5)
+                await release.wait()
+        
+        async def choice():
+            root = tracer.start_trace("choice", choice="Войти в замок")
+            with tracer.span("segment"):
+                await asyncio.sleep(0)
+            task = asyncio.ensure_future(illustration())
+            await asyncio.sleep(0)
+            tracer.end(root)
+            return task
+        
+        task = await asyncio.ensure_future(choice())
+        # Корень закончен, но картинка еще рисуется - трасса не экспортирована
+        self.assertEqual(exporter.traces, [])
+        release.set()
+        await task
+        
+        self.assertEqual(len(exporter.traces), 1)
+        spans = {span.name: span for span in exporter.traces[0]}
+        self.assertEqual(set(spans), {"choice", "segment", "illustration", "comfyui.execute"})
+        self.assertEqual(len({span.trace_id for span in spans.values()}), 1)
+        self.assertEqual(spans["illustration"].parent_id, spans["choice"].span_id)
+        self.assertEqual(spans["comfyui.execute"].parent_id, spans["illustration"].span_id)
+        self.assertEqual(spans["comfyui.execute"].attributes, {"queue_wait_seconds": 0.5})
+    
+    async def test_statuses_and_spans_outside_trace(self):
+        exporter = ListExporter()
+        tracer = Tracer(exporter)
+        with tracer.span("startup") as span:
+            self.assertIsNone(span)
+        
+        tracer.start_trace("choice")
+        with self.assertRaises(ValueError):
+            with tracer.span("ollama.analysis"):
+                raise ValueError("пустой ответ")
+        
+        async def cancelled():
+            with tracer.span("segment"):
+                await asyncio.sleep(10)
+        
+        task = asyncio.ensure_future(cancelled())
+        await asyncio.sleep(0)
+        task.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await task
+        tracer.end(tracer.current())
+        
+        spans = {span.name: span for span in exporter.traces[0]}
+        self.assertEqual(spans["ollama.analysis"].status, "error")
+        self.assertIn("пустой ответ", spans["ollama.analysis"].error)
+        self.assertEqual(spans["segment"].status, "cancelled")
+        self.assertEqual(tracer.get_stats()["pending_traces"], 0)
+    
+    async def test_jsonl_file_can_be_dissected(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "traces.jsonl")
+            tracer = Tracer(JSONLExporter(path))
+            root = tracer.start_trace("choice")
+            with tracer.span("gpu.prepare", action="keep"):
+                pass
+            tracer.end(root)
+            await tracer.flush()
+            
+            traces = load_traces(path)
+            self.assertEqual(len(traces), 1)
+            lines = format_trace(next(iter(traces.values()))).splitlines()
+            self.assertTrue(lines[0].endswith("choice"))
+            self.assertTrue(lines[1].endswith("  gpu.prepare  action=keep"))
+    
+    async def test_jsonl_file_rotates(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "traces.jsonl")
+            exporter = JSONLExporter(path, max_bytes=1000)
+            tracer = Tracer(exporter)
+            for segment in range(10):
+                root = tracer.start_trace("choice", segment=segment)
+                tracer.end(root)
+                await tracer.flush()
+            
+            self.assertGreater(exporter.stats["rotations"], 0)
+            self.assertLessEqual(os.path.getsize(path), 1000)
+            self.assertTrue(os.path.exists(path + ".1"))
+            # Последняя трасса - в текущем файле
+            segments = [spans[0]["attributes"]["segment"] for spans in load_traces(path).values()]
+            self.assertEqual(segments[-1], 9)
+    
+    async def test_otlp_exporter_posts_to_collector(self):
+        received = []
+        
+        async def collect(request):
+            received.append(await request.json())
+            return web.json_response({})
+        
+        app = web.Application()
+        app.router.add_post("/v1/traces", collect)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        try:
+            exporter = OTLPExporter(f"http://127.0.0.1:{port}/v1/traces")
+            tracer = Tracer(exporter)
+            root = tracer.start_trace("choice", segment=2)
+            tracer.end(root)
+            await tracer.flush()
+        finally:
+            await runner.cleanup()
+        
+        self.assertEqual(exporter.stats["exported"], 1)
+        span = received[0]["resourceSpans"][0]["scopeSpans"][0]["spans"][0]
+        self.assertEqual(span["name"], "choice")
+        self.assertEqual(len(span["traceId"]), 32)
+        self.assertEqual(span["attributes"], [{"key": "segment", "value": {"intValue": "2"}}])
+
+if __name__ == "__main__":
+    unittest.main()
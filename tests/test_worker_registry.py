@@ -0,0 +1,61 @@
+import asyncio
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+from app.core.worker_registry import WorkerRegistry
+
+class TestWorkerRegistry(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, "registry.db")
+        self.registry = WorkerRegistry(self.path, lock_poll=0.01)
+    
+    def tearDown(self):
+        self.registry.close()
+        self.tmp.cleanup()
+    
+    async def test_lock_is_exclusive(self):
+        """Блокировка не пускает второго владельца, даже через другой экземпляр реестра"""
+        other = WorkerRegistry(self.path, lock_poll=0.01)
+        order = []
+        
+        async def hold(registry, name):
+            async with registry.lock("gpu"):
+                order.append(f"{name}+")
+                await asyncio.sleep(0.05)
+                order.append(f"{name}-")
+        
+        await asyncio.gather(hold(self.registry, "a"), hold(other, "b"))
+        self.assertIn(order, (["a+", "a-", "b+", "b-"], ["b+", "b-", "a+", "a-"]))
+    
+    async def test_dead_worker_rows_ignored(self):
+        await self.registry.add_lease("comfyui", "mine")
+        # Запись процесса, который уже завершился
+        process = subprocess.Popen([sys.executable, "-c", "pass"])
+        process.wait()
+        self.registry._execute(
+            "INSERT INTO leases (id, resource, worker, acquired) VALUES ('dead', 'comfyui', ?, 0)", (process.pid,)
+        )
+        self.assertEqual(await self.registry.count_leases("comfyui"), 1)
+        self.assertEqual(self.registry.stats["stale_rows_removed"], 1)
+        
+        await self.registry.remove_lease("mine")
+        self.assertEqual(await self.registry.count_leases("comfyui"), 0)
+    
+    async def test_connections_and_flags(self):
+        await self.registry.register_connection("c1")
+        await self.registry.update_connection("c1", "token")
+        self.assertEqual(await self.registry.count_connections("token"), 1)
+        await self.registry.forget_worker()
+        self.assertEqual(await self.registry.count_connections(), 0)
+        
+        self.assertIsNone(await self.registry.get_flag("comfy_resident"))
+        await self.registry.set_flag("comfy_resident", "1")
+        other = WorkerRegistry(self.path)
+        self.assertEqual(await other.get_flag("comfy_resident"), "1")
+        other.close()
+
+if __name__ == '__main__':
+    unittest.main()